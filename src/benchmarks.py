@@ -0,0 +1,254 @@
+"""Benchmarks Comparing the Performance of the Data and Model Paths.
+
+Each benchmark runs on synthetic data so that it can be used on any
+machine, prints a short report, and returns the measured values.
+
+Example
+-------
+python src/benchmarks.py
+"""
+import time
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+from PIL import Image
+from torch.utils import data
+from torchvision import transforms
+
+from utils import STANDARD_IMAGE_TRANSFORMS, BatchImageTransform, BatchCollate
+from resources import ResourcePlan, available_cores
+from models import CustomCNN, InceptionV4
+from export import export_model, load_exported, example_inputs, onnxruntime
+from fusion import fuse_conv_bn
+
+
+def _main():
+    """Run all of the benchmarks."""
+    benchmark_image_transforms()
+    benchmark_resource_plans()
+    benchmark_export()
+    benchmark_fusion()
+
+
+def benchmark_image_transforms(batch_size:int=32, n_batches:int=5, image_size:tuple=(1024, 1024)) -> dict:
+    """Compare the per-sample and batched image transforms.
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of images per batch.
+    n_batches : int
+        Number of batches transformed by each path.
+    image_size : tuple
+        The height and width of the synthetic RGB images.
+
+    Returns
+    -------
+    Dictionary
+        Images per second of the per-sample and batched paths.
+    """
+    rng = np.random.default_rng(42)
+    images = [Image.fromarray(rng.integers(0, 256, (*image_size, 3), dtype=np.uint8)) for _ in range(batch_size)]
+    collate = BatchCollate(BatchImageTransform())
+    collate_cl = BatchCollate(BatchImageTransform(channels_last=True))
+    to_tensor = transforms.PILToTensor()
+
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        data.default_collate([STANDARD_IMAGE_TRANSFORMS(img) for img in images])
+    per_sample = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        collate([(to_tensor(img), 0) for img in images])
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        collate_cl([(np.asarray(img), 0) for img in images])
+    batched_cl = time.perf_counter() - start
+
+    n_images = batch_size * n_batches
+    results = {'per-sample': n_images / per_sample, 'batched': n_images / batched, 'channels last': n_images / batched_cl}
+    print("Image transforms ({} images of {}x{}):".format(n_images, *image_size))
+    for path, rate in results.items():
+        print(f'  {path:14s} {rate:10.1f} images/sec')
+    return results
+
+
+class SyntheticImages(data.Dataset):
+    """Dataset of random RGB images passed through the standard transforms."""
+
+    def __init__(self, length:int=256, image_size:tuple=(768, 768)):
+        """Init the Class."""
+        self.length = length
+        self.image_size = image_size
+
+    def __len__(self):
+        """Get the number of images."""
+        return self.length
+
+    def __getitem__(self, index):
+        """Create the image and its one-hot label."""
+        rng = np.random.default_rng(index)
+        img = Image.fromarray(rng.integers(0, 256, (*self.image_size, 3), dtype=np.uint8))
+        label = torch.zeros(2)
+        label[index % 2] = 1
+        return STANDARD_IMAGE_TRANSFORMS(img), label
+
+
+def benchmark_resource_plans(model:nn.Module=None, dataset:data.Dataset=None, plans:list=None, batch_size:int=16, n_batches:int=8) -> dict:
+    """Measure the training throughput of several resource plans.
+
+    Parameters
+    ----------
+    model : torch Module
+        The model trained during the benchmark. Defaults to a small
+        convolutional network.
+    dataset : torch Dataset
+        The dataset loaded during the benchmark. Defaults to random
+        images passed through the standard transforms.
+    plans : list of ResourcePlan
+        The plans compared. Defaults to plans with no workers and with
+        an eighth, a quarter, and half of the cores as workers.
+    batch_size : int
+        Number of images per batch.
+    n_batches : int
+        Number of training steps measured for each plan.
+
+    Returns
+    -------
+    Dictionary
+        Images per second of each plan.
+    """
+    if model == None:
+        model = nn.Sequential(
+                nn.Conv2d(1, 32, kernel_size=7, stride=2), nn.BatchNorm2d(32), nn.ReLU(),
+                nn.Conv2d(32, 64, kernel_size=3, stride=2), nn.BatchNorm2d(64), nn.ReLU(),
+                nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(64, 2), nn.Softmax(dim=1))
+    if dataset == None:
+        dataset = SyntheticImages(batch_size * (n_batches + 1))
+    if plans == None:
+        n_cores = len(available_cores())
+        n_workers = sorted({0, *(max(n_cores // d, 1) for d in (8, 4, 2) if n_cores >= 2)})
+        plans = [ResourcePlan(num_workers=n) for n in n_workers]
+    opt = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss = nn.BCELoss()
+    results = dict()
+    print("Resource plans ({} batches of {} images):".format(n_batches, batch_size))
+    for plan in plans:
+        # Every plan starts from the cores of the process, not the
+        # pinning of the previous plan.
+        with plan:
+            loader = data.DataLoader(dataset, batch_size=batch_size, **plan.loader_kwargs())
+            batches = iter(loader)
+            # The first batch includes the start up of the workers.
+            next(batches)
+            start = time.perf_counter()
+            for _, (inputs, labels) in zip(range(n_batches), batches):
+                opt.zero_grad()
+                loss(model(inputs), labels).backward()
+                opt.step()
+            rate = n_batches * batch_size / (time.perf_counter() - start)
+            del batches, loader
+        results[repr(plan)] = rate
+        print(f'  {rate:10.1f} images/sec  {plan}')
+    return results
+
+
+def benchmark_export(model:nn.Module=None, batch_size:int=4, n_batches:int=5, image_size:tuple=(512, 512)) -> dict:
+    """Compare the latency of the eager model with its exported artifacts.
+
+    Parameters
+    ----------
+    model : torch Module
+        The model exported during the benchmark. Defaults to CustomCNN.
+    batch_size : int
+        Number of images per batch.
+    n_batches : int
+        Number of batches evaluated by each runtime.
+    image_size : tuple
+        The height and width of the images expected by the model.
+
+    Returns
+    -------
+    Dictionary
+        Milliseconds per batch of the eager, TorchScript, and (when
+        onnxruntime is installed) ONNX runtimes.
+    """
+    if model == None:
+        model = CustomCNN(1, 2)
+    model = model.eval()
+    inputs = example_inputs(model, batch_size, image_size)
+    formats = ('torchscript', 'onnx') if onnxruntime is not None else ('torchscript',)
+    runtimes = {'eager': model}
+    with tempfile.TemporaryDirectory() as root:
+        filenames = export_model(model, root, formats, inputs=inputs, version=0)
+        for fmt, filename in filenames.items():
+            runtimes[fmt] = load_exported(filename)
+        results = dict()
+        with torch.inference_mode():
+            for runtime, function in runtimes.items():
+                # The first call includes the optimization of the graph.
+                function(*inputs)
+                start = time.perf_counter()
+                for _ in range(n_batches):
+                    function(*inputs)
+                results[runtime] = 1000 * (time.perf_counter() - start) / n_batches
+    print("Export latency ({}, batches of {}):".format(model.__class__.__name__, batch_size))
+    for runtime, latency in results.items():
+        print(f'  {runtime:14s} {latency:10.1f} ms/batch')
+    return results
+
+
+def benchmark_fusion(model:InceptionV4=None, batch_size:int=4, n_batches:int=5, image_size:tuple=(299, 299)) -> dict:
+    """Compare the latency of every Inception block before and after fusing its convolutions and BatchNorms.
+
+    Each block receives the activations produced by the previous block
+    of the model, so it is measured with the shapes it sees in practice.
+
+    Parameters
+    ----------
+    model : InceptionV4
+        The model whose blocks are measured. Defaults to a single
+        channel InceptionV4.
+    batch_size : int
+        Number of images per batch.
+    n_batches : int
+        Number of batches evaluated by each block.
+    image_size : tuple
+        The height and width of the images given to the stem.
+
+    Returns
+    -------
+    Dictionary
+        Milliseconds per batch of the eager and fused version of every
+        block.
+    """
+    if model == None:
+        model = InceptionV4(2, 1)
+    model = model.eval()
+    fused = fuse_conv_bn(model)
+    x = torch.randn(batch_size, model.stem.conv1.in_channels, *image_size)
+    results = dict()
+    with torch.inference_mode():
+        for name in ('stem', 'ia', 'ra', 'ib', 'rb', 'ic'):
+            latencies = dict()
+            for variant, block in (('eager', getattr(model, name)), ('fused', getattr(fused, name))):
+                block(x)
+                start = time.perf_counter()
+                for _ in range(n_batches):
+                    block(x)
+                latencies[variant] = 1000 * (time.perf_counter() - start) / n_batches
+            results[getattr(model, name).__class__.__name__] = latencies
+            x = getattr(model, name)(x)
+    print("Conv-BN fusion latency (batches of {}):".format(batch_size))
+    for block, latencies in results.items():
+        print(f'  {block:14s} {latencies["eager"]:10.1f} -> {latencies["fused"]:10.1f} ms/batch')
+    return results
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,269 @@
+"""Persistent Caches for Preprocessed Images and Predictions.
+
+Stores the arrays produced by the preprocessing functions, such as
+load_image and rescale_image, so that repeated experiments over the
+same datasets skip the decoding and resizing of the images. The cache
+is made of an in-process LRU layer in front of an on-disk LRU layer
+whose size is capped. The predictions of the dashboard are cached in
+the same manner for studies that are uploaded again.
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ArrayCache:
+    """Two level LRU cache of numpy arrays.
+
+    The keys are built from the content or the path and modification
+    time of the source together with the parameters of the transform,
+    so that a change to either one results in a new entry.
+
+    Parameters
+    ----------
+    root : str
+        Directory where the arrays are stored. The cache is kept in
+        memory only when stated to be None.
+    max_disk_bytes : int
+        The maximum size of the arrays stored on disk. The least
+        recently used arrays are removed once the size is exceeded.
+    max_memory_items : int
+        The maximum number of arrays kept in memory.
+
+    Examples
+    --------
+    >>> cache = ArrayCache("data/.cache")
+    >>> img = load_image("data/Dataset_BUSI_with_GT/benign/benign (1).png", img_size, cache=cache)
+    >>> print(cache.summary())
+    """
+
+    def __init__(self, root:str=None, max_disk_bytes:int=10 * 2**30, max_memory_items:int=256):
+        """Init the Class."""
+        self.root = root
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory hits': 0, 'disk hits': 0, 'misses': 0}
+        self.disk_bytes = 0
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(root) if entry.name.endswith('.npy'))
+
+    @staticmethod
+    def file_key(filename:str, **params) -> str:
+        """Create the key for a file and the parameters of its transform.
+
+        The file is identified by its absolute path, size, and
+        modification time so that the file does not need to be read.
+        """
+        stat = os.stat(filename)
+        ident = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, params]
+        return hashlib.sha1(json.dumps(ident, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def array_key(arr:np.ndarray, **params) -> str:
+        """Create the key for an array and the parameters of its transform."""
+        arr = np.ascontiguousarray(arr)
+        digest = hashlib.blake2b(arr.data, digest_size=20)
+        digest.update(json.dumps([arr.shape, str(arr.dtype), params], sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key:str) -> np.ndarray:
+        """Get a copy of the cached array, None is returned on a miss."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory hits'] += 1
+                return self.memory[key].copy()
+        if self.root is not None:
+            filename = self.path(key)
+            try:
+                arr = np.load(filename)
+                os.utime(filename)
+            except (FileNotFoundError, ValueError):
+                arr = None
+            if arr is not None:
+                with self.lock:
+                    self.stats['disk hits'] += 1
+                self.remember(key, arr)
+                return arr.copy()
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key:str, arr:np.ndarray):
+        """Store the array within the memory and disk layers."""
+        self.remember(key, arr.copy())
+        if self.root is None:
+            return
+        filename = self.path(key)
+        tmp = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fp:
+            np.save(fp, arr)
+        os.replace(tmp, filename)
+        with self.lock:
+            self.disk_bytes += os.path.getsize(filename)
+            evict = self.disk_bytes > self.max_disk_bytes
+        if evict:
+            self.evict()
+
+    def get_or_compute(self, key:str, function) -> np.ndarray:
+        """Get the cached array or compute and store it on a miss."""
+        arr = self.get(key)
+        if arr is None:
+            arr = function()
+            self.put(key, arr)
+        return arr
+
+    def remember(self, key:str, arr:np.ndarray):
+        """Add the array to the memory layer."""
+        with self.lock:
+            self.memory[key] = arr
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_items:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        """Remove the least recently used arrays until the disk cap is met."""
+        entries = [entry for entry in os.scandir(self.root) if entry.name.endswith('.npy')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.disk_bytes = total
+
+    def path(self, key:str) -> str:
+        """Get the path of the file storing the array."""
+        return os.path.join(self.root, key + '.npy')
+
+    def hit_rate(self) -> float:
+        """Calculate the fraction of lookups answered by the cache."""
+        hits = self.stats['memory hits'] + self.stats['disk hits']
+        lookups = hits + self.stats['misses']
+        return hits / lookups if lookups > 0 else 0.0
+
+    def summary(self) -> str:
+        """Summarize the counters of the cache for logging."""
+        return "memory hits: {}, disk hits: {}, misses: {}, hit rate: {:.1%}".format(
+                self.stats['memory hits'], self.stats['disk hits'], self.stats['misses'], self.hit_rate())
+
+
+class PredictionCache:
+    """LRU cache of the predictions made for uploaded files.
+
+    The keys are built from a hash of the decoded content of the file
+    together with the version of the model, so that the same study
+    gives the same key whichever way it was uploaded, and the
+    predictions of a new model are never mixed with those of the
+    previous one. The predictions may also be kept within a diskcache
+    directory, which is shared safely by the processes of the
+    application and survives its restarts.
+
+    Parameters
+    ----------
+    version : int | str
+        The version of the model making the predictions.
+    max_items : int
+        The maximum number of predictions kept in memory.
+    cache_dir : str
+        Optional diskcache directory storing the predictions.
+
+    Examples
+    --------
+    >>> predictions = PredictionCache(version)
+    >>> key = predictions.key(content)
+    >>> result = predictions.get(key)
+    """
+
+    def __init__(self, version, max_items:int=1024, cache_dir:str=None):
+        """Init the Class."""
+        self.version = str(version)
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory hits': 0, 'disk hits': 0, 'misses': 0}
+        self.disk = None
+        if cache_dir != None:
+            import diskcache
+            self.disk = diskcache.Cache(cache_dir)
+
+    def close(self):
+        """Close the diskcache."""
+        if self.disk is not None:
+            with self.lock:
+                self.disk.close()
+                self.disk = None
+
+    def key(self, content:bytes) -> str:
+        """Create the key of the decoded content of a file for the current model version."""
+        return self.digest_key(hashlib.blake2b(content, digest_size=20).hexdigest())
+
+    def digest_key(self, digest:str) -> str:
+        """Create the key from the hex digest of content hashed in chunks."""
+        return "{}:{}".format(self.version, digest)
+
+    def encoded_key(self, contents:str, chunk_size:int=2**20) -> str:
+        """Create the key of a file uploaded as a base64 data url.
+
+        The encoded payload is hashed as is, which is far cheaper than
+        decoding it, so that files uploaded again through the dashboard
+        are found without being decoded. These keys differ from those
+        of the decoded content.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for i in range(contents.index(',') + 1, len(contents), chunk_size):
+            digest.update(contents[i:i + chunk_size].encode('ascii'))
+        return "{}:base64:{}".format(self.version, digest.hexdigest())
+
+    def get(self, key:str) -> dict:
+        """Get the cached prediction, None is returned on a miss."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory hits'] += 1
+                return dict(self.memory[key])
+            result = self.disk.get(key) if self.disk is not None else None
+            if result is not None:
+                self.stats['disk hits'] += 1
+                self.remember(key, result)
+                return dict(result)
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key:str, result:dict):
+        """Store the prediction within memory and the diskcache."""
+        with self.lock:
+            self.remember(key, dict(result))
+            if self.disk is not None:
+                self.disk[key] = dict(result)
+
+    def remember(self, key:str, result:dict):
+        """Add the prediction to the memory layer, the lock must be held."""
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        """Calculate the fraction of lookups answered by the cache."""
+        hits = self.stats['memory hits'] + self.stats['disk hits']
+        lookups = hits + self.stats['misses']
+        return hits / lookups if lookups > 0 else 0.0
+
+    def summary(self) -> str:
+        """Summarize the counters of the cache for the dashboard."""
+        return "memory hits: {}, disk hits: {}, misses: {}, hit rate: {:.1%}".format(
+                self.stats['memory hits'], self.stats['disk hits'], self.stats['misses'], self.hit_rate())
@@ -7,25 +7,52 @@ library uses the plotly library on the backend to develop
 plots and display them within html that the Dash library
 develops.
 """
+import os
 import base64
+import hashlib
 import datetime
-import io
+import tempfile
+from functools import partial
+from tempfile import SpooledTemporaryFile
 
-from dash import Dash, dcc, html, dash_table
+from dash import Dash, dcc, html, dash_table, no_update
 from dash.dependencies import Input, Output, State
+from flask import request, jsonify
 
 import plotly.express as px
 from plotly.subplots import make_subplots
-import pydicom as pdc
 from pandas import DataFrame
 
 
-from pipeline import extract_data, transform_data, predict
+from inference import InferenceService, load_model, decode_dicom
+from jobs import JobQueue
+from cache import PredictionCache
 
+MODEL_PATH = os.environ.get('CAPAPP_MODEL', "models/tclass_VGG14.pt")
+# The jobs are kept within a diskcache shared by the gunicorn workers,
+# since the dashboard may poll a job from another worker than the one
+# processing it. An empty value keeps them within a single process.
+JOB_CACHE = os.environ.get('CAPAPP_JOB_CACHE', os.path.join(tempfile.gettempdir(), 'capapp-jobs')) or None
+# The predictions are kept within a diskcache shared by the workers and
+# across restarts. An empty value keeps them within the memory of each worker.
+PREDICTION_CACHE = os.environ.get('CAPAPP_PREDICTION_CACHE', os.path.join(tempfile.gettempdir(), 'capapp-predictions')) or None
+# Uploads larger than the spool size are written to disk and decoded
+# lazily from the file instead of being copied to the decoding processes.
+SPOOL_SIZE = 32 * 2**20
+CHUNK_SIZE = 2**20
+DEFER_SIZE = '1 MB'
 
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_version.txt'), 'r') as fp:
+    MODEL_VERSION = int(fp.read())
+    fp.close()
 
 app = Dash(__name__)
 
+# Loaded once per worker process and shared by all of the callbacks.
+service = InferenceService(load_model(MODEL_PATH), decoder=partial(decode_dicom, defer_size=DEFER_SIZE), max_batch_size=32, max_latency=0.02)
+predictions = PredictionCache(MODEL_VERSION, max_items=4096, cache_dir=PREDICTION_CACHE)
+jobs = JobQueue(service, cache_dir=JOB_CACHE, cache=predictions)
+
 colors = {
     'background': '#111111',
     'text': '#7FDBFF'
@@ -50,15 +77,23 @@ app.layout = html.Div([
     },
     multiple=True
     ),
+    dcc.Location(id='url'),
+    dcc.Store(id='job-id'),
+    dcc.Store(id='job-rendered', data=0),
+    dcc.Interval(id='job-poll', interval=1000, disabled=True),
+    html.Div(id='job-progress'),
     html.Div(id='output-data-upload')
 ])
 
 def parse_contents(contents, filename, date):
     """Load the content.
 
-    Function set to load the uploaded content and
-    transform the data into a readable format for
-    the machine learning model to make predictions.
+    Function set to load the uploaded content into a
+    file, which is decoded and transformed for the
+    machine learning model to make predictions. The
+    content is decoded in chunks into a temporary file
+    that is only kept in memory for small files, and
+    the decoded bytes are hashed along the way.
 
     Parameters
     ----------
@@ -78,74 +113,199 @@ def parse_contents(contents, filename, date):
         Used to let the user know the date in which
         the file was uploaded. Will be used within
         report to download.
+
+    Returns
+    -------
+    tuple
+        The SpooledTemporaryFile containing the decoded
+        content of the file and the hex digest of that
+        content.
     """
-    content_type, content = contents.split(',')
-    decoded = base64.b64decode(content)
-    try:
-        ds = pdc.dcmread(io.BytesIO(decoded))
-        datapoint = extract_data(ds)
-        datapoint = transform_data(datapoint)
-    except Exception as e:
-        print(e)
-        return html.Div([
-            'There was an error processing this file.'
-        ])
-    return datapoint
+    fp = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    digest = hashlib.blake2b(digest_size=20)
+    start = contents.index(',') + 1
+    # Chunks of a multiple of four characters decode independently.
+    step = 4 * (CHUNK_SIZE // 3)
+    for i in range(start, len(contents), step):
+        chunk = base64.b64decode(contents[i:i + step])
+        fp.write(chunk)
+        digest.update(chunk)
+    fp.seek(0)
+    return fp, digest.hexdigest()
+
+
+def spool_content(fp:SpooledTemporaryFile):
+    """Get the content of small files for the decoding processes.
+
+    Files larger than the spool size are kept on disk and returned as
+    is, to be decoded from the file by the inference service.
+    """
+    size = fp.seek(0, os.SEEK_END)
+    fp.seek(0)
+    if size > SPOOL_SIZE:
+        return fp
+    content = fp.read()
+    fp.close()
+    return content
+
+
+def decode_upload(contents):
+    """Decode an uploaded file for the job queue, only large files are kept as files."""
+    fp, digest = parse_contents(contents, None, None)
+    return spool_content(fp), digest
 
 
 @app.callback(
-    Output('output-data-upload', 'children'),
+    Output('job-id', 'data'),
+    Output('job-rendered', 'data', allow_duplicate=True),
+    Output('job-poll', 'disabled', allow_duplicate=True),
     Input('upload-data', 'contents'),
     State('upload-data', 'filename'),
-    State('upload-data', 'last_modified'))
-def update_output(list_of_contents, list_of_names, list_of_dates): #Need to change this to collect all data.
+    State('upload-data', 'last_modified'),
+    prevent_initial_call=True)
+def start_job(list_of_contents, list_of_names, list_of_dates):
+    """Queue the uploaded files and start polling for their results.
+
+    Files whose content was predicted before by the same model version
+    are taken from the prediction cache without being read by pydicom.
+    Files uploaded again are found by the hash of their encoded content
+    without being decoded, the others by the hash of the decoded file,
+    the same as for /upload.
+    """
+    if list_of_contents is None:
+        return no_update, no_update, no_update
+    return jobs.submit_encoded(list_of_contents, list_of_names, decode_upload), 0, False
+
+
+@app.callback(
+    Output('job-id', 'data', allow_duplicate=True),
+    Output('job-rendered', 'data', allow_duplicate=True),
+    Output('job-poll', 'disabled', allow_duplicate=True),
+    Input('url', 'search'),
+    prevent_initial_call=True)
+def follow_job(search):
+    """Poll the job given by the url, such as one created through /upload."""
+    params = dict(param.split('=', 1) for param in (search or '').lstrip('?').split('&') if '=' in param)
+    if 'job' not in params:
+        return no_update, no_update, no_update
+    return params['job'], 0, False
+
+
+@app.callback(
+    Output('job-progress', 'children'),
+    Output('output-data-upload', 'children'),
+    Output('job-rendered', 'data'),
+    Output('job-poll', 'disabled'),
+    Input('job-poll', 'n_intervals'),
+    State('job-id', 'data'),
+    State('job-rendered', 'data'),
+    prevent_initial_call=True)
+def update_output(n_intervals, job_id, rendered):
+    """Update the progress and the dashboard with the results received so far."""
+    if job_id is None:
+        return no_update, no_update, no_update, True
+    job = jobs.status(job_id)
+    if job is None:
+        if jobs.shared:
+            return html.H6("The job {} was not found or has expired.".format(job_id)), no_update, no_update, True
+        # The job may belong to another worker, keep polling until the
+        # request reaches it.
+        return html.H6("Waiting for the job..."), no_update, no_update, False
+    finished = job['status'] == 'done'
+    progress = html.Div([
+        html.H6("Processed {} of {} files{}".format(job['done'], job['total'], '.' if finished else '...')),
+        html.H6("Prediction cache {}".format(predictions.summary())),
+    ])
+    if job['done'] == rendered:
+        return progress, no_update, rendered, finished
+    return progress, render_dashboard(job['results']), job['done'], finished
+
+
+def render_dashboard(results:list[dict]):
     """Load the main dashboard."""
-    if list_of_contents is not None:
-        data = DataFrame([
-            parse_contents(c, n, d) for c, n, d in zip(list_of_contents, list_of_names, list_of_dates)
-        ])
-        data = predict(data, "models/tclass_VGG14")
-        first_column = data.pop('Subject ID')
-        data.insert(0, 'Suject ID', first_column)
-        data['score'] = data['score'].astype(str)
-        #Plotting the data.
-        fig = make_subplots(
-            rows=2, cols=2
-        )
-        fig1 = px.pie(data, names='pred_class')
-        fig2 = px.pie(data, names='sex')
-        fig3 = px.pie(data, names='side')
-        fig4 = px.histogram(data, x='age')
-        fig5 = px.histogram(data, x='pred_class')
-        fig6 = px.histogram(data, x='side')
+    for result in results:
+        if 'error' in result:
+            print("Unable to process {}: {}".format(result['filename'], result['error']))
+    data = DataFrame([result for result in results if 'error' not in result])
+    if data.empty:
         return html.Div([
-            html.H1(children='Main Dashboard', style={'textAlign': 'center'}),
-            html.H5('Data Table'),
-            html.H6(datetime.datetime.now()),
-            html.Div([
-                html.Div([
-                    dcc.Graph(id='g1', figure=fig1, style={'display': 'inline-block', 'width':'33vw'}),
-                    dcc.Graph(id='g2', figure=fig2, style={'display': 'inline-block', 'width':'33vw'}),
-                    dcc.Graph(id='g3', figure=fig3, style={'display': 'inline-block', 'width':'33vw'}),
-                ]),
-                html.Div(children=[
-                    dcc.Graph(id='g4', figure=fig4, style={'display': 'inline-block', 'width': '33vw'}),
-                    dcc.Graph(id='g5', figure=fig5, style={'display': 'inline-block', 'width': '33vw'}),
-                    dcc.Graph(id='g6', figure=fig6, style={'display': 'inline-block', 'width': '33vw'}),
-                ])
-            ], className="row"),
-            #dcc.Graph(figure=fig1, style={'display': 'inline-block'}),
-            #dcc.Graph(figure=fig2, style={'display': 'inline-block'}),
-
-            dash_table.DataTable(
-                data.to_dict('records'),
-                [{'name':i, 'id':i} for i in data.columns],
-                export_format="csv"
-            ),
-            html.Hr(),
+            'There was an error processing the uploaded files.'
         ])
+    data = data.drop(columns=['scores'])
+    first_column = data.pop('Subject ID')
+    data.insert(0, 'Suject ID', first_column)
+    data['score'] = data['score'].astype(str)
+    #Plotting the data.
+    fig = make_subplots(
+        rows=2, cols=2
+    )
+    fig1 = px.pie(data, names='pred_class')
+    fig2 = px.pie(data, names='sex')
+    fig3 = px.pie(data, names='side')
+    fig4 = px.histogram(data, x='age')
+    fig5 = px.histogram(data, x='pred_class')
+    fig6 = px.histogram(data, x='side')
+    return html.Div([
+        html.H1(children='Main Dashboard', style={'textAlign': 'center'}),
+        html.H5('Data Table'),
+        html.H6(datetime.datetime.now()),
+        html.Div([
+            html.Div([
+                dcc.Graph(id='g1', figure=fig1, style={'display': 'inline-block', 'width':'33vw'}),
+                dcc.Graph(id='g2', figure=fig2, style={'display': 'inline-block', 'width':'33vw'}),
+                dcc.Graph(id='g3', figure=fig3, style={'display': 'inline-block', 'width':'33vw'}),
+            ]),
+            html.Div(children=[
+                dcc.Graph(id='g4', figure=fig4, style={'display': 'inline-block', 'width': '33vw'}),
+                dcc.Graph(id='g5', figure=fig5, style={'display': 'inline-block', 'width': '33vw'}),
+                dcc.Graph(id='g6', figure=fig6, style={'display': 'inline-block', 'width': '33vw'}),
+            ])
+        ], className="row"),
+        #dcc.Graph(figure=fig1, style={'display': 'inline-block'}),
+        #dcc.Graph(figure=fig2, style={'display': 'inline-block'}),
+
+        dash_table.DataTable(
+            data.to_dict('records'),
+            [{'name':i, 'id':i} for i in data.columns],
+            export_format="csv"
+        ),
+        html.Hr(),
+    ])
 
 server = app.server
 
+
+@server.route('/upload', methods=['POST'])
+def upload():
+    """Stream an uploaded DICOM file into a job.
+
+    The body of the request is the raw file, which is written in
+    chunks to a temporary file that is only kept in memory for small
+    files, so that large multi-frame files are never held in memory as
+    a whole. The name of the file is given by the `filename` query
+    parameter. The returned job is shown by the dashboard at /?job=id.
+
+    Example
+    -------
+    curl -X POST --data-binary @study.dcm "http://localhost:8050/upload?filename=study.dcm"
+    """
+    filename = request.args.get('filename', 'upload.dcm')
+    fp = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    digest = hashlib.blake2b(digest_size=20)
+    while True:
+        chunk = request.stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        fp.write(chunk)
+        digest.update(chunk)
+    key = predictions.digest_key(digest.hexdigest())
+    result = predictions.get(key)
+    if result is not None:
+        fp.close()
+        job_id = jobs.submit([], [], cached=[{'filename': filename, **result}])
+    else:
+        job_id = jobs.submit([spool_content(fp)], [filename], [key])
+    return jsonify({'job_id': job_id, 'status_url': '/?job={}'.format(job_id)})
+
 if __name__ == '__main__':
     app.run_server(debug=False, port='8050')
@@ -0,0 +1,160 @@
+"""Periodic Checkpoints for Resuming Training.
+
+Saves the model, optimizer, random number generators, and position
+within the dataset every few steps or minutes so that a crashed run
+resumes from the last checkpoint instead of from the first epoch. The
+state is copied to the cpu on the training thread and written to disk
+by a background thread, every file is written under a temporary name
+and renamed once complete so that a crash never leaves a partial
+checkpoint behind.
+"""
+import os
+import re
+import time
+import random
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint-(\d+)\.pt$')
+
+
+def snapshot(state):
+    """Copy every tensor within a (nested) state to the cpu."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+def get_rng_state() -> dict:
+    """Get the state of the python, numpy, and pytorch generators."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state:dict):
+    """Restore the state of the python, numpy, and pytorch generators."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer:
+    """Writer of periodic training checkpoints.
+
+    Parameters
+    ----------
+    root : str
+        Directory where the checkpoints are stored.
+    every_steps : int
+        Number of optimizer steps between checkpoints.
+    every_minutes : float
+        Number of minutes between checkpoints. A checkpoint is written
+        whenever either of the two intervals has passed.
+    keep_last : int
+        Number of checkpoints kept, the older ones are removed.
+
+    Examples
+    --------
+    >>> checkpointer = Checkpointer("models/checkpoints", every_steps=500, every_minutes=15)
+    >>> trainer = ClassTrainer(model, opt, loss, checkpointer=checkpointer)
+    >>> trainer.resume()
+    >>> trainer.train(train_loader, 160)
+    """
+
+    def __init__(self, root:str, every_steps:int=None, every_minutes:float=None, keep_last:int=3):
+        """Init the Class."""
+        assert every_steps != None or every_minutes != None, "Either every_steps or every_minutes must be given."
+        assert keep_last > 0, "At least one checkpoint must be kept."
+        self.root = root
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.keep_last = keep_last
+        self.last_step = 0
+        self.last_time = time.monotonic()
+        self.thread = None
+        self.error = None
+        os.makedirs(root, exist_ok=True)
+
+    def due(self, step:int) -> bool:
+        """Check whether a checkpoint should be written at the step."""
+        if self.every_steps != None and step - self.last_step >= self.every_steps:
+            return True
+        if self.every_minutes != None and time.monotonic() - self.last_time >= 60 * self.every_minutes:
+            return True
+        return False
+
+    def save(self, state:dict, step:int) -> str:
+        """Write the state in the background.
+
+        The tensors are copied to the cpu before returning, so training
+        may continue to update the model while the file is written.
+        Waits for the previous checkpoint when it is still being
+        written.
+
+        Parameters
+        ----------
+        state : dict
+            The state saved within the checkpoint.
+        step : int
+            The training step of the state, used to name the file.
+
+        Returns
+        -------
+        str
+            The path of the checkpoint.
+        """
+        self.wait()
+        filename = os.path.join(self.root, "checkpoint-{:08d}.pt".format(step))
+        self.thread = threading.Thread(target=self._write, args=(snapshot(state), filename))
+        self.thread.start()
+        self.last_step = step
+        self.last_time = time.monotonic()
+        return filename
+
+    def wait(self):
+        """Wait for the checkpoint being written and raise its errors."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, state:dict, filename:str):
+        """Write the checkpoint and remove the old ones, run on the background thread."""
+        try:
+            tmp = filename + '.tmp'
+            torch.save(state, tmp)
+            os.replace(tmp, filename)
+            for old in self.checkpoints()[:-self.keep_last]:
+                os.remove(old)
+        except Exception as e:
+            self.error = e
+
+    def checkpoints(self) -> list[str]:
+        """Get the paths of the checkpoints sorted from oldest to newest."""
+        names = sorted(entry.name for entry in os.scandir(self.root) if CHECKPOINT_PATTERN.match(entry.name))
+        return [os.path.join(self.root, name) for name in names]
+
+    def latest(self) -> str:
+        """Get the path of the newest checkpoint, None when there are none."""
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load(self, filename:str=None) -> dict:
+        """Load a checkpoint onto the cpu, defaults to the newest one."""
+        if filename == None:
+            filename = self.latest()
+        if filename == None:
+            return None
+        state = torch.load(filename, map_location='cpu', weights_only=False)
+        self.last_step = state['step']
+        return state
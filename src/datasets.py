@@ -1,9 +1,15 @@
 """Custom Dataset Classes that Inherit from Pytorch's Dataset Class."""
 import os
+import json
+import random
+import hashlib
+import threading
 
 from torch.utils import data
+from torch import distributed as dist
 import polars as pl
 from pydicom import dcmread
+from pydicom.pixels import pixel_array
 import numpy as np
 import torch
 from PIL import Image
@@ -14,40 +20,216 @@ def _main():
     pass
 
 
+INDEX_FILENAME = '.file_index.npz'
+# Indexes of read-only datasets are kept within the cache of the user.
+INDEX_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'pyblight', 'indexes')
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def default_index_file(root:str) -> str:
+    """Find the path of the index of the root directory.
+
+    The index is kept within the root directory when it already exists
+    there or when the directory is writable, otherwise within a folder
+    of the user cache named after the absolute path of the root.
+    """
+    filename = os.path.join(root, INDEX_FILENAME)
+    if os.path.exists(filename) or os.access(root, os.W_OK):
+        return filename
+    digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()
+    return os.path.join(INDEX_CACHE_DIR, digest, INDEX_FILENAME)
+
+def list_class_folders(root:str) -> tuple:
+    """List the class folders of the root together with their modification times in nanoseconds."""
+    with os.scandir(root) as entries:
+        folders = sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries if entry.is_dir())
+    return [name for name, _ in folders], [mtime for _, mtime in folders]
+
+
+def build_file_index(root:str, filename:str=None) -> dict:
+    """Build the index of the image files within class folders.
+
+    Scans every class folder found directly within the root directory
+    and records the relative path of each file together with the
+    numeric id of its class. The index is stored as compact numpy
+    arrays so that it can be reloaded without scanning the directory
+    tree again, together with the modification time of every class
+    folder, which changes whenever a file is added or removed.
+
+    Parameters
+    ----------
+    root : str
+        Path to the folder containing one folder per class.
+    filename : str
+        Path where the index is saved. Stated to be None if the index
+        should not be saved.
+
+    Returns
+    -------
+    Dictionary
+        Contains the arrays `paths`, `labels`, `classes`, and `mtimes`.
+    """
+    classes, mtimes = list_class_folders(root)
+    paths = list()
+    labels = list()
+    for class_id, folder in enumerate(classes):
+        with os.scandir(os.path.join(root, folder)) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_file())
+        paths.extend(os.path.join(folder, name) for name in names)
+        labels.extend([class_id] * len(names))
+    index = {
+            'paths': np.array(paths, dtype=np.str_),
+            'labels': np.array(labels, dtype=np.int32),
+            'classes': np.array(classes, dtype=np.str_),
+            'mtimes': np.array(mtimes, dtype=np.int64),
+            }
+    if filename != None:
+        # Save through a temporary file so that a reader never loads a
+        # partially written index.
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            with open(tmp, 'wb') as fp:
+                np.savez(fp, **index)
+            os.replace(tmp, filename)
+        except OSError as e:
+            print("Unable to save the file index {}: {}".format(filename, e))
+    return index
+
+def load_file_index(root:str, filename:str=None, rebuild:bool=False) -> dict:
+    """Load the index of the image files, building it when missing.
+
+    Parameters
+    ----------
+    root : str
+        Path to the folder containing one folder per class.
+    filename : str
+        Path to the saved index. Defaults to `default_index_file`.
+    rebuild : bool
+        Determines whether the directory tree is scanned again even
+        though a saved index exists. The index is also built again
+        when the class folders or their modification times changed.
+
+    Returns
+    -------
+    Dictionary
+        Contains the arrays `paths`, `labels`, `classes`, and `mtimes`.
+    """
+    if filename == None:
+        filename = default_index_file(root)
+    if rebuild or not os.path.exists(filename):
+        return build_file_index(root, filename)
+    with np.load(filename, allow_pickle=False) as fp:
+        index = {key: fp[key] for key in fp.files}
+    classes, mtimes = list_class_folders(root)
+    if 'mtimes' not in index or classes != index['classes'].tolist() or mtimes != index['mtimes'].tolist():
+        return build_file_index(root, filename)
+    return index
+
+
 class ImageSet(data.Dataset):
-    """Dataset that will load unlabeled images.
+    """Dataset that will load images organized within class folders.
 
     *Alternatively, one can use the torchvision.data.ImageFolder class for the same reason.*
 
+    The files are listed once into an index saved within the root
+    directory, or the user cache for read-only directories. Later
+    instances reload the index instead of listing the folders again,
+    unless a file was added to or removed from a class folder since.
+
     Parameters
     ----------
     root : str
         Path to the folder containing the data.
+    image_loader : Callable
+        Function that loads the image from its path. Defaults to
+        opening the file with PIL.
+    transform : Callable
+        Transformation applied to the loaded image.
+    index_file : str
+        Path to the saved index. Defaults to a hidden file within the
+        root directory when it is writable.
+    rebuild_index : bool
+        Determines whether the index is built again from the folders.
     """
 
-    def __init__(self, root='train/', image_loader=None, transform=None):
+    def __init__(self, root='train/', image_loader=None, transform=None, index_file:str=None, rebuild_index:bool=False):
         """Initialize the Dataset Subclass."""
         self.root = root
-        self.folders = os.listdir(root)
-        self.files = list()
-        self.dict__files = dict()
-        for folder in self.folders:
-            fold = os.path.join(self.root, folder)
-            self.dict__files[folder] = os.listdir(fold)
-            self.files.extend(os.listdir(fold))
-        self.loader = image_loader
+        self.index_file = index_file if index_file != None else default_index_file(root)
+        index = load_file_index(root, self.index_file, rebuild_index)
+        self.paths = index['paths']
+        self.labels = index['labels']
+        self.classes = index['classes'].tolist()
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.loader = image_loader if image_loader is not None else Image.open
         self.transform = transform
 
     def __len__(self):
         """Get the Length of the items within the dataset."""
-        return sum([len(self.files)])
+        return len(self.paths)
 
     def __getitem__(self, index):
         """Get item from class."""
-        images = [self.loader(os.path.join(self.root, folder)) for folder in self.folders]
+        if torch.is_tensor(index):
+            index = index.tolist()
+        image = self.loader(os.path.join(self.root, str(self.paths[index])))
         if self.transform is not None:
-            images = [self.transform(img) for img in images]
-        return images
+            image = self.transform(image)
+        return image, int(self.labels[index])
+
+
+class StreamingImageSet(data.IterableDataset):
+    """Streaming version of the ImageSet.
+
+    Iterates through the indexed files, giving each DataLoader worker
+    its own share of the files so that no file is loaded twice within
+    an epoch.
+
+    Parameters
+    ----------
+    root : str
+        Path to the folder containing the data.
+    image_loader : Callable
+        Function that loads the image from its path.
+    transform : Callable
+        Transformation applied to the loaded image.
+    index_file : str
+        Path to the saved index.
+    shuffle : bool
+        Determines whether the order of the files changes on every
+        epoch.
+    seed : int
+        Seed used to shuffle the files.
+    """
+
+    def __init__(self, root='train/', image_loader=None, transform=None, index_file:str=None, shuffle:bool=False, seed:int=42):
+        """Initialize the Dataset Subclass."""
+        self.dataset = ImageSet(root, image_loader, transform, index_file)
+        self.classes = self.dataset.classes
+        self.class_to_idx = self.dataset.class_to_idx
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch:int):
+        """Set the epoch used to shuffle the files."""
+        self.epoch = epoch
+
+    def __len__(self):
+        """Get the Length of the items within the dataset."""
+        return len(self.dataset)
+
+    def __iter__(self):
+        """Iterate through the share of files of the current worker."""
+        order = np.arange(len(self.dataset))
+        if self.shuffle:
+            np.random.default_rng(self.seed + self.epoch).shuffle(order)
+        worker = data.get_worker_info()
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+        for index in order:
+            yield self.dataset[index]
 
 
 class MixedDataset(data.Dataset):
@@ -74,26 +256,111 @@ class MixedDataset(data.Dataset):
         self.loader = image_loader
         self.image_transforms = image_transforms
         self.cat_transforms = cat_transforms
+        # Convert the tabular data once; each datapoint is then a row
+        # slice of these contiguous tensors.
+        self.paths = np.array(self.csv.get_column('path').to_list(), dtype=np.str_)
+        self.features = torch.tensor(self.csv.select(pl.exclude('path', self.lcol)).to_numpy(), dtype=torch.float32)
+        self.labels = torch.tensor(self.csv.select(self.lcol).to_numpy(), dtype=torch.int64)
 
     def __len__(self):
         """Calculate the length of the dataset."""
-        return self.csv.select(pl.count()).item()
+        return len(self.labels)
 
     def __getitem__(self, index):
         """Get the datapoint."""
         if torch.is_tensor(index):
-            index.tolist()
-        image = Image.open(self.csv['path'][index])
+            index = index.tolist()
+        return self.load_sample(self.paths[index], self.features[index], self.labels[index])
+
+    def __getitems__(self, indices:list[int]) -> list[dict]:
+        """Get a batch of datapoints.
+
+        Gathers the supplementary data and labels of the whole batch
+        with a single fancy index before the images are loaded.
+
+        Parameters
+        ----------
+        indices : list of int
+            Positions of the datapoints within the dataset.
+
+        Returns
+        -------
+        list of dict
+            The datapoints in the same order as the indices.
+        """
+        index = torch.as_tensor(indices, dtype=torch.int64)
+        paths = self.paths[index.numpy()]
+        features = self.features[index]
+        labels = self.labels[index]
+        return [self.load_sample(*sample) for sample in zip(paths, features, labels)]
+
+    def load_sample(self, path:str, supplementary_data:torch.Tensor, labels:torch.Tensor) -> dict:
+        """Load the image of a single datapoint and apply the transforms."""
+        image = Image.open(str(path))
         if self.image_transforms:
             image = self.image_transforms(image)
-        supplementary_data = np.array(self.csv.select(pl.exclude('path', self.lcol)))
-        labels = np.array(self.csv.select(self.lcol))
         if self.cat_transforms:
-            labels = self.label_transforms(labels)
+            labels = self.cat_transforms(labels)
         sample = {'image':image, 'supplementary data':supplementary_data, 'labels':labels}
         return sample
 
 
+class PixelCache:
+    """On-disk cache of decoded pixel data read through memory maps.
+
+    Decoded images are written once as ``.npy`` files whose names are
+    derived from the absolute path and modification time of the source
+    file. Later reads open the file with ``np.memmap`` so that repeated
+    epochs and DataLoader workers share the pages of the operating
+    system cache instead of decoding the source file again.
+
+    Parameters
+    ----------
+    root : str
+        Directory where the decoded arrays are stored.
+    """
+
+    def __init__(self, root:str):
+        """Init the Class."""
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, path:str) -> str:
+        """Create the cache key for the file found at the path."""
+        stat = os.stat(path)
+        ident = "{}:{}".format(os.path.abspath(path), stat.st_mtime_ns)
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def load(self, path:str, decoder) -> np.ndarray:
+        """Load the decoded array, decoding and storing it on a miss.
+
+        Parameters
+        ----------
+        path : str
+            Path to the source file.
+        decoder : Callable
+            Function that receives the path and returns the decoded
+            numpy array.
+
+        Returns
+        -------
+        numpy memmap
+            Copy-on-write array mapped from the cached file. Writes,
+            such as in-place transforms, only change private copies of
+            the pages and never reach the cached file.
+        """
+        filename = os.path.join(self.root, self.key(path) + '.npy')
+        if not os.path.exists(filename):
+            arr = decoder(path)
+            # Write to a private file first so that concurrent workers
+            # never map a partially written array.
+            tmp = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as fp:
+                np.save(fp, np.ascontiguousarray(arr))
+            os.replace(tmp, filename)
+        return np.load(filename, mmap_mode='c')
+
+
 class DICOMSet(data.Dataset):
     """Dataset used to load and extract information from DICOM images.
 
@@ -109,9 +376,13 @@ class DICOMSet(data.Dataset):
         The column containing the labels for the classifier.
     img_col : String
         The column containing the path to the dicom file.
+    cache_dir : String
+        Optional directory used to cache the decoded images. When set,
+        each DICOM file is decoded once and read back through a memory
+        map on later accesses.
     """
 
-    def __init__(self, csvfile:str|pl.DataFrame, label_col:str,img_col:str="path", image_loader=None, image_transforms=None, categorical_transforms=None):
+    def __init__(self, csvfile:str|pl.DataFrame, label_col:str,img_col:str="path", image_loader=None, image_transforms=None, categorical_transforms=None, cache_dir:str=None):
         """Init the Class."""
         assert (type(csvfile) == str) | (type(csvfile) == pl.DataFrame), TypeError("csvfile is not of the correct type, the current type is {}".format(type(csvfile)))
         if type(csvfile) == str:
@@ -123,19 +394,52 @@ class DICOMSet(data.Dataset):
         self.loader = image_loader
         self.img_transforms = image_transforms
         self.cat_transforms = categorical_transforms
+        self.cache = PixelCache(cache_dir) if cache_dir is not None else None
+        # Materialize the columns once so that lookups do not build a
+        # new DataFrame for every sample.
+        self.paths = np.array(self.csv.get_column(self.pcol).to_list(), dtype=np.str_)
+        self.labels = self.csv.get_column(self.lcol).cast(pl.Int8).to_numpy()
 
     def __len__(self):
         """Calculate the length of the dataset."""
-        return len(self.csv)
-        #return self.csv.select(pl.count()).item()
+        return len(self.labels)
 
     def __getitem__(self, index):
         """Get the datapoint."""
         if torch.is_tensor(index):
-            index.tolist()
-        dicom_file = dcmread(self.csv.select(self.pcol).row(index)[0])
-        img = self.extract_image(dicom_file)
-        cat = self.csv.select(pl.col(self.lcol).cast(pl.Int8)).row(index)[0]
+            index = index.tolist()
+        return self.load_sample(self.paths[index], self.labels[index])
+
+    def __getitems__(self, indices:list[int]) -> list:
+        """Get a batch of datapoints.
+
+        Used by the DataLoader when a batch sampler is available so
+        that the paths and labels of the whole batch are gathered with
+        a single index into the precomputed arrays.
+
+        Parameters
+        ----------
+        indices : list of int
+            Positions of the datapoints within the dataset.
+
+        Returns
+        -------
+        list
+            The datapoints in the same order as the indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        paths = self.paths[indices]
+        labels = self.labels[indices]
+        return [self.load_sample(path, cat) for path, cat in zip(paths, labels)]
+
+    def load_sample(self, path:str, cat:int):
+        """Load the image of a single datapoint and apply the transforms."""
+        path = str(path)
+        cat = int(cat)
+        if self.cache is not None:
+            img = self.cache.load(path, self.read_image)
+        else:
+            img = self.read_image(path)
         if self.img_transforms:
             img = self.img_transforms(img)
         if self.cat_transforms:
@@ -143,16 +447,37 @@ class DICOMSet(data.Dataset):
         #sample = {'image': img, 'labels': cat}
         return img, cat
 
+    @classmethod
+    def read_image(cls, path:str) -> np.ndarray:
+        """Read the DICOM file and extract its image."""
+        return cls.extract_image(dcmread(path, stop_before_pixels=True), path)
+
     @staticmethod
-    def extract_image(dicom_file):
-        """Extract image from the DICOM File."""
-        slices = np.asarray(dicom_file.pixel_array).astype('float32')
-        if slices.ndim <= 2:
-            slice = slices
-        elif slices.ndim > 3:
-            slice = slices[0]
-        slice = slice[..., np.newaxis]
-        return slice
+    def extract_image(dicom_file, src=None):
+        """Extract the first frame of the DICOM File.
+
+        Only the first frame is decoded and converted to float32, so
+        multi-frame files never hold all of their frames in memory.
+
+        Parameters
+        ----------
+        dicom_file
+            DICOM file containing the image.
+        src : str | file-like
+            Optional path to or handle of the same file, positioned at
+            its start. Only the bytes of the first frame are then read,
+            so the dataset may be read without its pixel data.
+
+        Returns
+        -------
+        numpy array
+            The frame of shape (height, width, 1), the first sample is
+            kept for images with several samples per pixel.
+        """
+        slice = pixel_array(src if src is not None else dicom_file, index=0)
+        if slice.ndim > 2:
+            slice = slice[..., 0]
+        return slice.astype(np.float32)[..., np.newaxis]
 
     @staticmethod
     def extract_metadata(dicom_file, cols:list[str]) -> dict:
@@ -175,5 +500,152 @@ class DICOMSet(data.Dataset):
         return {str(col):dicom_file[str(col)].value for col in cols}
 
 
+class ShardSet(data.IterableDataset):
+    """Dataset that streams images from the shards written by ingest.
+
+    Reads each shard in large sequential chunks and passes the images
+    through an in-memory shuffle buffer, so that training does not pay
+    a random seek per sample. The datapoints match those of the
+    DICOMSet, an image of shape (height, width, 1) and an integer
+    label.
+
+    The shuffled shards are read as one sequence of samples that is
+    cut into equal contiguous spans, one per distributed rank, and each
+    span is cut again across the DataLoader workers. Every rank
+    therefore runs the same number of batches, as required by the
+    collective operations of DistributedDataParallel, while reading at
+    most two shards partially. The last `count % world_size` samples of
+    the sequence are dropped, which differ between epochs.
+
+    Parameters
+    ----------
+    root : str
+        Folder containing the shards and their manifest.
+    shuffle_buffer : int
+        Number of samples kept in memory to shuffle the stream. A value
+        of zero keeps the order of the shards.
+    chunk_size : int
+        Number of images read from a shard at once.
+    shuffle : bool
+        Determines whether the order of the shards changes on every
+        epoch.
+    seed : int
+        Seed shared by all of the workers and ranks.
+    image_transforms : Callable
+        Transformation applied to the image.
+    categorical_transforms : Callable
+        Transformation applied to the label.
+    rank : int
+        Rank of the current process. Defaults to the rank of the
+        initialized process group.
+    world_size : int
+        Number of processes. Defaults to the size of the initialized
+        process group.
+    """
+
+    def __init__(self, root:str, shuffle_buffer:int=1024, chunk_size:int=256, shuffle:bool=True, seed:int=42, image_transforms=None, categorical_transforms=None, rank:int=None, world_size:int=None):
+        """Init the Class."""
+        self.root = root
+        with open(os.path.join(root, MANIFEST_FILENAME), 'r') as fp:
+            self.manifest = json.load(fp)
+            fp.close()
+        self.shards = self.manifest['shards']
+        # The labels are small, read them here since Polars must not be
+        # used within forked DataLoader workers.
+        self.labels = [pl.read_parquet(os.path.join(root, shard['metadata']), columns=['label']).get_column('label').to_numpy() for shard in self.shards]
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.img_transforms = image_transforms
+        self.cat_transforms = categorical_transforms
+        distributed = dist.is_available() and dist.is_initialized()
+        if rank == None:
+            rank = dist.get_rank() if distributed else 0
+        if world_size == None:
+            world_size = dist.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch:int):
+        """Set the epoch used to shuffle the shards."""
+        self.epoch = epoch
+
+    def __len__(self):
+        """Calculate the number of samples seen by each rank."""
+        return sum(len(labels) for labels in self.labels) // self.world_size
+
+    def spans(self, num_workers:int=1, worker_id:int=0) -> list[tuple]:
+        """Find the part of each shard read by a worker of the current rank.
+
+        Returns
+        -------
+        list of tuple
+            The shard together with the first and last (exclusive)
+            sample read from it, in the shuffled order of the epoch.
+        """
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            np.random.default_rng(self.seed + self.epoch).shuffle(order)
+        per_rank = len(self)
+        start = self.rank * per_rank
+        begin = start + per_rank * worker_id // num_workers
+        end = start + per_rank * (worker_id + 1) // num_workers
+        spans = list()
+        offset = 0
+        for shard in order:
+            length = len(self.labels[shard])
+            first, last = max(begin - offset, 0), min(end - offset, length)
+            if first < last:
+                spans.append((int(shard), first, last))
+            offset += length
+        return spans
+
+    def __iter__(self):
+        """Iterate through the span of the current worker and rank."""
+        worker = data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        # Workers receive a new seed from the DataLoader every epoch.
+        seed = worker.seed if worker is not None else self.seed + self.epoch
+        rng = random.Random(seed + self.rank)
+        buffer = list()
+        for shard, first, last in self.spans(num_workers, worker_id):
+            for sample in self.read_shard(shard, first, last):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if self.shuffle_buffer > 0:
+                    i = rng.randrange(len(buffer))
+                    buffer[i], sample = sample, buffer[i]
+                yield self.transform(*sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.transform(*sample)
+
+    def read_shard(self, shard:int, first:int=0, last:int=None):
+        """Read the images and labels of a shard sequentially, from the first to the last (exclusive) sample."""
+        images = np.load(os.path.join(self.root, self.shards[shard]['images']), mmap_mode='r')
+        labels = self.labels[shard]
+        if last == None:
+            last = len(labels)
+        for start in range(first, last, self.chunk_size):
+            stop = min(start + self.chunk_size, last)
+            chunk = np.asarray(images[start:stop], dtype=np.float32)
+            if self.manifest['dtype'] == 'uint16':
+                chunk /= np.iinfo(np.uint16).max
+            chunk = np.moveaxis(chunk, 1, -1)
+            for img, cat in zip(chunk, labels[start:stop]):
+                yield img, int(cat)
+
+    def transform(self, img:np.ndarray, cat:int):
+        """Apply the transforms to the datapoint."""
+        if self.img_transforms:
+            img = self.img_transforms(img)
+        if self.cat_transforms:
+            cat = self.cat_transforms(cat)
+        return img, cat
+
+
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,208 @@
+"""Export of Trained Models for Inference.
+
+Converts the trained models into TorchScript or ONNX artifacts that no
+longer depend on the classes of models.py. The models are put into
+evaluation mode so that BatchNorm uses its running statistics and
+Dropout is disabled, and the BatchNorm layers are folded into the
+weights of their convolutions before tracing. Each artifact is named after the
+model and its version and is accompanied by a json file describing its
+inputs.
+
+The exported models are loaded with `load_exported`, which runs
+TorchScript artifacts through `torch.jit.optimize_for_inference` and
+ONNX artifacts through onnxruntime on the cpu when it is installed.
+
+Example
+-------
+>>> filenames = export_model(model, "models/", formats=('torchscript', 'onnx'))
+>>> model = load_exported("models/AlexNet_v3")
+"""
+import os
+import copy
+import json
+
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from utils import img_size
+from fusion import fuse_conv_bn
+
+EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+
+
+def read_version(filename:str=None) -> int:
+    """Read the current model version, defaults to model_version.txt of this folder."""
+    if filename == None:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_version.txt')
+    with open(filename, 'r') as fp:
+        version = int(fp.read())
+        fp.close()
+    return version
+
+def example_inputs(model:nn.Module, batch_size:int=1, image_size:tuple=img_size) -> tuple:
+    """Create random inputs with the shapes expected by the model.
+
+    The number of channels is taken from the first convolution. The
+    TumorClassifier additionally receives its categorical features.
+
+    Parameters
+    ----------
+    model : torch Module
+        The model receiving the inputs.
+    batch_size : int
+        Number of samples within the inputs.
+    image_size : tuple
+        The height and width of the images.
+
+    Returns
+    -------
+    tuple
+        The tensors given to the forward pass of the model.
+    """
+    conv = next(module for module in model.modules() if isinstance(module, nn.Conv2d))
+    inputs = (torch.randn(batch_size, conv.in_channels, *image_size),)
+    if model.__class__.__name__ == 'TumorClassifier':
+        if len(model.catlinears) > 0:
+            cat_length = model.catlinears[0].in_features
+        else:
+            cat_length = model.outlinear.in_features - model.linear8.out_features
+        inputs = inputs + (torch.randn(batch_size, cat_length),)
+    return inputs
+
+def export_model(model:nn.Module, root:str="models", formats:tuple=('torchscript',), inputs:tuple=None, version:int=None, name:str=None, fuse:bool=True) -> dict:
+    """Export the model into versioned inference artifacts.
+
+    Parameters
+    ----------
+    model : torch Module
+        The trained model, such as InceptionV4, AlexNet, CustomCNN, or
+        TumorClassifier.
+    root : str
+        Folder where the artifacts are written.
+    formats : tuple
+        The formats of the artifacts, torchscript and/or onnx.
+    inputs : tuple
+        Example inputs used to trace the model, created by
+        `example_inputs` when not given.
+    version : int
+        The version of the model, defaults to the one within
+        model_version.txt.
+    name : str
+        The name of the artifacts, defaults to the class of the model.
+    fuse : bool
+        Determines whether the convolutions and BatchNorms are fused
+        before the export. The model itself is left untouched, a copy
+        of it is exported from the cpu in evaluation mode.
+
+    Returns
+    -------
+    Dictionary
+        The path of the artifact of each format.
+    """
+    assert all(fmt in EXTENSIONS for fmt in formats), "The formats must be within {}.".format(tuple(EXTENSIONS))
+    if version == None:
+        version = read_version()
+    if name == None:
+        name = model.__class__.__name__
+    model = copy.deepcopy(model).cpu().eval()
+    if fuse:
+        model = fuse_conv_bn(model, inplace=True)
+    if inputs == None:
+        inputs = example_inputs(model)
+    os.makedirs(root, exist_ok=True)
+    stem = os.path.join(root, "{}_v{}".format(name, version))
+    input_names = ["input{}".format(i) for i in range(len(inputs))]
+    filenames = dict()
+    with torch.no_grad():
+        for fmt in formats:
+            filename = stem + EXTENSIONS[fmt]
+            if fmt == 'torchscript':
+                traced = torch.jit.trace(model, inputs)
+                torch.jit.save(torch.jit.freeze(traced), filename)
+            else:
+                dynamic_axes = {input_name: {0: 'batch'} for input_name in input_names + ['output']}
+                torch.onnx.export(model, inputs, filename, input_names=input_names, output_names=['output'], dynamic_axes=dynamic_axes, dynamo=False)
+            filenames[fmt] = filename
+    metadata = {
+            'name': name,
+            'version': version,
+            'model': model.__class__.__name__,
+            'inputs': [{'name': input_name, 'shape': list(x.shape[1:])} for input_name, x in zip(input_names, inputs)],
+            'formats': {fmt: os.path.basename(filename) for fmt, filename in filenames.items()},
+            }
+    with open(stem + '.json', 'w') as fp:
+        json.dump(metadata, fp, indent=2)
+        fp.close()
+    return filenames
+
+def load_exported(path:str, device:torch.device=torch.device("cpu"), prefer_onnx:bool=True):
+    """Load an exported model for inference.
+
+    Parameters
+    ----------
+    path : str
+        The artifact, or the path of the artifacts without extension.
+        When the ONNX artifact exists and onnxruntime is installed it is
+        preferred, otherwise the TorchScript artifact is used.
+    device : torch device
+        The device of the TorchScript model, ONNX runs on the cpu.
+    prefer_onnx : bool
+        Determines whether the ONNX artifact is preferred.
+
+    Returns
+    -------
+    torch ScriptModule | OnnxModel
+        The model, called with the same tensors as the eager model.
+    """
+    stem, ext = os.path.splitext(path)
+    if ext not in EXTENSIONS.values():
+        stem, ext = path, None
+    use_onnx = ext == '.onnx' or (ext == None and prefer_onnx and onnxruntime is not None and os.path.exists(stem + '.onnx'))
+    if use_onnx:
+        return OnnxModel(stem + '.onnx')
+    model = torch.jit.load(stem + '.pt', map_location=device).eval()
+    return torch.jit.optimize_for_inference(model)
+
+
+class OnnxModel:
+    """ONNX artifact run by onnxruntime on the cpu.
+
+    Behaves like the exported module, the tensors given to the model
+    are returned as a tensor.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the ONNX artifact.
+    threads : int
+        Number of threads used by onnxruntime, defaults to the number
+        of threads used by pytorch.
+    """
+
+    def __init__(self, filename:str, threads:int=None):
+        """Init the Class."""
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required to run the ONNX artifact {}.".format(filename))
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads if threads != None else torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, *inputs) -> torch.Tensor:
+        """Run the model on the inputs."""
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+    def to(self, device):
+        """Keep the model on the cpu, used for compatibility with modules."""
+        return self
+
+    def eval(self):
+        """Return the model, which is always in evaluation mode."""
+        return self
@@ -0,0 +1,98 @@
+"""Fusion of Convolutions and Batch Normalizations for Inference.
+
+In evaluation mode a BatchNorm only scales and shifts every channel
+with fixed values, which can be folded into the weights and bias of
+the preceding convolution. Fusing every conv/bn pair of a model
+removes one kernel launch and one pass over the activations per pair
+while giving the same outputs up to rounding.
+
+The pairs are found through the naming used in models.py, where each
+`conv{suffix}` is directly followed by `bn{suffix}` in the forward
+pass, and through adjacent layers of the Sequential containers, such
+as those of AlexNet. Models whose BatchNorm does not directly follow
+its convolution, such as the TumorClassifier which pools in between,
+are left untouched. The ReLU following each fused convolution is
+fused by `torch.jit.optimize_for_inference` once the model is
+exported.
+
+Example
+-------
+>>> fused = fuse_conv_bn(model)
+>>> fused(images)
+"""
+import copy
+
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models import CustomCNN, InceptionStem, InceptionA, InceptionB, InceptionC, ReductionA, ReductionB
+
+NAMED_PAIR_MODULES = (CustomCNN, InceptionStem, InceptionA, InceptionB, InceptionC, ReductionA, ReductionB)
+
+
+def fuse_conv_bn(model:nn.Module, inplace:bool=False) -> nn.Module:
+    """Fold every BatchNorm into its preceding convolution.
+
+    Parameters
+    ----------
+    model : torch Module
+        The trained model, such as an InceptionV4 or AlexNet.
+    inplace : bool
+        Determines whether the model itself is modified instead of a
+        copy of it.
+
+    Returns
+    -------
+    torch Module
+        The model in evaluation mode with the fused convolutions, the
+        BatchNorm layers are replaced by identities.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, NAMED_PAIR_MODULES):
+            fuse_named_pairs(module)
+        elif isinstance(module, nn.Sequential):
+            fuse_sequential(module)
+    return model
+
+def fuse_named_pairs(module:nn.Module) -> int:
+    """Fuse the `conv{suffix}` and `bn{suffix}` children of the module.
+
+    Returns
+    -------
+    int
+        The number of fused pairs.
+    """
+    n_fused = 0
+    for name, conv in list(module.named_children()):
+        if not (name.startswith('conv') and isinstance(conv, nn.Conv2d)):
+            continue
+        bn_name = 'bn' + name[len('conv'):]
+        bn = getattr(module, bn_name, None)
+        if isinstance(bn, nn.BatchNorm2d):
+            setattr(module, name, fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+            n_fused += 1
+    return n_fused
+
+def fuse_sequential(module:nn.Sequential) -> int:
+    """Fuse the adjacent convolutions and BatchNorms of the Sequential.
+
+    Returns
+    -------
+    int
+        The number of fused pairs.
+    """
+    n_fused = 0
+    for i in range(len(module) - 1):
+        if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+            module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+            module[i + 1] = nn.Identity()
+            n_fused += 1
+    return n_fused
+
+def count_batchnorms(model:nn.Module) -> int:
+    """Count the BatchNorm layers that remain within the model."""
+    return sum(isinstance(module, nn.BatchNorm2d) for module in model.modules())
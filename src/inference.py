@@ -0,0 +1,267 @@
+"""Batched Inference for the Dashboard.
+
+Keeps a single copy of the model in memory for the lifetime of the
+application process. Uploaded files are decoded within a pool of
+threads, and the decoded images of concurrent requests are gathered
+into micro-batches that are each evaluated with one forward pass once
+the batch is full or its deadline has passed.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+import torch
+from torch import nn
+from pydicom import dcmread
+from PIL import Image
+
+from datasets import DICOMSet
+from utils import img_size
+from export import load_exported
+
+METADATA_COLUMNS = {'PatientID': 'Subject ID', 'PatientSex': 'sex', 'ImageLaterality': 'side', 'PatientAge': 'age'}
+CLASSES = ('benign', 'malignant')
+
+_STOP = object()
+
+
+def load_model(filename:str, device:torch.device=torch.device("cpu")) -> nn.Module:
+    """Load an exported artifact or a pickled model for evaluation.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the saved model, or to the artifacts written by
+        `export_model` without their extension.
+    device : torch device
+        The device where the model is loaded.
+
+    Returns
+    -------
+    torch Module
+        The model in evaluation mode.
+    """
+    try:
+        model = load_exported(filename, device)
+    except RuntimeError:
+        model = torch.load(filename, map_location=device, weights_only=False)
+    return model.eval()
+
+def decode_dicom(fp, size:tuple=img_size, defer_size:str|int=None) -> tuple:
+    """Decode a DICOM file into the input of the model and its metadata.
+
+    Parameters
+    ----------
+    fp : str | file-like
+        Path to or handle of the DICOM file.
+    size : tuple
+        The width and height of the image given to the model.
+    defer_size : str | int
+        Elements larger than this size are only read from the file
+        once accessed. The pixel data is never read as a whole, only
+        the first frame is read from files given by path or by a
+        seekable handle.
+
+    Returns
+    -------
+    tuple
+        The normalized image of shape (1, height, width) and the
+        dictionary of metadata shown on the dashboard.
+    """
+    if not hasattr(fp, 'read') or fp.seekable():
+        start = fp.tell() if hasattr(fp, 'read') else None
+        dicom_file = dcmread(fp, defer_size=defer_size, stop_before_pixels=True)
+        if start != None:
+            fp.seek(start)
+        slice = DICOMSet.extract_image(dicom_file, fp)[..., 0]
+    else:
+        dicom_file = dcmread(fp, defer_size=defer_size)
+        slice = DICOMSet.extract_image(dicom_file)[..., 0]
+    img = Image.fromarray(slice).resize(size, resample=Image.BILINEAR)
+    data = np.asarray(img, dtype=np.float32)
+    data = (data - data.min()) / max(data.max() - data.min(), np.finfo(np.float32).eps)
+    metadata = dict()
+    for keyword, name in METADATA_COLUMNS.items():
+        metadata[name] = str(dicom_file[keyword].value) if keyword in dicom_file else None
+    # Ages are stored as strings such as 054Y.
+    if metadata['age'] != None and metadata['age'][:-1].isdigit():
+        metadata['age'] = int(metadata['age'][:-1])
+    return torch.from_numpy(data).unsqueeze(0), metadata
+
+
+class InferenceService:
+    """Long-lived service gathering uploads into batched predictions.
+
+    Files are decoded by a pool of threads and queued for the batching
+    thread, which waits at most `max_latency` seconds after the first
+    queued file for other files to arrive before running the model on
+    all of them at once. Requests from concurrent callbacks therefore
+    share forward passes.
+
+    Parameters
+    ----------
+    model : torch Module
+        The trained classifier, loaded once.
+    decoder : Callable
+        Converts a file into the model inputs and a dictionary of
+        metadata. The inputs are a tensor or a tuple of tensors for
+        models with several inputs, such as the TumorClassifier.
+    classes : tuple
+        The names of the classes predicted by the model.
+    max_batch_size : int
+        The largest number of files evaluated by one forward pass.
+    max_latency : float
+        Number of seconds a file may wait for others to fill its batch.
+    decode_workers : int
+        Number of threads decoding the files.
+    device : torch device
+        The device used by the model.
+    activation : Callable
+        Optional function converting the outputs of the model into
+        scores, such as a softmax for models returning logits.
+
+    Examples
+    --------
+    >>> service = InferenceService(load_model("models/tclass_VGG14.pt"))
+    >>> results = service.predict(["study/1-1.dcm", "study/1-2.dcm"])
+    >>> results[0]['pred_class'], results[0]['score']
+    """
+
+    def __init__(self, model:nn.Module, decoder=decode_dicom, classes:tuple=CLASSES, max_batch_size:int=32, max_latency:float=0.02, decode_workers:int=None, device:torch.device=torch.device("cpu"), activation=None):
+        """Init the Class."""
+        assert max_batch_size > 0, "The batch size must be greater than zero."
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.decoder = decoder
+        self.classes = classes
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.activation = activation
+        self.requests = queue.Queue()
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers)
+        self.n_batches = 0
+        self.n_files = 0
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        """Use the service within a with statement."""
+        return self
+
+    def __exit__(self, *args):
+        """Stop the service at the end of the with statement."""
+        self.close()
+
+    def close(self):
+        """Stop the batching thread once the queued files are evaluated."""
+        self.decode_pool.shutdown(wait=True)
+        self.requests.put(_STOP)
+        self.thread.join()
+
+    def submit(self, fp, filename:str=None) -> Future:
+        """Queue a file for prediction.
+
+        Parameters
+        ----------
+        fp : str | file-like
+            The file given to the decoder.
+        filename : str
+            The name of the file added to the result.
+
+        Returns
+        -------
+        Future
+            Resolves to the dictionary of metadata together with the
+            scores, score, and predicted class of the file.
+        """
+        future = Future()
+
+        def decode():
+            try:
+                inputs, metadata = self.decoder(fp)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            self.enqueue(inputs, metadata, filename, future)
+
+        self.decode_pool.submit(decode)
+        return future
+
+    def enqueue(self, inputs, metadata:dict, filename:str=None, future:Future=None) -> Future:
+        """Queue inputs that were already decoded, such as by another process."""
+        if future == None:
+            future = Future()
+        if filename != None:
+            metadata = {'filename': filename, **metadata}
+        self.requests.put((inputs, metadata, future))
+        return future
+
+    def predict(self, files:list, filenames:list[str]=None, timeout:float=None) -> list[dict]:
+        """Predict the class of every file.
+
+        Files that cannot be decoded or evaluated are returned as a
+        dictionary containing the filename and the error.
+        """
+        if filenames == None:
+            filenames = [None] * len(files)
+        futures = [self.submit(fp, filename) for fp, filename in zip(files, filenames)]
+        results = list()
+        for filename, future in zip(filenames, futures):
+            try:
+                results.append(future.result(timeout))
+            except Exception as e:
+                results.append({'filename': filename, 'error': str(e)})
+        return results
+
+    def mean_batch_size(self) -> float:
+        """Calculate the average number of files per forward pass."""
+        return self.n_files / self.n_batches if self.n_batches > 0 else 0.0
+
+    def _serve(self):
+        """Gather the queued files into batches, run on the batching thread."""
+        stopping = False
+        while not stopping:
+            item = self.requests.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._evaluate(batch)
+
+    def _evaluate(self, batch:list):
+        """Run the model on a batch and resolve the futures of its files."""
+        futures = [future for _, _, future in batch]
+        try:
+            inputs = [inputs for inputs, _, _ in batch]
+            if isinstance(inputs[0], (tuple, list)):
+                inputs = [torch.stack(parts).to(self.device) for parts in zip(*inputs)]
+            else:
+                inputs = [torch.stack(inputs).to(self.device)]
+            with torch.inference_mode():
+                outputs = self.model(*inputs).float()
+                if self.activation != None:
+                    outputs = self.activation(outputs)
+            scores = outputs.cpu()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.n_batches += 1
+        self.n_files += len(batch)
+        for (_, metadata, future), row in zip(batch, scores.tolist()):
+            pred = int(np.argmax(row))
+            future.set_result({**metadata, 'scores': row, 'score': row[pred], 'pred_class': self.classes[pred]})
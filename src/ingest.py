@@ -0,0 +1,215 @@
+"""Ingestion of Raw Image Downloads into Sharded Arrays.
+
+Walks a download tree from the Cancer Imaging Archive, decodes every
+DICOM and PNG file within a pool of processes, and writes the resized
+images into fixed-size shards. Each shard is made of a contiguous numpy
+array of shape (n, 1, height, width) together with a Parquet sidecar
+containing the path, label, and requested metadata of every image. A
+manifest describing the shards is written once all of the files have
+been processed.
+
+Training can then read the shards sequentially instead of opening
+millions of small files in random order.
+
+Example
+-------
+python src/ingest.py data/CMMD data/CMMD-shards --size 512 --csv data/CMMD.csv --label-col classification
+"""
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import polars as pl
+from pydicom import dcmread
+from PIL import Image
+
+from datasets import DICOMSet, MANIFEST_FILENAME
+from utils import load_image
+
+IMAGE_EXTENSIONS = ('.dcm', '.png', '.jpg', '.jpeg')
+
+
+def _main():
+    """Ingest the download tree given through the command line."""
+    parser = argparse.ArgumentParser(description="Convert a folder of DICOM/PNG files into shards.")
+    parser.add_argument('root', help="folder containing the downloaded images.")
+    parser.add_argument('output', help="folder where the shards are written.")
+    parser.add_argument('--size', type=int, default=512, help="width and height of the stored images.")
+    parser.add_argument('--shard-size', type=int, default=1024, help="number of images per shard.")
+    parser.add_argument('--dtype', choices=('float16', 'uint16'), default='float16', help="storage type of the pixels.")
+    parser.add_argument('--workers', type=int, default=None, help="number of decoding processes.")
+    parser.add_argument('--csv', default=None, help="csv file containing the labels of the images.")
+    parser.add_argument('--label-col', default='label', help="column of the csv containing the labels.")
+    parser.add_argument('--img-col', default='path', help="column of the csv containing the paths.")
+    parser.add_argument('--metadata', nargs='*', default=[], help="DICOM keywords stored in the sidecar.")
+    args = parser.parse_args()
+    labels = None
+    if args.csv != None:
+        labels = read_labels(args.csv, args.label_col, args.img_col)
+    manifest = write_shards(args.root, args.output, args.size, args.shard_size, args.dtype, args.workers, labels, args.metadata)
+    print("Wrote {} images into {} shards.".format(manifest['count'], len(manifest['shards'])))
+    for failure in manifest['errors']:
+        print("Unable to decode {}: {}".format(failure['path'], failure['error']))
+
+
+def find_image_files(root:str) -> list[str]:
+    """Find all of the image files within the download tree.
+
+    Parameters
+    ----------
+    root : str
+        The root of the download tree.
+
+    Returns
+    -------
+    list of str
+        Sorted paths to the DICOM and PNG files.
+    """
+    files = list()
+    for path, subdirs, names in os.walk(root):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                files.append(os.path.join(path, name))
+    return sorted(files)
+
+def read_labels(csvfile:str, label_col:str, img_col:str='path') -> dict[str, int]:
+    """Read the label of each image from a csv file.
+
+    Parameters
+    ----------
+    csvfile : str
+        Path to the csv file containing the paths and labels.
+    label_col : str
+        Column containing the labels.
+    img_col : str
+        Column containing the paths to the images.
+
+    Returns
+    -------
+    Dictionary
+        Maps the absolute path of each image to its label.
+    """
+    df = pl.read_csv(csvfile).select(pl.col(img_col), pl.col(label_col).cast(pl.Int64))
+    return {os.path.abspath(path): label for path, label in df.iter_rows()}
+
+def decode_file(path:str, size:tuple|int, dtype:str='float16', metadata_cols:list[str]=()):
+    """Decode, resize, and normalize a single image file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the DICOM or PNG file.
+    size : tuple | int
+        The desired width and height of the image.
+    dtype : str
+        Storage type of the pixels, either float16 or uint16.
+    metadata_cols : list of str
+        DICOM keywords extracted together with the image.
+
+    Returns
+    -------
+    tuple
+        The image of shape (1, height, width), the dictionary of
+        metadata, and the error message, which is None unless the file
+        could not be decoded. The image is then None as well.
+    """
+    if type(size) == int:
+        size = (size, size)
+    metadata = dict()
+    try:
+        if path.lower().endswith('.dcm'):
+            dicom_file = dcmread(path, stop_before_pixels=True)
+            slice = DICOMSet.extract_image(dicom_file, path)[..., 0]
+            img = Image.fromarray(slice).resize(size, resample=Image.BILINEAR)
+            raw_data = np.asarray(img, dtype=np.float32)
+            data = (raw_data - np.min(raw_data)) / max(np.max(raw_data) - np.min(raw_data), np.finfo(np.float32).eps)
+            data = data[np.newaxis, ...]
+            cols = [col for col in metadata_cols if col in dicom_file]
+            metadata = {col: str(value) for col, value in DICOMSet.extract_metadata(dicom_file, cols).items()}
+        else:
+            data = load_image(path, size)
+    except Exception as e:
+        return None, metadata, "{}: {}".format(e.__class__.__name__, e)
+    if dtype == 'uint16':
+        if np.issubdtype(data.dtype, np.floating):
+            data = np.rint(data * np.iinfo(np.uint16).max)
+        data = data.astype(np.uint16)
+    else:
+        data = data.astype(np.float16)
+    return data, metadata, None
+
+def write_shards(root:str, output:str, size:tuple|int=512, shard_size:int=1024, dtype:str='float16', workers:int=None, labels:dict=None, metadata_cols:list[str]=()) -> dict:
+    """Decode the download tree in parallel and write it as shards.
+
+    Parameters
+    ----------
+    root : str
+        The root of the download tree.
+    output : str
+        Folder where the shards and manifest are written.
+    size : tuple | int
+        The desired width and height of the images.
+    shard_size : int
+        Number of images stored within each shard.
+    dtype : str
+        Storage type of the pixels, either float16 or uint16.
+    workers : int
+        Number of decoding processes. Defaults to the number of cores.
+    labels : dict
+        Maps the absolute path of each image to its label. Images
+        without a label are given the label -1.
+    metadata_cols : list of str
+        DICOM keywords stored within the metadata sidecar.
+
+    Returns
+    -------
+    Dictionary
+        The manifest describing the shards, which lists the files
+        that could not be decoded together with their errors.
+    """
+    assert dtype in ('float16', 'uint16'), "The dtype must be either float16 or uint16."
+    if type(size) == int:
+        size = (size, size)
+    if labels == None:
+        labels = dict()
+    os.makedirs(output, exist_ok=True)
+    files = find_image_files(root)
+    width, height = size
+    buffer = np.empty((shard_size, 1, height, width), dtype=dtype)
+    rows = list()
+    manifest = {'size': [height, width], 'dtype': dtype, 'count': 0, 'skipped': 0, 'errors': list(), 'shards': list()}
+    # Every shard has the same columns, whichever metadata its files hold.
+    schema = {'path': pl.Utf8, 'label': pl.Int64, **{col: pl.Utf8 for col in metadata_cols}}
+
+    def flush():
+        name = "shard-{:05d}".format(len(manifest['shards']))
+        np.save(os.path.join(output, name + '.npy'), buffer[:len(rows)])
+        pl.DataFrame(rows, schema=schema).write_parquet(os.path.join(output, name + '.parquet'))
+        manifest['shards'].append({'images': name + '.npy', 'metadata': name + '.parquet', 'count': len(rows)})
+        manifest['count'] += len(rows)
+        rows.clear()
+
+    decoder = partial(decode_file, size=size, dtype=dtype, metadata_cols=metadata_cols)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, result in zip(files, executor.map(decoder, files, chunksize=16)):
+            img, metadata, error = result
+            if error != None:
+                manifest['skipped'] += 1
+                manifest['errors'].append({'path': path, 'error': error})
+                continue
+            buffer[len(rows)] = img
+            rows.append({'path': path, 'label': labels.get(os.path.abspath(path), -1), **metadata})
+            if len(rows) == shard_size:
+                flush()
+    if rows:
+        flush()
+    with open(os.path.join(output, MANIFEST_FILENAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,245 @@
+"""Background Processing of Dashboard Uploads.
+
+Uploads are turned into jobs that are processed in the background
+while the dashboard polls for their progress, so that a request never
+waits for a whole study to be decoded and predicted. The files of a
+job are decoded within a pool of processes and evaluated by the
+batched InferenceService of the application process, each result is
+added to the job as soon as it is available. Large files are instead
+given as file handles, which are decoded by the threads of the
+InferenceService so that their content is never copied in memory.
+
+The jobs are stored in memory, or within a diskcache directory when
+several application processes should be able to read them.
+"""
+import io
+import uuid
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from inference import InferenceService, decode_dicom
+from cache import PredictionCache
+
+
+def decode_dicom_bytes(content:bytes) -> tuple:
+    """Decode the content of an uploaded DICOM file, run within the process pool."""
+    return decode_dicom(io.BytesIO(content))
+
+
+class MemoryStore:
+    """In-memory store of the jobs keeping the most recent ones.
+
+    Parameters
+    ----------
+    max_items : int
+        The maximum number of jobs kept.
+    """
+
+    def __init__(self, max_items:int=100):
+        """Init the Class."""
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    def get(self, key:str, default=None):
+        """Get the job, or the default when it is unknown."""
+        return self.items.get(key, default)
+
+    def set(self, key:str, value, expire:float=None):
+        """Store the job, the expiration is not used."""
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+class JobQueue:
+    """Queue processing the uploaded files of each job in the background.
+
+    Parameters
+    ----------
+    service : InferenceService
+        The service evaluating the decoded files.
+    decoder : Callable
+        Top level function decoding the content of a file within the
+        process pool, returning the model inputs and the metadata. The
+        processes are spawned, so the function must be importable.
+    decode_workers : int
+        Number of decoding processes.
+    cache_dir : str
+        Directory of the diskcache storing the jobs, which is required
+        when the application runs within several processes since the
+        status of a job may be requested from any of them. The jobs are
+        kept in the memory of this process when stated to be None.
+    expire : float
+        Number of seconds a job is kept within the diskcache.
+    cache : PredictionCache
+        Optional cache receiving the prediction of every file that was
+        submitted together with its key.
+
+    Examples
+    --------
+    >>> jobs = JobQueue(service)
+    >>> job_id = jobs.submit(contents, filenames)
+    >>> jobs.status(job_id)['done']
+    """
+
+    def __init__(self, service:InferenceService, decoder=decode_dicom_bytes, decode_workers:int=None, cache_dir:str=None, expire:float=3600, cache:PredictionCache=None):
+        """Init the Class."""
+        self.service = service
+        self.cache = cache
+        self.decoder = decoder
+        # Forking would copy the threads of the InferenceService and of
+        # torch into the decoding processes, which may deadlock them.
+        self.pool = ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.expire = expire
+        self.lock = threading.Lock()
+        # Jobs unknown to a shared store have expired, while those of a
+        # private store may belong to another process.
+        self.shared = cache_dir != None
+        if cache_dir == None:
+            self.store = MemoryStore()
+        else:
+            import diskcache
+            self.store = diskcache.Cache(cache_dir)
+
+    def close(self):
+        """Stop the decoding processes."""
+        self.pool.shutdown(wait=True)
+
+    def submit(self, contents:list[bytes], filenames:list[str], keys:list[str]=None, cached:list[dict]=()) -> str:
+        """Create the job processing the contents of the files.
+
+        Parameters
+        ----------
+        contents : list of bytes | file-like
+            The content of every uploaded file, or the handles of the
+            files decoded by the InferenceService, which are closed
+            once predicted.
+        filenames : list of str
+            The name of every uploaded file.
+        keys : list of str | tuple
+            The keys under which the predictions are cached, a tuple
+            caches the prediction under each of its keys.
+        cached : list of dict
+            Predictions of files found within the cache, which are
+            added to the job directly.
+
+        Returns
+        -------
+        str
+            The id used to poll the status of the job.
+        """
+        if keys == None:
+            keys = [None] * len(contents)
+        job_id = uuid.uuid4().hex
+        job = {'status': 'running', 'total': len(contents) + len(cached), 'done': len(cached), 'results': list(cached), 'started': time.time()}
+        self.store.set(job_id, job, expire=self.expire)
+        if not contents:
+            self.update(job_id, None)
+        for content, filename, key in zip(contents, filenames, keys):
+            if isinstance(content, (bytes, bytearray)):
+                decoding = self.pool.submit(self.decoder, content)
+                decoding.add_done_callback(lambda future, filename=filename, key=key: self.evaluate(job_id, filename, key, future))
+            else:
+                prediction = self.service.submit(content, filename)
+                prediction.add_done_callback(lambda future, fp=content, filename=filename, key=key: self.finish(job_id, filename, key, future, fp))
+        return job_id
+
+    def submit_encoded(self, contents:list[str], filenames:list[str], decode) -> str:
+        """Create the job processing files uploaded as base64 data urls.
+
+        Files are first looked up by the hash of their encoded content,
+        so that a file uploaded again is taken from the cache without
+        being decoded. The remaining files are decoded and looked up by
+        the key of their decoded content, which is shared with the
+        other upload paths, before being submitted.
+
+        Parameters
+        ----------
+        contents : list of str
+            The data url of every uploaded file.
+        filenames : list of str
+            The name of every uploaded file.
+        decode : Callable
+            Function decoding a data url into the content given to
+            `submit` and the hex digest of the decoded bytes.
+
+        Returns
+        -------
+        str
+            The id used to poll the status of the job.
+        """
+        pending, names, keys, cached = list(), list(), list(), list()
+        for encoded, filename in zip(contents, filenames):
+            if self.cache is None:
+                content, digest = decode(encoded)
+                pending.append(content)
+                names.append(filename)
+                keys.append(None)
+                continue
+            encoded_key = self.cache.encoded_key(encoded)
+            result = self.cache.get(encoded_key)
+            if result is None:
+                content, digest = decode(encoded)
+                key = self.cache.digest_key(digest)
+                result = self.cache.get(key)
+                if result is None:
+                    pending.append(content)
+                    names.append(filename)
+                    keys.append((key, encoded_key))
+                    continue
+                if hasattr(content, 'close'):
+                    content.close()
+                self.cache.put(encoded_key, result)
+            cached.append({'filename': filename, **result})
+        return self.submit(pending, names, keys, cached)
+
+    def evaluate(self, job_id:str, filename:str, key:str, decoding):
+        """Send the decoded file to the inference service."""
+        try:
+            inputs, metadata = decoding.result()
+        except Exception as e:
+            self.update(job_id, {'filename': filename, 'error': str(e)})
+            return
+        prediction = self.service.enqueue(inputs, metadata, filename)
+        prediction.add_done_callback(lambda future: self.finish(job_id, filename, key, future))
+
+    def finish(self, job_id:str, filename:str, key:str, prediction, fp=None):
+        """Add the prediction of the file to the job and the cache."""
+        if fp is not None:
+            fp.close()
+        try:
+            result = prediction.result()
+        except Exception as e:
+            result = {'filename': filename, 'error': str(e)}
+        else:
+            if self.cache is not None and key != None:
+                prediction = {k: v for k, v in result.items() if k != 'filename'}
+                for cache_key in (key if isinstance(key, tuple) else (key,)):
+                    self.cache.put(cache_key, prediction)
+        self.update(job_id, result)
+
+    def update(self, job_id:str, result:dict):
+        """Add a result to the job and mark the job as done after the last one."""
+        with self.lock:
+            job = self.store.get(job_id)
+            if job == None:
+                return
+            if result != None:
+                job['results'].append(result)
+                job['done'] += 1
+            if job['done'] >= job['total']:
+                job['status'] = 'done'
+                job['elapsed'] = time.time() - job['started']
+            self.store.set(job_id, job, expire=self.expire)
+
+    def status(self, job_id:str) -> dict:
+        """Get a copy of the job, None when the job is unknown."""
+        with self.lock:
+            job = self.store.get(job_id)
+            if job == None:
+                return None
+            return {**job, 'results': list(job['results'])}
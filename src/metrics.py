@@ -0,0 +1,216 @@
+"""Streaming Metrics for Evaluating Classifiers.
+
+The accumulators are updated batch by batch on the device of the
+predictions and only reduced to the final metrics once the whole
+dataset has been seen, avoiding python loops over the samples and
+synchronizations with the device after every batch.
+"""
+import torch
+
+
+def to_indices(values:torch.Tensor) -> torch.Tensor:
+    """Convert scores or one-hot encoded labels into class indices."""
+    if values.ndim > 1:
+        return values.argmax(dim=1)
+    return values.long()
+
+
+class ConfusionMatrix:
+    """Confusion matrix accumulated across batches.
+
+    The rows of the matrix are the actual classes while the columns
+    are the predicted classes.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of classes.
+    device : torch device
+        The device where the matrix is accumulated.
+
+    Examples
+    --------
+    >>> cm = ConfusionMatrix(2)
+    >>> for images, labels in testloader:
+    ...     cm.update(model(images), labels)
+    >>> cm.compute()['Accuracy']
+    """
+
+    def __init__(self, n_classes:int, device:torch.device=torch.device("cpu")):
+        """Init the Class."""
+        self.n_classes = n_classes
+        self.matrix = torch.zeros(n_classes, n_classes, dtype=torch.int64, device=device)
+
+    def reset(self):
+        """Clear the counts."""
+        self.matrix.zero_()
+
+    def update(self, preds:torch.Tensor, labels:torch.Tensor):
+        """Add a batch of predictions.
+
+        Parameters
+        ----------
+        preds : torch Tensor
+            The predicted scores of shape (n, n_classes) or the
+            predicted class indices of shape (n,).
+        labels : torch Tensor
+            The one-hot encoded labels of shape (n, n_classes) or the
+            class indices of shape (n,).
+
+        Returns
+        -------
+        ConfusionMatrix
+            The updated confusion matrix.
+        """
+        pindices = to_indices(preds).to(self.matrix.device)
+        lindices = to_indices(labels).to(self.matrix.device)
+        counts = torch.bincount(lindices * self.n_classes + pindices, minlength=self.n_classes ** 2)
+        self.matrix += counts.reshape(self.n_classes, self.n_classes)
+        return self
+
+    def compute(self) -> dict:
+        """Calculate the metrics from the accumulated counts.
+
+        Returns
+        -------
+        Dictionary
+            Contains the overall accuracy and the per-class precision,
+            recall, and F1 score. Classes without predictions or
+            samples are given a value of zero.
+        """
+        matrix = self.matrix.double()
+        tp = matrix.diagonal()
+        predicted = matrix.sum(dim=0)
+        actual = matrix.sum(dim=1)
+        precision = tp / predicted.clamp(min=1)
+        recall = tp / actual.clamp(min=1)
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=torch.finfo(torch.float64).eps)
+        metrics = dict()
+        metrics['Accuracy'] = (tp.sum() / matrix.sum().clamp(min=1)).item()
+        metrics['Precision'] = precision.cpu()
+        metrics['Recall'] = recall.cpu()
+        metrics['F1 Score'] = f1.cpu()
+        metrics['Support'] = actual.long().cpu()
+        return metrics
+
+
+class AUROC:
+    """One-vs-rest area under the ROC curve accumulated across batches.
+
+    The scores are counted within histograms of fixed width bins for
+    the positive and negative samples of every class, so the memory
+    used does not grow with the size of the dataset. The area is exact
+    up to the width of the bins. Batches with scores outside of [0, 1]
+    are taken to be logits and converted by a softmax.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of classes.
+    n_bins : int
+        Number of bins dividing the scores between 0 and 1.
+    device : torch device
+        The device where the histograms are accumulated.
+    """
+
+    def __init__(self, n_classes:int, n_bins:int=1000, device:torch.device=torch.device("cpu")):
+        """Init the Class."""
+        self.n_classes = n_classes
+        self.n_bins = n_bins
+        self.positives = torch.zeros(n_classes, n_bins, dtype=torch.int64, device=device)
+        self.negatives = torch.zeros(n_classes, n_bins, dtype=torch.int64, device=device)
+
+    def reset(self):
+        """Clear the histograms."""
+        self.positives.zero_()
+        self.negatives.zero_()
+
+    def update(self, scores:torch.Tensor, labels:torch.Tensor):
+        """Add a batch of predicted probabilities.
+
+        Parameters
+        ----------
+        scores : torch Tensor
+            The predicted probabilities or logits of shape
+            (n, n_classes).
+        labels : torch Tensor
+            The one-hot encoded labels of shape (n, n_classes) or the
+            class indices of shape (n,).
+
+        Returns
+        -------
+        AUROC
+            The updated accumulator.
+        """
+        device = self.positives.device
+        scores = scores.detach().to(device, torch.float32)
+        # Selected on the device to avoid a synchronization per batch.
+        logits = (scores.amin() < 0) | (scores.amax() > 1)
+        scores = torch.where(logits, torch.softmax(scores, dim=1), scores)
+        lindices = to_indices(labels).to(device)
+        bins = (scores.clamp(0, 1) * self.n_bins).long().clamp(max=self.n_bins - 1)
+        bins = bins + torch.arange(self.n_classes, device=device) * self.n_bins
+        positive = torch.nn.functional.one_hot(lindices, self.n_classes).bool()
+        size = self.n_classes * self.n_bins
+        self.positives += torch.bincount(bins[positive], minlength=size).reshape(self.n_classes, self.n_bins)
+        self.negatives += torch.bincount(bins[~positive], minlength=size).reshape(self.n_classes, self.n_bins)
+        return self
+
+    def compute(self) -> torch.Tensor:
+        """Calculate the area under the curve of every class.
+
+        Returns
+        -------
+        torch Tensor
+            The area of every class, nan for classes without positive
+            or negative samples.
+        """
+        # Sweep the threshold from the highest to the lowest score.
+        tps = self.positives.flip(1).cumsum(1).double()
+        fps = self.negatives.flip(1).cumsum(1).double()
+        zeros = torch.zeros(self.n_classes, 1, dtype=torch.float64, device=tps.device)
+        tpr = torch.cat([zeros, tps], dim=1) / tps[:, -1:]
+        fpr = torch.cat([zeros, fps], dim=1) / fps[:, -1:]
+        return torch.trapezoid(tpr, fpr, dim=1).cpu()
+
+
+class ClassificationMetrics:
+    """Confusion matrix and AUROC of a classifier accumulated together.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of classes.
+    device : torch device
+        The device where the metrics are accumulated.
+    n_bins : int
+        Number of bins used by the AUROC.
+    activation : Callable
+        Optional function converting the outputs of the model into
+        probabilities, such as a softmax for models returning logits.
+    """
+
+    def __init__(self, n_classes:int, device:torch.device=torch.device("cpu"), n_bins:int=1000, activation=None):
+        """Init the Class."""
+        self.confusion_matrix = ConfusionMatrix(n_classes, device)
+        self.auroc = AUROC(n_classes, n_bins, device)
+        self.activation = activation
+
+    def reset(self):
+        """Clear the accumulated metrics."""
+        self.confusion_matrix.reset()
+        self.auroc.reset()
+
+    def update(self, outputs:torch.Tensor, labels:torch.Tensor):
+        """Add a batch of predicted probabilities or logits of shape (n, n_classes)."""
+        if self.activation != None:
+            outputs = self.activation(outputs)
+        self.confusion_matrix.update(outputs, labels)
+        self.auroc.update(outputs, labels)
+        return self
+
+    def compute(self) -> dict:
+        """Calculate the metrics of the confusion matrix together with the AUROC."""
+        metrics = self.confusion_matrix.compute()
+        metrics['AUROC'] = self.auroc.compute()
+        return metrics
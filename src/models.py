@@ -157,9 +157,14 @@ class AlexNet(nn.Module):
         The number of classes at output.
     n_channels : int
         The number of channels of the image.
+    pool_size : int
+        The height and width the features are averaged to before the
+        linear layers, so that any image resolution can be used. The
+        features of 512 x 512 images are flattened as they are when
+        stated to be None.
     """
 
-    def __init__(self, n_channels:int=1, n_classes:int=2):
+    def __init__(self, n_channels:int=1, n_classes:int=2, pool_size:int=None):
         """Init the Class."""
         super(AlexNet, self).__init__()
         self.n_classes = n_classes
@@ -187,10 +192,11 @@ class AlexNet(nn.Module):
                 nn.ReLU(),
                 nn.MaxPool2d(kernel_size=3, stride=2)
                 )
+        self.avgpool = nn.AdaptiveAvgPool2d(pool_size) if pool_size != None else nn.Identity()
         self.flatten = nn.Flatten()
         self.fc1 = nn.Sequential(
                 nn.Dropout(0.5),
-                nn.Linear(50_176, 4096),
+                nn.Linear(256 * pool_size ** 2 if pool_size != None else 50_176, 4096),
                 nn.ReLU()
                 )
         self.fc2 = nn.Sequential(
@@ -209,6 +215,7 @@ class AlexNet(nn.Module):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
+        x = self.avgpool(x)
         x = self.flatten(x)
         x = self.fc1(x)
         x = self.fc2(x)
@@ -309,9 +316,18 @@ class TumorClassifier(nn.Module):
     scan in conjunction with categorical data contained within
     the dicom file.
 
+    Parameters
+    ----------
+    cat_input_length : int
+        The number of categorical features.
+    pool_size : int
+        The height and width the image features are averaged to before
+        the linear layers, so that any image resolution can be used.
+        The features of 512 x 512 images are flattened as they are
+        when stated to be None.
     """
 
-    def __init__(self, cat_input_length:int):
+    def __init__(self, cat_input_length:int, pool_size:int=None):
         """Initialize the Module."""
         super(TumorClassifier, self).__init__()
         self.conv1 = nn.Conv2d(1, 64, kernel_size=3, stride=2)
@@ -323,8 +339,9 @@ class TumorClassifier(nn.Module):
         self.conv3 = nn.Conv2d(256, 384, kernel_size=3)
         self.conv4 = nn.Conv2d(384, 256, kernel_size=3)
         self.mp3 = nn.MaxPool2d(kernel_size=(3, 3), stride=2)
+        self.avgpool = nn.AdaptiveAvgPool2d(pool_size) if pool_size != None else nn.Identity()
         self.flatten = nn.Flatten()
-        self.linear1 = nn.Linear(43264, 4096)
+        self.linear1 = nn.Linear(256 * pool_size ** 2 if pool_size != None else 43264, 4096)
         self.dropout = nn.Dropout(0.25)
         self.linear2 = nn.Linear(4096, 1000)
         self.linear3 = nn.Linear(1000, 500)
@@ -352,6 +369,7 @@ class TumorClassifier(nn.Module):
         x1 = self.conv3(x1)
         x1 = self.conv4(x1)
         x1 = self.mp3(x1)
+        x1 = self.avgpool(x1)
         x1 = self.flatten(x1)
         x1 = self.linear1(x1)
         x1 = self.dropout(x1)
@@ -378,17 +396,23 @@ class TutorialNet(nn.Module):
         The number of channels for input.
     n_classes : int
         The number of classes.
+    pool_size : int
+        The height and width the features are averaged to before the
+        linear layers, so that any image resolution can be used. The
+        features of 512 x 512 images are flattened as they are when
+        stated to be None.
     """
 
-    def __init__(self, in_channels:int=1, n_classes:int=2):
+    def __init__(self, in_channels:int=1, n_classes:int=2, pool_size:int=None):
         """Init the Class."""
         super(TutorialNet, self).__init__()
         self.conv1 = nn.Conv2d(3, 6, kernel_size=5)
         self.relu = nn.ReLU()
         self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
         self.conv2 = nn.Conv2d(6, 16, kernel_size=5)
+        self.avgpool = nn.AdaptiveAvgPool2d(pool_size) if pool_size != None else nn.Identity()
         self.flatten = nn.Flatten()
-        self.fc1 = nn.Linear(250_000, 120) # 7744
+        self.fc1 = nn.Linear(16 * pool_size ** 2 if pool_size != None else 250_000, 120) # 7744
         self.fc2 = nn.Linear(120, 84)
         self.fc3 = nn.Linear(84,n_classes)
 
@@ -400,6 +424,7 @@ class TutorialNet(nn.Module):
         x = self.conv2(x)
         x = self.relu(x)
         x = self.pool(x)
+        x = self.avgpool(x)
         x = self.flatten(x)
         x = self.fc1(x)
         x = self.relu(x)
@@ -10,6 +10,7 @@ Archive.
 import os
 import pathlib
 import json
+import argparse
 from typing import Optional
 import re
 import time
@@ -27,9 +28,11 @@ from torchvision import datasets, transforms
 
 from models import CustomCNN, AlexNet, InceptionStem, InceptionA, InceptionB, InceptionC, ReductionA, ReductionB, InceptionV4, TutorialNet
 from datasets import DICOMSet
-from trainers import Trainer, VERSION
-from utils import create_target_transform, STANDARD_IMAGE_TRANSFORMS
-from stats import calculate_image_t_test
+from trainers import Trainer, ClassTrainer, VERSION, launch, distributed_loader
+from utils import create_target_transform, STANDARD_IMAGE_TRANSFORMS, NORMALIZATION_FILENAME
+from stats import calculate_image_t_test, compute_normalization_stats
+from resources import ResourcePlan
+from checkpoints import Checkpointer
 
 img_size = (512, 512)
 torch.manual_seed(42)
@@ -49,13 +52,13 @@ def _main():
     train_size = int(0.7*len(img_set))
     val_size = len(img_set) - train_size
     train_set, val_set = data.random_split(img_set, [train_size, val_size])
-    dets = [torch.mean(image) for image, label in train_set]
-    img_mean = torch.mean(torch.Tensor(dets))
-    img_std = torch.std(torch.Tensor(dets))
-    print("mean: {}\nStandard Deviation: {}".format(img_mean, img_std))
+    # The split is seeded, so the statistics of the training set are cached.
+    norm_stats = compute_normalization_stats(train_set, os.path.join(dir_train, NORMALIZATION_FILENAME))
+    print("mean: {}\nStandard Deviation: {}".format(norm_stats['mean'], norm_stats['std']))
     exit()
-    train_loader = data.DataLoader(train_set, batch_size=64, shuffle=True, num_workers=4)
-    val_loader = data.DataLoader(val_set, batch_size=64, shuffle=True, num_workers=4)
+    plan = ResourcePlan()
+    train_loader = data.DataLoader(train_set, batch_size=64, shuffle=True, **plan.loader_kwargs())
+    val_loader = data.DataLoader(val_set, batch_size=64, shuffle=True, **plan.loader_kwargs())
     #Loading the models
     model1 = InceptionV4(2, 1)
     #Loading optimizers
@@ -63,8 +66,10 @@ def _main():
     #Loading the Losses
     loss1 = nn.BCELoss()
     #Loading the Trainers
-    trainer1 = Trainer(model1, opt1, loss1)
+    checkpointer = Checkpointer("models/checkpoints/inceptionv4_catloaf", every_minutes=15, keep_last=3)
+    trainer1 = Trainer(model1, opt1, loss1, resources=plan, checkpointer=checkpointer)
     # Training and saving models
+    trainer1.resume()
     trainer1.train(train_loader, 160, gpu=True)
 
     trained_model1 = trainer1.get_model()
@@ -72,5 +77,30 @@ def _main():
     torch.save(trained_model1.state_dict(), "models/inceptionv4_catloaf.pt")
 
 
+def _train_distributed(rank:int, world_size:int, dir_train:str, epochs:int, checkpoint_dir:str):
+    """Train the classifier within one process of a data-parallel run."""
+    cat_trans = create_target_transform(2)
+    img_set = datasets.ImageFolder(root=dir_train, transform=STANDARD_IMAGE_TRANSFORMS, target_transform=cat_trans)
+    # The processes share the machine, so the workers are left unpinned.
+    plan = ResourcePlan(num_workers=2, compute_threads=max((os.cpu_count() or 1) // (2 * world_size), 1), pin_workers=False)
+    train_loader = distributed_loader(img_set, batch_size=64, **plan.loader_kwargs())
+    model = InceptionV4(2, 1)
+    opt = optim.Adam(model.parameters(), lr=0.003)
+    checkpointer = Checkpointer(checkpoint_dir, every_minutes=15, keep_last=3)
+    trainer = ClassTrainer(model, opt, nn.BCELoss(), resources=plan, checkpointer=checkpointer)
+    trainer.resume()
+    trainer.train(train_loader, epochs)
+    trainer.save_model("models/inceptionv4_catloaf.pt")
+
+
 if __name__ == "__main__":
-    _main()
+    parser = argparse.ArgumentParser(description="Train the image classifier.")
+    parser.add_argument('--world-size', type=int, default=1, help="number of local training processes.")
+    parser.add_argument('--data', default="data/images/", help="folder containing the training images.")
+    parser.add_argument('--epochs', type=int, default=160, help="number of training epochs.")
+    parser.add_argument('--checkpoint-dir', default="models/checkpoints/inceptionv4_catloaf", help="folder where the checkpoints are written.")
+    args = parser.parse_args()
+    if args.world_size > 1:
+        launch(_train_distributed, args.world_size, args.data, args.epochs, args.checkpoint_dir)
+    else:
+        _main()
@@ -0,0 +1,175 @@
+"""Post-Training Static Quantization for CPU Inference.
+
+Converts the trained models of models.py into int8 models with FX graph
+mode quantization. The model is traced into a graph, where adjacent
+convolutions, BatchNorms, and ReLUs are fused, and observers are added
+that record the range of the activations while a sample of the training
+or validation loader is passed through it. The observed ranges determine
+the scales of the quantized activations. Most of the parameters of
+AlexNet and the TumorClassifier are within their first linear layer,
+which is reduced to a quarter of its size together with its memory
+traffic.
+
+The quantized models are saved as TorchScript artifacts through
+`export_model` and compared with the original model by
+`evaluate_quantization`, which reports the change in accuracy next to
+the latency and the size of both models.
+
+Example
+-------
+>>> quantized = quantize_model(model, trainloader, n_batches=16)
+>>> save_quantized(quantized, "AlexNet", example_inputs(model), "models/")
+>>> evaluate_quantization(model, quantized, testloader, classes)
+"""
+import io
+import copy
+import time
+
+import torch
+from torch import nn
+from torch.utils import data
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from trainers import ClassTrainer
+from export import export_model
+
+
+def quantization_backend() -> str:
+    """Select the quantized engine of this cpu, x86 when supported and otherwise fbgemm or qnnpack."""
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in torch.backends.quantized.supported_engines:
+            return backend
+    raise RuntimeError("No quantized engine is supported by this build of pytorch.")
+
+def batch_inputs(batch) -> tuple:
+    """Take the model inputs from a batch of a DICOMSet or ImageFolder loader, which are followed by the labels."""
+    return (batch[0],)
+
+def quantize_model(model:nn.Module, loader:data.DataLoader, n_batches:int=10, backend:str=None, to_inputs=batch_inputs) -> nn.Module:
+    """Quantize a copy of the model after calibrating it on the loader.
+
+    Parameters
+    ----------
+    model : torch Module
+        The trained model, such as AlexNet or TumorClassifier.
+    loader : pytorch DataLoader
+        The batches used to observe the range of the activations,
+        usually a sample of the training data.
+    n_batches : int
+        Number of batches of the loader used for the calibration.
+    backend : str
+        The quantized engine, defaults to `quantization_backend`.
+    to_inputs : Callable
+        Converts a batch of the loader into the tuple of model inputs,
+        such as the images and categorical data of the
+        TumorClassifier.
+
+    Returns
+    -------
+    torch GraphModule
+        The quantized model, run on the cpu.
+    """
+    assert n_batches > 0, "At least one batch is required for the calibration."
+    if backend == None:
+        backend = quantization_backend()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), to_inputs(next(iter(loader))))
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if i >= n_batches:
+                break
+            prepared(*to_inputs(batch))
+    return convert_fx(prepared)
+
+def save_quantized(model:nn.Module, name:str, inputs:tuple, root:str="models", version:int=None) -> str:
+    """Save the quantized model as a TorchScript artifact.
+
+    Parameters
+    ----------
+    model : torch GraphModule
+        The model returned by `quantize_model`.
+    name : str
+        The name of the original model, such as AlexNet, the artifact
+        is named after it followed by int8.
+    inputs : tuple
+        Example inputs used to trace the model.
+    root : str
+        Folder where the artifact is written.
+    version : int
+        The version of the model, defaults to the one within
+        model_version.txt.
+
+    Returns
+    -------
+    str
+        Path to the artifact, which is loaded by `load_exported`.
+    """
+    return export_model(model, root, ('torchscript',), inputs=inputs, version=version, name="{}_int8".format(name), fuse=False)['torchscript']
+
+def model_size(model:nn.Module) -> int:
+    """Calculate the number of bytes of the serialized parameters and buffers of the model."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def measure_latency(model:nn.Module, inputs:tuple, n_batches:int=5) -> float:
+    """Measure the milliseconds per batch of the model on the cpu."""
+    with torch.inference_mode():
+        model(*inputs)
+        start = time.perf_counter()
+        for _ in range(n_batches):
+            model(*inputs)
+    return 1000 * (time.perf_counter() - start) / n_batches
+
+def evaluate_quantization(model:nn.Module, quantized:nn.Module, testloader:data.DataLoader, classes:tuple, n_batches:int=5, version:int=0, to_inputs=batch_inputs) -> dict:
+    """Compare the quantized model with the original model.
+
+    The accuracy of both models is calculated by `ClassTrainer.test`
+    on the cpu, while the latency is measured on the first batch of
+    the loader.
+
+    Parameters
+    ----------
+    model : torch Module
+        The original model.
+    quantized : torch Module
+        The model returned by `quantize_model`.
+    testloader : pytorch DataLoader
+        Dataset that was never seen by the model.
+    classes : tuple
+        An immutable list of classes from the dataset.
+    n_batches : int
+        Number of batches used to measure the latency.
+    version : int
+        The version of the model added to the result files.
+    to_inputs : Callable
+        Converts a batch of the loader into the tuple of model inputs,
+        as for `quantize_model`. The labels are the last item of the
+        batch.
+
+    Returns
+    -------
+    Dictionary
+        The accuracy, milliseconds per batch, and bytes of both models
+        together with the change in accuracy and the speedup.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    inputs = to_inputs(next(iter(testloader)))
+    results = dict()
+    for variant, candidate in (('fp32', model), ('int8', quantized)):
+        metrics = ClassTrainer.test(candidate, testloader, classes, gpu=False, version=version, to_inputs=to_inputs)
+        results[variant] = {
+                'Accuracy': metrics['Accuracy'],
+                'Latency': measure_latency(candidate, inputs, n_batches),
+                'Size': model_size(candidate),
+                }
+    results['Accuracy Delta'] = results['int8']['Accuracy'] - results['fp32']['Accuracy']
+    results['Speedup'] = results['fp32']['Latency'] / results['int8']['Latency']
+    print("Quantization of {}:".format(model.__class__.__name__))
+    for variant in ('fp32', 'int8'):
+        result = results[variant]
+        print(f'  {variant}  accuracy: {100 * result["Accuracy"]:.1f}%  latency: {result["Latency"]:8.1f} ms/batch  size: {result["Size"] / 2 ** 20:8.1f} MiB')
+    print(f'  accuracy delta: {100 * results["Accuracy Delta"]:+.1f}%  speedup: {results["Speedup"]:.2f}x')
+    return results
@@ -0,0 +1,155 @@
+"""Planning of the CPU Resources Used for Training.
+
+Splits the cores available to the process between the compute threads
+of pytorch and the DataLoader workers so that the two do not compete
+for the same cores. The DataLoader workers are pinned to their own
+cores, spread across the NUMA nodes of the machine.
+"""
+import os
+import glob
+
+import torch
+
+
+def available_cores() -> list[int]:
+    """Get the ids of the cores the process is allowed to run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def parse_cpu_list(text:str) -> list[int]:
+    """Parse a list of cpus, such as '0-3,8-11', into their ids."""
+    cpus = list()
+    for part in text.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def numa_nodes() -> list[list[int]]:
+    """Get the cores available to the process grouped by NUMA node.
+
+    Machines that do not expose their NUMA topology are treated as a
+    single node.
+    """
+    cores = set(available_cores())
+    nodes = list()
+    for filename in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        with open(filename, 'r') as fp:
+            node = [cpu for cpu in parse_cpu_list(fp.read()) if cpu in cores]
+            fp.close()
+        if node:
+            nodes.append(node)
+    if not nodes:
+        nodes = [sorted(cores)]
+    return nodes
+
+
+class ResourcePlan:
+    """Split of the cores between compute threads and DataLoader workers.
+
+    The compute threads keep the first cores of every NUMA node while
+    the DataLoader workers take the last ones, each worker is pinned
+    to a single core in a round robin across the nodes.
+
+    Parameters
+    ----------
+    num_workers : int
+        Number of DataLoader workers. Defaults to a quarter of the
+        cores, with at least one worker when two or more cores are
+        available.
+    compute_threads : int
+        Number of intra-op threads. Defaults to the cores that are not
+        used by the workers.
+    interop_threads : int
+        Number of inter-op threads.
+    pin_workers : bool
+        Determines whether each worker is pinned to its cores.
+
+    Examples
+    --------
+    >>> plan = ResourcePlan()
+    >>> train_loader = data.DataLoader(train_set, batch_size=64, shuffle=True, **plan.loader_kwargs())
+    >>> trainer = ClassTrainer(model, opt, loss, resources=plan)
+
+    The plan may also be applied for a block only, after which the
+    affinity and the number of threads of the process are restored.
+
+    >>> with plan:
+    ...     train(model, train_loader)
+    """
+
+    def __init__(self, num_workers:int=None, compute_threads:int=None, interop_threads:int=1, pin_workers:bool=True):
+        """Init the Class."""
+        self.nodes = numa_nodes()
+        cores = [cpu for node in self.nodes for cpu in node]
+        if num_workers == None:
+            num_workers = max(len(cores) // 4, 1) if len(cores) >= 2 else 0
+        assert num_workers >= 0, "The number of workers cannot be negative."
+        self.num_workers = num_workers
+        # Take the worker cores from the end of each node in turn.
+        remaining = [list(node) for node in self.nodes]
+        self.worker_cores = list()
+        node = 0
+        while len(self.worker_cores) < min(num_workers, len(cores) - 1):
+            if remaining[node % len(remaining)]:
+                self.worker_cores.append(remaining[node % len(remaining)].pop())
+            node += 1
+        self.compute_cores = sorted(cpu for node in remaining for cpu in node)
+        if compute_threads == None:
+            compute_threads = max(len(self.compute_cores), 1)
+        self.compute_threads = compute_threads
+        self.interop_threads = interop_threads
+        self.pin_workers = pin_workers and bool(self.worker_cores) and hasattr(os, 'sched_setaffinity')
+        self.restore = list()
+
+    def __repr__(self):
+        """Describe the plan."""
+        return "ResourcePlan(numa_nodes={}, compute_threads={}, interop_threads={}, num_workers={}, worker_cores={})".format(
+                len(self.nodes), self.compute_threads, self.interop_threads, self.num_workers, self.worker_cores)
+
+    def apply(self):
+        """Configure the thread pools of pytorch for the current process.
+
+        When the workers are pinned, the process is pinned to the
+        compute cores so its threads stay off the cores of the workers.
+        """
+        if self.pin_workers:
+            os.sched_setaffinity(0, self.compute_cores)
+        torch.set_num_threads(self.compute_threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # The inter-op pool can only be sized before it is first used.
+            pass
+
+    def __enter__(self):
+        """Apply the plan, saving the affinity and threads it replaces."""
+        affinity = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+        self.restore.append((affinity, torch.get_num_threads()))
+        self.apply()
+        return self
+
+    def __exit__(self, *args):
+        """Restore the affinity and threads, the inter-op pool keeps its size."""
+        affinity, threads = self.restore.pop()
+        if affinity is not None and self.pin_workers:
+            os.sched_setaffinity(0, affinity)
+        torch.set_num_threads(threads)
+
+    def worker_init_fn(self, worker_id:int):
+        """Pin the DataLoader worker to its core and limit its threads."""
+        torch.set_num_threads(1)
+        if self.pin_workers:
+            os.sched_setaffinity(0, {self.worker_cores[worker_id % len(self.worker_cores)]})
+
+    def loader_kwargs(self) -> dict:
+        """Get the DataLoader arguments that follow the plan."""
+        kwargs = {'num_workers': self.num_workers}
+        if self.num_workers > 0:
+            kwargs.update({'worker_init_fn': self.worker_init_fn, 'persistent_workers': True})
+        return kwargs
@@ -1,30 +1,41 @@
 """Useful Functions for Statistical Analysis."""
+import os
+import re
+import json
 import math
+import hashlib
 
+import numpy as np
 import torch
 from torch.utils import data
 import polars as pl
 import scipy
 
-def calculate_confusion_matrix(fin_predictions:pl.DataFrame):
-    """Calculate the confusion matrix using pandas.
+from metrics import ConfusionMatrix, to_indices
+from utils import normalization_file
 
-    Calculates the confusion matrix using a csv file that
-    contains both the predictions and actual labels. This
-    function then creates a crosstab of the data to develop
-    the confusion matrix.
+def calculate_confusion_matrix(fin_predictions:pl.DataFrame, positive=None):
+    """Calculate the confusion matrix of a table of predictions.
+
+    Uses a DataFrame that contains both the predictions and actual
+    labels. The classes are mapped to indices and counted within a
+    ConfusionMatrix, from which the metrics are derived.
 
     Parameters
     ----------
-    fin_predictions : Pandas DataFrame
-        DataFrame containing the prediction and actual
-        labels.
+    fin_predictions : Polars DataFrame
+        DataFrame containing the prediction and actual labels within
+        the columns `predictions` and `classification`.
+    positive
+        The positive class whose metrics are reported. Defaults to
+        the second class in sorted order for two classes, while the
+        metrics are averaged across the classes otherwise.
 
     Returns
     -------
     Polars DataFrame
-        Cross tab containing the confusion matrix of the
-        predictions compared to the actual labels.
+        Cross tab containing the confusion matrix of the actual
+        labels (rows) compared to the predictions (columns).
 
     Dictionary
         Contains the basic metrics obtained from the
@@ -34,58 +45,270 @@ def calculate_confusion_matrix(fin_predictions:pl.DataFrame):
         - Recall
         - F1 Score
     """
-    ct = fin_predictions.pivot(values="predictions", index="classification", columns="classification", aggregate_function='count')
-    # Set the initial values
-    tp = ct.values[1][1]
-    tn = ct.values[0][0]
-    fn = ct.values[0][1]
-    fp = ct.values[1][0]
+    actual = fin_predictions['classification']
+    predicted = fin_predictions['predictions']
+    classes = sorted(set(actual.unique().to_list()) | set(predicted.unique().to_list()))
+    class_to_idx = {c: i for i, c in enumerate(classes)}
+    lindices = torch.tensor(actual.replace_strict(class_to_idx, return_dtype=pl.Int64).to_numpy())
+    pindices = torch.tensor(predicted.replace_strict(class_to_idx, return_dtype=pl.Int64).to_numpy())
+    cm = ConfusionMatrix(len(classes)).update(pindices, lindices)
+    ct = pl.DataFrame({'classification': classes}).hstack(
+            pl.DataFrame(cm.matrix.numpy(), schema=[str(c) for c in classes]))
     # Calculate the metrics
-    metrics = dict()
-    metrics['Accuracy'] = (tp + tn) / (tp + tn + fp + fn) # Ability of model to get the correct predictions
-    metrics['Precision'] = tp / (tp + fp) # Ability of model to label actual positives as positives (think retrospectively)
-    metrics['Recall'] = tp / (tp + fn) # Ability of model to correctly identify positives
-    metrics['F1 Score'] = (2 * metrics['Precision'] * metrics['Recall']) / (metrics['Precision'] + metrics['Recall'])
+    results = cm.compute()
+    if positive == None and len(classes) == 2:
+        positive = classes[1]
+    metrics = {'Accuracy': results['Accuracy']}
+    for name in ('Precision', 'Recall', 'F1 Score'):
+        if positive != None:
+            metrics[name] = results[name][class_to_idx[positive]].item()
+        else:
+            metrics[name] = results[name].mean().item()
     return ct, metrics
 
-def calculate_image_t_test(dataset:data.Dataset, labels:dict, ci:int=0.95): #two sample t-test of unequal variance; Requires Correction of Degrees of Freedom
-    """Calculate the t-test for comparing two samples of data with unequal variance."""
+class RunningStats:
+    """Per-class count, mean, and variance accumulated in a single pass.
+
+    Each batch is reduced to its per-class count, mean, and sum of
+    squared deviations, which are merged into the running values with
+    the parallel form of Welford's algorithm, so the values never need
+    to be stored and the variance does not suffer from cancellation.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of classes.
+    """
+
+    def __init__(self, n_classes:int):
+        """Init the Class."""
+        self.n_classes = n_classes
+        self.count = torch.zeros(n_classes, dtype=torch.float64)
+        self.mean = torch.zeros(n_classes, dtype=torch.float64)
+        self.m2 = torch.zeros(n_classes, dtype=torch.float64)
+
+    def update(self, values:torch.Tensor, labels:torch.Tensor):
+        """Add a batch of values of shape (n,) with their class indices."""
+        values = values.detach().to('cpu', torch.float64)
+        labels = to_indices(labels).cpu()
+        count = torch.bincount(labels, minlength=self.n_classes).double()
+        mean = torch.bincount(labels, weights=values, minlength=self.n_classes) / count.clamp(min=1)
+        m2 = torch.bincount(labels, weights=(values - mean[labels]) ** 2, minlength=self.n_classes)
+        return self.merge(count, mean, m2)
+
+    def merge(self, count:torch.Tensor, mean:torch.Tensor, m2:torch.Tensor):
+        """Merge the per-class count, mean, and sum of squared deviations of a batch."""
+        count, mean, m2 = (t.to('cpu', torch.float64) for t in (count, mean, m2))
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total.clamp(min=1)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total.clamp(min=1)
+        self.count = total
+        return self
+
+    def variance(self) -> torch.Tensor:
+        """Calculate the sample variance of every class."""
+        return self.m2 / (self.count - 1)
+
+    def std(self) -> torch.Tensor:
+        """Calculate the sample standard deviation of every class."""
+        return torch.sqrt(self.variance())
+
+
+def welch_t_test(mean1:float, var1:float, n1:int, mean2:float, var2:float, n2:int) -> tuple:
+    """Calculate the two sample t-test of unequal variance from summary statistics.
+
+    Returns
+    -------
+    tuple
+        The t score, the Welch-Satterthwaite degrees of freedom, and
+        the two-sided p value.
+    """
+    se1 = var1 / n1
+    se2 = var2 / n2
+    t_value = (mean1 - mean2) / math.sqrt(se1 + se2)
+    df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    p_value = float(2 * scipy.stats.t.sf(abs(t_value), df))
+    return t_value, df, p_value
+
+def calculate_image_t_test(dataset:data.Dataset, labels:dict, ci:float=0.95, batch_size:int=64, num_workers:int=0):
+    """Calculate the t-test for comparing the mean intensity of two classes of images.
+
+    The mean intensity of every image is accumulated per class within
+    a single pass through the dataset, from which the two sample t-test
+    of unequal variance is calculated.
+
+    Parameters
+    ----------
+    dataset : torch Dataset
+        Dataset returning the images together with their class index
+        or one-hot encoded label.
+    labels : dict
+        Maps the name of the two compared classes to their index.
+        Images of any other class are ignored.
+    ci : float
+        The confidence level of the test.
+    batch_size : int
+        Number of images loaded at once.
+    num_workers : int
+        Number of processes loading the images.
+
+    Returns
+    -------
+    Dictionary
+        The per-class means, standard deviations, variances, and
+        counts together with the t score, critical t value, degrees of
+        freedom, p value, and significance of the difference.
+    """
     assert ci > 0.0 and ci < 1.0, "the parameter `ci` must fall between 0 and 1.\nCurrent value: {}".format(ci)
-    means = dict()
-    standard_deviations = dict()
-    variances = dict()
-    counts = dict()
-    for k,v in labels.items():
-        count = 0
-        means.update({k:torch.mean(torch.Tensor([torch.mean(X) for X,y in dataset if int(y.argmax().item()) == v]))})
-        standard_deviations.update({k:torch.std(torch.Tensor([torch.mean(X) for X,y in dataset if int(y.argmax().item()) == v]))})
-        variances.update({k:torch.var(torch.Tensor([torch.mean(X) for X,y in dataset if int(y.argmax().item()) == v]))})
-        for _,y in dataset:
-            if y.argmax().item() == v:
-                count+=1
-        counts.update({k:count})
+    assert len(labels) == 2, "Exactly two classes are compared by the t-test."
+    names = list(labels.keys())
+    compared = torch.tensor([labels[k] for k in names])
+    # Images of the other classes are skipped, the compared classes are
+    # accumulated at the positions of their names.
+    stats = RunningStats(2)
+    loader = data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    for X, y in loader:
+        matches = to_indices(y).unsqueeze(1) == compared
+        keep = matches.any(dim=1)
+        stats.update(X.flatten(start_dim=1).mean(dim=1)[keep], matches[keep].long().argmax(dim=1))
+    means = {k: stats.mean[i].item() for i, k in enumerate(names)}
+    standard_deviations = {k: stats.std()[i].item() for i, k in enumerate(names)}
+    variances = {k: stats.variance()[i].item() for i, k in enumerate(names)}
+    counts = {k: int(stats.count[i].item()) for i, k in enumerate(names)}
     base_stats = {'means':means, 'stds':standard_deviations, 'variances':variances, 'counts':counts}
-    m1 = means['cat']
-    m2 = means['loaf']
-    std1 = standard_deviations['cat']
-    std2 = standard_deviations['loaf']
-    var1 = variances['cat']
-    var2 = variances['loaf']
-    n1 = counts['cat']
-    n2 = counts['loaf']
-    t_score = (m1-m2)/ torch.sqrt((var1/n1) + (var2/n2))
-    df_numerator = torch.square((torch.square(var1)/n1) + (torch.square(var2)/n2))
-    df_denominator = (torch.square(torch.square(var1)) / ((n1**2)*(n1-1))) + (torch.square(torch.square(var2)) / ((n2**2)*(n2-1)))
-    df = math.ceil(df_numerator / df_denominator)
-    t = scipy.stats.t.ppf(ci, df)
-    base_stats.update({'t value':t_value, 't':t, 'degrees of freedom':df})
-    if t_value < t:
-        base_stats.update({'significance':True})
-    else:
-        base_stats.update({'significance':False})
+    n1, n2 = (counts[k] for k in names)
+    assert n1 > 1 and n2 > 1, "Each class requires at least two images.\nCurrent counts: {}".format(counts)
+    t_value, df, p_value = welch_t_test(means[names[0]], variances[names[0]], n1, means[names[1]], variances[names[1]], n2)
+    t = float(scipy.stats.t.ppf(1 - (1 - ci) / 2, df))
+    base_stats.update({'t value':t_value, 't':t, 'degrees of freedom':df, 'p value':p_value})
+    base_stats.update({'significance':bool(p_value < 1 - ci)})
     print(base_stats)
     return base_stats
 
+def dataset_signature(dataset:data.Dataset) -> dict:
+    """Describe the samples and transforms of a dataset.
+
+    Used to find statistics that were saved for another split, image
+    size, or transform of the same dataset. Subsets and wrapped
+    datasets are described together with the datasets they wrap.
+
+    Returns
+    -------
+    Dictionary
+        The representation of the transforms, the shape of the first
+        image, and a digest of the listed samples.
+    """
+    digest = hashlib.sha1()
+    transforms = list()
+    wrapped = dataset
+    while wrapped is not None:
+        for name in ('indices', 'paths', 'samples', 'labels', 'shards'):
+            value = getattr(wrapped, name, None)
+            if value is None:
+                continue
+            if torch.is_tensor(value):
+                value = value.cpu().numpy()
+            digest.update(name.encode())
+            # Each sample is hashed on its own, as the listings of large
+            # datasets would make a very long string.
+            for part in (value if isinstance(value, (list, tuple)) else (value,)):
+                if isinstance(part, np.ndarray):
+                    digest.update(np.ascontiguousarray(part).data)
+                else:
+                    digest.update(str(part).encode())
+                digest.update(b'\0')
+        for name in ('transform', 'img_transforms', 'image_transforms'):
+            if getattr(wrapped, name, None) is not None:
+                # Drop the memory addresses found within the representation of functions.
+                transforms.append(re.sub(r' at 0x[0-9a-fA-F]+', '', repr(getattr(wrapped, name))))
+        wrapped = getattr(wrapped, 'dataset', None)
+    sample = next(iter(dataset)) if isinstance(dataset, data.IterableDataset) else dataset[0]
+    image = sample['image'] if isinstance(sample, dict) else sample[0]
+    return {'transforms': transforms, 'shape': list(np.shape(image)), 'samples': digest.hexdigest()}
+
+def compute_normalization_stats(dataset:data.Dataset, filename:str=None, batch_size:int=64, num_workers:int=0, n_bins:int=256, value_range:tuple=(0.0, 1.0), recompute:bool=False) -> dict:
+    """Calculate the per-channel statistics used to normalize the images.
+
+    The mean, standard deviation, minimum, maximum, and histogram of
+    every channel are accumulated within a single batched pass through
+    the dataset and saved as json, by default next to the index of the
+    dataset. The saved statistics are returned instead when they were
+    computed for the same samples, transforms, and image shape, as
+    described by `dataset_signature`.
+
+    Parameters
+    ----------
+    dataset : torch Dataset
+        Dataset returning the transformed images first, or within the
+        key `image` for datasets of dictionaries.
+    filename : str
+        Path of the json file. Defaults to a file next to the index or
+        within the root of the dataset.
+    batch_size : int
+        Number of images loaded at once.
+    num_workers : int
+        Number of processes loading the images.
+    n_bins : int
+        Number of bins of the histograms.
+    value_range : tuple
+        The lowest and highest values covered by the histograms,
+        values outside of the range are counted within the outer bins.
+    recompute : bool
+        Calculate the statistics even when they were saved before.
+
+    Returns
+    -------
+    Dictionary
+        The per-channel mean, std, min, max, and histogram together
+        with the bin edges and the number of images.
+    """
+    if filename == None:
+        filename = normalization_file(dataset)
+    signature = dataset_signature(dataset)
+    if os.path.exists(filename) and not recompute:
+        with open(filename, 'r') as fp:
+            stats = json.load(fp)
+            fp.close()
+        if stats['count'] == len(dataset) and stats.get('signature') == signature:
+            return stats
+    loader = data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    running = None
+    for batch in loader:
+        images = batch['image'] if isinstance(batch, dict) else batch[0]
+        # Gather the pixels of each channel into a row.
+        pixels = images.transpose(0, 1).flatten(start_dim=1).double()
+        if running == None:
+            n_channels = pixels.shape[0]
+            running = RunningStats(n_channels)
+            minimum = torch.full((n_channels,), math.inf, dtype=torch.float64)
+            maximum = torch.full((n_channels,), -math.inf, dtype=torch.float64)
+            histograms = torch.zeros(n_channels, n_bins, dtype=torch.float64)
+        mean = pixels.mean(dim=1)
+        running.merge(torch.full_like(mean, pixels.shape[1]), mean, ((pixels - mean[:, None]) ** 2).sum(dim=1))
+        minimum = torch.minimum(minimum, pixels.min(dim=1).values)
+        maximum = torch.maximum(maximum, pixels.max(dim=1).values)
+        clamped = pixels.clamp(*value_range)
+        for channel in range(n_channels):
+            histograms[channel] += torch.histc(clamped[channel], bins=n_bins, min=value_range[0], max=value_range[1])
+    assert running != None, "The dataset does not contain any images."
+    stats = {
+            'mean': running.mean.tolist(),
+            'std': running.std().tolist(),
+            'min': minimum.tolist(),
+            'max': maximum.tolist(),
+            'histogram': histograms.long().tolist(),
+            'bin_edges': torch.linspace(value_range[0], value_range[1], n_bins + 1).tolist(),
+            'count': len(dataset),
+            'signature': signature,
+            }
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(stats, fp)
+        fp.close()
+    os.replace(tmp, filename)
+    return stats
+
 def calculate_t_score(sample1, sample2):
     """Calculate the t score.
 
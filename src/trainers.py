@@ -1,21 +1,276 @@
 """Set of Classes for Training Machine Learning Models."""
+import os
+import time
+import queue
+import threading
+from contextlib import nullcontext
+
 import torch
 from torch import nn, optim
+from torch import distributed as dist
+from torch import multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils import data
 
+from resources import ResourcePlan
+from checkpoints import Checkpointer, get_rng_state, set_rng_state
+from metrics import ConfusionMatrix, ClassificationMetrics
+
 with open('src/model_version.txt', 'r') as fp:
     VERSION = int(fp.read())
     fp.close()
 
+_END = object()
+
+
+def is_distributed() -> bool:
+    """Check whether the process belongs to an initialized process group."""
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process() -> bool:
+    """Check whether the process is the one that logs and saves files."""
+    return not is_distributed() or dist.get_rank() == 0
+
+def setup_distributed(rank:int, world_size:int, backend:str='gloo', master_addr:str='127.0.0.1', master_port:int=29500):
+    """Join the process group used for data-parallel training.
+
+    Parameters
+    ----------
+    rank : int
+        The rank of the current process.
+    world_size : int
+        The number of processes.
+    backend : str
+        The backend of the process group, gloo runs on the cpu.
+    master_addr : str
+        The address of the process with rank zero.
+    master_port : int
+        The port of the process with rank zero.
+    """
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def cleanup_distributed():
+    """Leave the process group."""
+    if is_distributed():
+        dist.destroy_process_group()
+
+def _run_distributed(rank:int, world_size:int, backend:str, master_port:int, function, args:tuple):
+    """Set up the process group and run the function within a process."""
+    setup_distributed(rank, world_size, backend, master_port=master_port)
+    try:
+        function(rank, world_size, *args)
+    finally:
+        cleanup_distributed()
+
+def launch(function, world_size:int, *args, backend:str='gloo', master_port:int=29500):
+    """Launch data-parallel training within several local processes.
+
+    Each process joins the process group and calls the function with
+    its rank, the world size, and the given arguments. The function
+    must be defined at the top level of a module so that it can be
+    sent to the spawned processes.
+
+    Parameters
+    ----------
+    function : Callable
+        The training function, called as function(rank, world_size, *args).
+    world_size : int
+        The number of processes.
+    backend : str
+        The backend of the process group.
+    master_port : int
+        The port used by the processes to find each other.
+
+    Examples
+    --------
+    >>> def train(rank, world_size, dir_train):
+    ...     img_set = datasets.ImageFolder(root=dir_train, transform=STANDARD_IMAGE_TRANSFORMS)
+    ...     trainer = ClassTrainer(model, opt, loss)
+    ...     trainer.train(distributed_loader(img_set, batch_size=64), 160)
+    >>> launch(train, 4, "data/images/")
+    """
+    mp.spawn(_run_distributed, args=(world_size, backend, master_port, function, args), nprocs=world_size, join=True)
+
+def distributed_loader(dataset:data.Dataset, batch_size:int, shuffle:bool=True, **kwargs) -> data.DataLoader:
+    """Create a DataLoader that gives each process its share of the dataset.
+
+    Uses a DistributedSampler when the process group is initialized,
+    otherwise a regular DataLoader is returned. Streaming datasets are
+    expected to split themselves across the ranks.
+    """
+    if is_distributed() and not isinstance(dataset, data.IterableDataset):
+        sampler = data.DistributedSampler(dataset, shuffle=shuffle)
+        return data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+    if isinstance(dataset, data.IterableDataset):
+        return data.DataLoader(dataset, batch_size=batch_size, **kwargs)
+    return data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+
+def apply_to_tensors(batch, function):
+    """Apply the function to every tensor within a (nested) batch."""
+    if torch.is_tensor(batch):
+        return function(batch)
+    if isinstance(batch, dict):
+        return {key: apply_to_tensors(value, function) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(apply_to_tensors(value, function) for value in batch)
+    return batch
+
+
+class PrefetchLoader:
+    """Wrapper that stages the upcoming batches on a background thread.
+
+    While the model computes on the current batch, a background thread
+    iterates through the wrapped loader and copies the next batches to
+    the device. On a gpu the batches are pinned and copied on a
+    separate stream with non-blocking copies, on the cpu the thread
+    overlaps the collation and transforms with the computation. The
+    time spent waiting for data is reported through `wait_time`.
+
+    Parameters
+    ----------
+    loader : torch DataLoader
+        The loader providing the batches.
+    device : torch device
+        The device where the batches are copied.
+    n_batches : int
+        Number of batches staged ahead of the computation.
+    """
+
+    def __init__(self, loader:data.DataLoader, device:torch.device=torch.device("cpu"), n_batches:int=2):
+        """Initialize the class."""
+        assert n_batches > 0, "The number of prefetched batches must be greater than zero."
+        self.loader = loader
+        self.device = torch.device(device)
+        self.n_batches = n_batches
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.wait_time = 0.0
+
+    def __len__(self):
+        """Get the number of batches of the wrapped loader."""
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        """Get the attributes, such as the dataset, of the wrapped loader."""
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        """Iterate through the batches staged by the background thread."""
+        self.wait_time = 0.0
+        staged = queue.Queue(maxsize=self.n_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._stage, args=(staged, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = staged.get()
+                self.wait_time += time.perf_counter() - start
+                if batch is _END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if self.stream is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_stream(self.stream)
+                    apply_to_tensors(batch, lambda tensor: tensor.record_stream(current))
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    staged.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+    def _stage(self, staged:queue.Queue, stop:threading.Event):
+        """Load and copy the batches, run on the background thread."""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.loader:
+                if not put(self.transfer(batch)):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+    def transfer(self, batch):
+        """Copy the tensors of the batch to the device."""
+        if self.stream is None:
+            return apply_to_tensors(batch, lambda tensor: tensor.to(self.device))
+        with torch.cuda.stream(self.stream):
+            return apply_to_tensors(batch, lambda tensor: tensor.pin_memory().to(self.device, non_blocking=True))
+
 
 class Trainer:
-    """Base class for training machine learning models."""
+    """Base class for training machine learning models.
 
-    def __init__(self, model:nn.Module, optimizer:optim.Optimizer, loss):
+    Parameters
+    ----------
+    model : torch Module
+        Model which will be trained within this class.
+    optimizer : torch Optimizer
+        optimizer used to change the weights on the machine
+        learning model.
+    loss : torch Loss
+        The chosen loss to compare the prediction and the target.
+    mixed_precision : bool
+        Determines whether the forward pass runs under bfloat16
+        autocast.
+    channels_last : bool
+        Determines whether the model and the image batches use the
+        channels last memory format, which speeds up the convolutions
+        of models such as InceptionV4, AlexNet, and CustomCNN.
+    accumulation_steps : int
+        Number of batches whose gradients are accumulated before the
+        weights are updated.
+    prefetch : int
+        Number of batches staged ahead of the computation by a
+        PrefetchLoader. Stated to be zero to iterate through the
+        loader directly.
+    resources : ResourcePlan
+        Split of the cores between the compute threads and the
+        DataLoader workers. The compute threads are configured when
+        training starts, the loader should be created with the
+        arguments from `resources.loader_kwargs()`.
+    checkpointer : Checkpointer
+        Writes the model, optimizer, random number generators, and
+        position within the dataset every few steps or minutes so that
+        training can be resumed through `resume`.
+    """
+
+    def __init__(self, model:nn.Module, optimizer:optim.Optimizer, loss, mixed_precision:bool=False, channels_last:bool=False, accumulation_steps:int=1, prefetch:int=2, resources:ResourcePlan=None, checkpointer:Checkpointer=None):
         """Initialize the class."""
+        assert accumulation_steps > 0, "The number of accumulation steps must be greater than zero."
         self.model = model
         self.opt = optimizer
         self.criterion = loss
+        self.mixed_precision = mixed_precision
+        self.channels_last = channels_last
+        self.accumulation_steps = accumulation_steps
+        self.prefetch = prefetch
+        self.resources = resources
+        self.checkpointer = checkpointer
+        self.device = torch.device("cpu")
+        self.epochs = 0
+        self.steps_per_epoch = 0
+        self.step = 0
+        self.epoch_rng = None
+        self.resume_state = None
+        self.skip_batches = 0
+        self.resume_rng = None
 
     def get_model(self):
         """Get the model post training.
@@ -25,8 +280,76 @@ class Trainer:
         torch Module
             The model at any point in time before or after training.
         """
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.module
         return self.model
 
+    def save_model(self, filename:str):
+        """Save the weights of the model from the main process only."""
+        if is_main_process():
+            torch.save(self.get_model().state_dict(), filename)
+
+    def log(self, message:str):
+        """Print the message from the main process only."""
+        if is_main_process():
+            print(message)
+
+    def resume(self, filename:str=None) -> bool:
+        """Resume training from a checkpoint.
+
+        The checkpoint is applied once `train` is called, which then
+        continues from the epoch and batch where the checkpoint was
+        written. The batches of the epoch that were already trained on
+        are loaded again and skipped, so the data order and random
+        numbers match those of an uninterrupted run as long as the
+        loader only draws from the generators of the main process.
+
+        Parameters
+        ----------
+        filename : str
+            The checkpoint to resume from, defaults to the newest one
+            written by the checkpointer.
+
+        Returns
+        -------
+        bool
+            Whether a checkpoint was found.
+        """
+        assert self.checkpointer is not None, "A checkpointer is required to resume training."
+        self.resume_state = self.checkpointer.load(filename)
+        return self.resume_state is not None
+
+    def checkpoint(self, epoch:int, batch:int, force:bool=False):
+        """Write a checkpoint from the main process when one is due.
+
+        Parameters
+        ----------
+        epoch : int
+            The current epoch.
+        batch : int
+            Number of batches of the epoch that were trained on.
+        force : bool
+            Write the checkpoint even when it is not due.
+        """
+        if self.checkpointer is None or not (force or self.checkpointer.due(self.step)):
+            return
+        if batch >= self.steps_per_epoch:
+            epoch, batch = epoch + 1, 0
+        if not is_main_process():
+            self.checkpointer.last_step = self.step
+            return
+        state = {
+                'model': self.get_model().state_dict(),
+                'optimizer': self.opt.state_dict(),
+                'epoch': epoch,
+                'batch': batch,
+                'step': self.step,
+                'rng': get_rng_state(),
+                'epoch_rng': self.epoch_rng if batch > 0 else None,
+                'version': VERSION,
+                }
+        self.checkpointer.save(state, self.step)
+
     def train(self, trainloader:data.DataLoader, epochs:int, gpu=False):
         """Train the machine learning model.
 
@@ -48,29 +371,118 @@ class Trainer:
         gpu : bool
             Determines whether the gpu is used to train dataset.
         """
-        if  gpu == True:
-            device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        if  gpu == True and torch.cuda.is_available():
+            index = dist.get_rank() % torch.cuda.device_count() if is_distributed() else 0
+            self.device = torch.device("cuda:{}".format(index))
         else:
-            device = torch.device("cpu")
-        print("The model will be running on ", device, "device")
-        self.model.to(device)
-        steps_per_epoch = len(trainloader.dataset) // trainloader.batch_size
-        print("Starting Training of {} version {}.".format(self.model.__class__.__name__, VERSION))
-        for epoch in range(epochs):
-            running_loss = 0.0
+            self.device = torch.device("cpu")
+        self.log("The model will be running on {} device".format(self.device))
+        if self.resources is not None:
+            self.resources.apply()
+            self.log("Using {}".format(self.resources))
+        self.model.to(self.device)
+        if self.channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        start_epoch = 0
+        if self.resume_state is not None:
+            start_epoch = self.load_checkpoint(self.resume_state)
+            self.resume_state = None
+        if is_distributed() and not isinstance(self.model, DistributedDataParallel):
+            device_ids = [self.device.index] if self.device.type == 'cuda' else None
+            self.model = DistributedDataParallel(self.model, device_ids=device_ids)
+        self.epochs = epochs
+        self.steps_per_epoch = max(len(trainloader), 1)
+        self.log("Starting Training of {} version {}.".format(self.get_model().__class__.__name__, VERSION))
+        if self.prefetch > 0:
+            trainloader = PrefetchLoader(trainloader, self.device, self.prefetch)
+        for epoch in range(start_epoch, epochs):
+            self.set_epoch(trainloader, epoch)
+            # Holds the state the shuffling of the epoch was drawn from.
+            self.epoch_rng = get_rng_state()
             self.model.train(True)
-            train_step(self. epoch, trainloader)
+            self.train_step(epoch, trainloader)
+            if isinstance(trainloader, PrefetchLoader):
+                self.log(f'[{epoch + 1:3d}/{epochs}] waited {trainloader.wait_time:.2f}s for data')
+        if self.checkpointer is not None:
+            if start_epoch < epochs and self.checkpointer.last_step < self.step:
+                self.checkpoint(epochs - 1, self.steps_per_epoch, force=True)
+            self.checkpointer.wait()
+
+    def load_checkpoint(self, state:dict) -> int:
+        """Load the checkpoint into the model and optimizer.
+
+        Parameters
+        ----------
+        state : dict
+            The checkpoint written by `checkpoint`.
+
+        Returns
+        -------
+        int
+            The epoch training continues from.
+        """
+        self.get_model().load_state_dict(state['model'])
+        self.opt.load_state_dict(state['optimizer'])
+        self.step = state['step']
+        if state['batch'] > 0:
+            # Replay the shuffling of the epoch, the generators are
+            # restored once the trained batches have been skipped.
+            set_rng_state(state['epoch_rng'])
+            self.skip_batches = state['batch']
+            self.resume_rng = state['rng']
+        else:
+            set_rng_state(state['rng'])
+        self.log("Resuming from epoch {} batch {} (step {}).".format(state['epoch'] + 1, state['batch'], state['step']))
+        return state['epoch']
+
+    def batches(self, trainloader:data.DataLoader):
+        """Enumerate the batches of the epoch, skipping those trained on before resuming."""
+        skip, rng = self.skip_batches, self.resume_rng
+        self.skip_batches, self.resume_rng = 0, None
+        for i, batch in enumerate(trainloader, 0):
+            if i < skip:
+                continue
+            if rng is not None:
+                set_rng_state(rng)
+                rng = None
+            yield i, batch
 
     def train_step(self, epoch:int, trainloader:data.DataLoader):
         """Single Step for training model."""
         raise NotImplementedError("method train_step must be implemented.")
 
+    @staticmethod
+    def set_epoch(trainloader:data.DataLoader, epoch:int):
+        """Let the sampler or streaming dataset reshuffle for the epoch."""
+        sampler = getattr(trainloader, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        dataset = getattr(trainloader, 'dataset', None)
+        if hasattr(dataset, 'set_epoch'):
+            dataset.set_epoch(epoch)
+
+    def sync_gradients(self, step:bool):
+        """Create the context that skips the gradient all-reduce between steps."""
+        if not step and isinstance(self.model, DistributedDataParallel):
+            return self.model.no_sync()
+        return nullcontext()
+
+    def to_device(self, inputs:torch.Tensor) -> torch.Tensor:
+        """Move a batch of inputs to the device used for training."""
+        if self.channels_last and inputs.ndim == 4:
+            return inputs.to(self.device, memory_format=torch.channels_last)
+        return inputs.to(self.device)
+
+    def autocast(self):
+        """Create the autocast context used for the forward pass."""
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
 
 class ClassTrainer(Trainer):
     """Class for training pytorch machine learning classifiers.
 
     This class functions as an environment for training the
-    pytorch models.
+    pytorch models. The labels are expected to be one-hot encoded.
 
     Parameters
     ----------
@@ -83,54 +495,50 @@ class ClassTrainer(Trainer):
         The chosen loss to compare the prediction and the target.
     """
 
-    def __init__(self, model:nn.Module, optimizer:optim.Optimizer, loss):
-        """Initialize the class."""
-        self.model = model
-        self.opt = optimizer
-        self.criterion = loss
-
     def train_step(self, epoch:int, trainloader:data.DataLoader):
-        correct = 0
-        total = 0
-        for i, (inputs, labels) in enumerate(trainloader, 0):
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-            self.opt.zero_grad()
-
-            outputs = self.model(inputs)
-            loss = self.criterion(outputs, labels)
-            loss.backward()
-            self.opt.step()
-
-            _, ipredicted = torch.max(outputs.data, 1)
-            _, lindices = torch.max(labels.data, 1)
-            total += labels.size(0)
-            correct += (ipredicted == lindices).sum().item()
-            running_loss += loss.item()
-        print(f'[{epoch + 1:3d}/{epochs}] loss: {running_loss / steps_per_epoch:.3f}, accuracy: {round(100 * correct / total, 2)}')
-            correct = 0
-            total = 0
-            for i, (inputs, labels) in enumerate(trainloader, 0):
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-                self.opt.zero_grad()
+        """Train the model on every batch of the dataset once.
 
-                outputs = self.model(inputs)
-                loss = self.criterion(outputs, labels)
-                loss.backward()
+        The loss and accuracy are accumulated on the device and only
+        synchronized once at the end of the epoch, when they are also
+        summed across the processes of a distributed run.
+        """
+        # Holds the running loss, the number of batches, the number of
+        # correct predictions, and the number of samples.
+        metrics = torch.zeros(4, dtype=torch.float64, device=self.device)
+        n_batches = len(trainloader)
+        self.opt.zero_grad()
+        for i, (inputs, labels) in self.batches(trainloader):
+            inputs = self.to_device(inputs)
+            labels = labels.to(self.device)
+
+            step = (i + 1) % self.accumulation_steps == 0 or i + 1 == n_batches
+            # The last group of the epoch may hold fewer batches.
+            group_size = min(self.accumulation_steps, n_batches - (i // self.accumulation_steps) * self.accumulation_steps)
+            with self.sync_gradients(step):
+                with self.autocast():
+                    outputs = self.model(inputs)
+                # Losses such as BCELoss are not safe to autocast.
+                loss = self.criterion(outputs.float(), labels)
+                (loss / group_size).backward()
+            if step:
                 self.opt.step()
+                self.opt.zero_grad()
+                self.step += 1
+                self.checkpoint(epoch, i + 1)
 
-                #_, ipredicted = torch.max(outputs.data, 1)
-                ipredicted= outputs.max(1).indices
-                #_, lindices = torch.max(labels.data, 1)
-                lindices = labels.max(1).indices
-                total += labels.size(0)
-                correct += (ipredicted == lindices).sum().item()
-                running_loss += loss.item()
-            print(f'[{epoch + 1:3d}/{epochs}] loss: {running_loss / steps_per_epoch:.3f}, accuracy: {round(100 * correct / total, 2)}')
+            ipredicted = outputs.detach().argmax(dim=1)
+            lindices = labels.argmax(dim=1)
+            metrics[0] += loss.detach()
+            metrics[1] += 1
+            metrics[2] += (ipredicted == lindices).sum()
+            metrics[3] += labels.size(0)
+        if is_distributed():
+            dist.all_reduce(metrics)
+        running_loss, batches, correct, total = metrics.tolist()
+        self.log(f'[{epoch + 1:3d}/{self.epochs}] loss: {running_loss / max(batches, 1):.3f}, accuracy: {round(100 * correct / max(total, 1), 2)}')
 
     @staticmethod
-    def test(model, testloader:data.DataLoader, classes:tuple, gpu:bool=False, version:int=0):
+    def test(model, testloader:data.DataLoader, classes:tuple, gpu:bool=False, version:int=0, activation=None, to_inputs=None) -> dict:
         """Test the model's ability to classify on a never before seen dataset.
 
         Parameters
@@ -142,34 +550,45 @@ class ClassTrainer(Trainer):
         gpu : bool
             Determines whether to send the model and data to the gpu
             or the cpu.
+        activation : Callable
+            Optional function converting the outputs of the model into
+            probabilities for the AUROC. Outputs outside of [0, 1] are
+            converted by a softmax otherwise.
+        to_inputs : Callable
+            Optional function converting a batch into the tuple of
+            model inputs, such as the images and categorical data of
+            the TumorClassifier. Defaults to the first item of the
+            batch. The labels are always the last item.
+
+        Returns
+        -------
+        Dictionary
+            The accuracy together with the per-class precision,
+            recall, F1 score, and AUROC.
         """
         if  gpu == True:
             device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         else:
             device = torch.device("cpu")
         model.to(device)
-        correct_pred = {classname: 0 for classname in classes}
-        total_pred = {classname: 0 for classname in classes}
+        metrics = ClassificationMetrics(len(classes), device, activation=activation)
         results = list("Accuracy Results on test set for Machine Learning Model {}\n".format(model.__class__.__name__))
 
         with torch.no_grad():
-            for images, labels in testloader:
-                images = images.to(device)
-                labels = labels.to(device)
-                outputs = model(images)
-                _, predictions = torch.max(outputs, 1)
-                _, lindices = torch.max(labels, 1)
-                for label, pred in zip(lindices, predictions):
-                    if label == pred:
-                        correct_pred[classes[label]] += 1
-                    total_pred[classes[label]] += 1
-        for classname, correct_count in correct_pred.items():
-            accuracy = 100 * float(correct_count) / total_pred[classname]
-            results.append(f'Accuracy for class: {classname:5s} is {accuracy:.1f}%\n')
-            print(f'Accuracy for class: {classname:5s} is {accuracy:.1f}%')
+            for batch in PrefetchLoader(testloader, device):
+                inputs = (batch[0],) if to_inputs == None else to_inputs(batch)
+                metrics.update(model(*inputs), batch[-1])
+        metrics = metrics.compute()
+        # The recall of a class is the accuracy over its samples.
+        for classname, recall in zip(classes, metrics['Recall'].tolist()):
+            results.append(f'Accuracy for class: {classname:5s} is {100 * recall:.1f}%\n')
+            print(f'Accuracy for class: {classname:5s} is {100 * recall:.1f}%')
+        results.append(f'Accuracy: {100 * metrics["Accuracy"]:.1f}%\n')
+        print(f'Accuracy: {100 * metrics["Accuracy"]:.1f}%')
         with open('data/{}_results_version_{}.txt'.format(model.__class__.__name__, version), 'w') as fp:
             fp.writelines(results)
             fp.close()
+        return metrics
 
     @staticmethod
     def create_confusion_matrix(preds, labels, device):
@@ -186,13 +605,6 @@ class ClassTrainer(Trainer):
         labels
             The true value
         """
-        n_classes = len(labels[0])
-        cm = torch.zeros(n_classes, n_classes)
-        cm.to(device)
-        pindices = preds.max(1).indices
-        pindices.to(device)
-        lindices = labels.max(1).indices
-        lindices.to(device)
-        for l, p in zip(lindices, pindices):
-            cm[p, l] += 1
-        return cm
+        cm = ConfusionMatrix(len(labels[0]), device).update(preds, labels)
+        # The rows are the predicted classes and the columns the true ones.
+        return cm.matrix.T.float()
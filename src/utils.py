@@ -5,15 +5,22 @@ These functions are set to provide a list of paths to images, organize
 the files based on desired categories found within the image path, and
 some helpful transformations from pytorch.
 """
+import os
+import json
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 
 import polars as pl
 import numpy as np
 import torch
+from torch.nn import functional as F
+from torch.utils.data import default_collate
+from PIL import Image
 from torchvision import transforms
 
 img_size = (512, 512)
+NORMALIZATION_FILENAME = '.normalization.json'
 
 STANDARD_IMAGE_TRANSFORMS = transforms.Compose([
         transforms.ToTensor(),
@@ -21,6 +28,147 @@ STANDARD_IMAGE_TRANSFORMS = transforms.Compose([
         transforms.Grayscale(num_output_channels=1),
         ])
 
+
+class BatchImageTransform:
+    """Batched version of the standard image transforms.
+
+    Converts a whole batch of images to grayscale, resizes it, and
+    normalizes it at once. Floating point batches are converted to
+    grayscale before the resize so that only one channel is
+    interpolated, while uint8 batches on the cpu are resized first
+    with the uint8 kernel and then scaled to [0, 1] as done by
+    ToTensor.
+
+    Parameters
+    ----------
+    size : tuple
+        The height and width of the output images.
+    num_output_channels : int
+        The number of channels of the output images, either 1 or 3.
+    mean : float | list
+        Optional mean used to normalize each channel.
+    std : float | list
+        Optional standard deviation used to normalize each channel.
+    channels_last : bool
+        Determines whether the input batch is laid out as (batch,
+        height, width, channels) and whether the output is returned in
+        the channels last memory format.
+    """
+
+    grayscale_weights = (0.2989, 0.587, 0.114)
+
+    def __init__(self, size:tuple=img_size, num_output_channels:int=1, mean=None, std=None, channels_last:bool=False):
+        """Init the Class."""
+        assert num_output_channels in (1, 3), "The number of output channels must be either 1 or 3."
+        assert (mean is None) == (std is None), "Both the mean and std are required to normalize."
+        self.size = tuple(size)
+        self.num_output_channels = num_output_channels
+        self.mean = mean
+        self.std = std
+        self.channels_last = channels_last
+
+    def __call__(self, batch:torch.Tensor) -> torch.Tensor:
+        """Transform the batch of images."""
+        if self.channels_last:
+            batch = batch.permute(0, 3, 1, 2)
+        if batch.dtype == torch.uint8 and batch.device.type == 'cpu':
+            # The uint8 kernel resizes all of the channels faster than
+            # the image can be converted to float at full resolution.
+            batch = self.resize(batch).float().div_(255)
+        elif batch.dtype == torch.uint8:
+            batch = batch.float().div_(255)
+        else:
+            batch = batch.float()
+        if batch.shape[1] == 3 and self.num_output_channels == 1:
+            weights = torch.tensor(self.grayscale_weights, dtype=batch.dtype, device=batch.device)
+            batch = (batch * weights.reshape(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+        batch = self.resize(batch)
+        if batch.shape[1] == 1 and self.num_output_channels == 3:
+            batch = batch.expand(-1, 3, -1, -1)
+        if self.mean is not None:
+            mean = torch.as_tensor(self.mean, dtype=batch.dtype, device=batch.device).reshape(1, -1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=batch.dtype, device=batch.device).reshape(1, -1, 1, 1)
+            batch = (batch - mean) / std
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def resize(self, batch:torch.Tensor) -> torch.Tensor:
+        """Resize the batch with antialiased bilinear interpolation."""
+        if tuple(batch.shape[-2:]) == self.size:
+            return batch
+        return F.interpolate(batch, size=self.size, mode='bilinear', align_corners=False, antialias=True)
+
+
+class BatchCollate:
+    """Collate function that applies a batched transform to the images.
+
+    Replaces the per-sample image transforms of a dataset so that the
+    images are transformed once per batch, either in the main process
+    or at the end of each DataLoader worker. The dataset should return
+    unresized images, such as uint8 tensors from PILToTensor for an
+    ImageFolder, or the raw arrays of a DICOMSet. Numpy arrays and PIL
+    images are read as (height, width, channels).
+
+    Parameters
+    ----------
+    transform : BatchImageTransform
+        The transform applied to the stacked images.
+    image_key : str
+        The key of the image when the datapoints are dictionaries, as
+        done by the MixedDataset.
+
+    Examples
+    --------
+    >>> img_set = datasets.ImageFolder(root=dir_train, transform=transforms.PILToTensor())
+    >>> loader = data.DataLoader(img_set, batch_size=64, collate_fn=BatchCollate(BatchImageTransform()))
+    """
+
+    def __init__(self, transform:BatchImageTransform, image_key:str='image'):
+        """Init the Class."""
+        self.transform = transform
+        self.image_key = image_key
+
+    def __call__(self, samples:list):
+        """Collate the datapoints and transform the images."""
+        if isinstance(samples[0], dict):
+            images = [sample[self.image_key] for sample in samples]
+            batch = default_collate([{k:v for k,v in sample.items() if k != self.image_key} for sample in samples])
+            batch[self.image_key] = self.transform_images(images)
+            return batch
+        images = [sample[0] for sample in samples]
+        batch = default_collate([tuple(sample[1:]) for sample in samples])
+        return [self.transform_images(images), *batch]
+
+    def transform_images(self, images:list) -> torch.Tensor:
+        """Stack the images and apply the transform.
+
+        Images of the same size are transformed together, the results
+        are returned in the original order.
+        """
+        images = [self.to_tensor(img) for img in images]
+        groups = defaultdict(list)
+        for i, img in enumerate(images):
+            groups[tuple(img.shape)].append(i)
+        if len(groups) == 1:
+            return self.transform(torch.stack(images))
+        output = [None] * len(images)
+        for indices in groups.values():
+            transformed = self.transform(torch.stack([images[i] for i in indices]))
+            for i, img in zip(indices, transformed):
+                output[i] = img
+        return torch.stack(output)
+
+    def to_tensor(self, img) -> torch.Tensor:
+        """Convert the image into a tensor with the transform's layout."""
+        if torch.is_tensor(img):
+            return img.permute(1, 2, 0) if self.transform.channels_last else img
+        img = torch.from_numpy(np.array(img))
+        if img.ndim == 2:
+            img = img.unsqueeze(-1)
+        return img if self.transform.channels_last else img.permute(2, 0, 1)
+
+
 def split_set(df:pl.DataFrame, train_size:float=0.0, test_size:float=0.0, valid_size:float=0.0):
     """Split the dataset into train, test, and validation sets.
 
@@ -135,6 +283,51 @@ def update_version(filename:str, new_model:bool=False):
             fp.write(str(nv))
             fp.close()
 
+def normalization_file(dataset) -> str:
+    """Get the path of the normalization statistics of a dataset.
+
+    The statistics are stored next to the file index of an ImageSet,
+    or within the root of datasets such as an ImageFolder or ShardSet.
+    """
+    if getattr(dataset, 'index_file', None) != None:
+        return os.path.join(os.path.dirname(dataset.index_file), NORMALIZATION_FILENAME)
+    if getattr(dataset, 'root', None) != None:
+        return os.path.join(dataset.root, NORMALIZATION_FILENAME)
+    raise ValueError("Unable to find the root of the dataset, the filename must be given.")
+
+def load_normalization_stats(path) -> dict:
+    """Load the statistics saved by compute_normalization_stats.
+
+    Parameters
+    ----------
+    path : str | Dataset
+        The json file, the folder containing it, or the dataset whose
+        statistics were saved.
+
+    Returns
+    -------
+    Dictionary
+        The per-channel statistics of the images.
+    """
+    if not isinstance(path, str):
+        path = normalization_file(path)
+    elif os.path.isdir(path):
+        path = os.path.join(path, NORMALIZATION_FILENAME)
+    with open(path, 'r') as fp:
+        stats = json.load(fp)
+        fp.close()
+    return stats
+
+def create_normalize_transform(path) -> transforms.Normalize:
+    """Create the Normalize transform from the saved statistics.
+
+    Examples
+    --------
+    >>> img_transforms = transforms.Compose([STANDARD_IMAGE_TRANSFORMS, create_normalize_transform(dir_train)])
+    """
+    stats = load_normalization_stats(path)
+    return transforms.Normalize(stats['mean'], stats['std'])
+
 def create_target_transform(n_class:int, val:int=1):
     """Create the transformation function for the label data.
 
@@ -202,9 +395,14 @@ def convert_string_to_cat(df:pl.DataFrame, col:str|list) -> pl.DataFrame:
         exit()
     return df
 
-def load_image(filename:str, size:tuple|int) -> np.ndarray:
+def load_image(filename:str, size:tuple|int, cache=None) -> np.ndarray:
     """Load the image based on the path.
 
+    The image is decoded at the lowest resolution that the format
+    allows while still covering the desired size, JPEG files are
+    drafted directly into a reduced grayscale image and the other
+    formats are reduced by an integer factor before the final resize.
+
     Parameters
     ----------
     filename : string
@@ -214,32 +412,67 @@ def load_image(filename:str, size:tuple|int) -> np.ndarray:
         tuple containing the desired width and height to
         readjust the image. In the case that the image is
         square, then the size may be an integer.
+    cache : ArrayCache
+        Optional cache of the loaded images. The image is only
+        decoded when it is not found within the cache.
 
     Returns
     -------
     numpy Array
         Returns a 3D array containing the image of the
-        dimensions (width, height, colors).
+        dimensions (colors, height, width).
 
     """
-    img = Image.open( filename ).convert('L')
     if type(size) == int:
-        tsize = (size, size)
-        img = img.resize(tsize)
-    else:
-        img = img.resize(size)
-    img.load()
+        size = (size, size)
+    if cache is not None:
+        key = cache.file_key(filename, function='load_image', size=size)
+        return cache.get_or_compute(key, lambda: load_image(filename, size))
+    img = Image.open( filename )
+    img.draft('L', size)
+    img = img.convert('L')
+    img = img.resize(size, reducing_gap=2.0)
     if 'mask' in filename:
         data = np.asarray( img ).astype('int32')
     else:
-        raw_data = np.asarray( img ).astype('float32')
-        data = (raw_data - np.min(raw_data)) / (np.max(raw_data) - np.min(raw_data))
+        data = np.array( img, dtype=np.float32 )
+        vmin = data.min()
+        vrange = data.max() - vmin
+        data -= vmin
+        if vrange > 0:
+            data /= vrange
     if data.ndim == 2:
         data = data[np.newaxis, ...]
     else:
         pass
     return data
 
+def load_images(filenames:list[str], size:tuple|int, max_workers:int=None, cache=None) -> list[np.ndarray]:
+    """Load a list of images using a pool of threads.
+
+    Decoding and resizing within PIL releases the GIL, so the images
+    are loaded concurrently by the threads.
+
+    Parameters
+    ----------
+    filenames : list of string
+        The paths to the images.
+    size : tuple | int
+        The desired width and height of the images.
+    max_workers : int
+        The number of threads. Defaults to the value chosen by the
+        ThreadPoolExecutor.
+    cache : ArrayCache
+        Optional cache of the loaded images.
+
+    Returns
+    -------
+    list of numpy Array
+        The loaded images in the same order as the filenames.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda filename: load_image(filename, size, cache), filenames))
+
 def merge_dictionaries(*dictionaries) -> dict:
     """Merge n number of dictionaries.
 
@@ -341,7 +574,7 @@ def get_file_paths(root:str, filename:str=None) -> list[str]:
             fp.close()
     return all_files
 
-def rescale_image(img:np.ndarray) -> np.ndarray:
+def rescale_image(img:np.ndarray, cache=None) -> np.ndarray:
     """Rescale the image to a more manageable size.
 
     Changes the size of the image based on the length and
@@ -353,6 +586,9 @@ def rescale_image(img:np.ndarray) -> np.ndarray:
     ----------
     img : Numpy Array
         array containing the raw values of images.
+    cache : ArrayCache
+        Optional cache of the rescaled images, keyed by the
+        content of the image.
 
     Returns
     -------
@@ -360,6 +596,9 @@ def rescale_image(img:np.ndarray) -> np.ndarray:
         Array containing the rescaled image.
 
     """
+    if cache is not None:
+        key = cache.array_key(img, function='rescale_image')
+        return cache.get_or_compute(key, lambda: rescale_image(img))
     size = img.shape
     width = int(size[1] / 2)
     height = int(size[0] / 2)
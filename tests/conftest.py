@@ -0,0 +1,6 @@
+"""Shared configuration for the test suite."""
+import os
+import sys
+
+# The modules within src import each other by their plain module names.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src'))
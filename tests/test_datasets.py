@@ -0,0 +1,212 @@
+"""Module for testing the custom datasets."""
+import os
+import time
+import shutil
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+import polars as pl
+import pytest
+from pydicom.data import get_testdata_file
+from torch.utils import data
+
+import datasets
+from datasets import DICOMSet, MixedDataset, ShardSet, PixelCache, ImageSet, StreamingImageSet, INDEX_FILENAME
+from ingest import write_shards
+
+sample = get_testdata_file('CT_small.dcm')
+
+
+def test_dicomset_batched_fetch():
+    """Test whether the batched fetch matches the single item fetch."""
+    df = pl.DataFrame({"path": [sample] * 4, "label": [0, 1, 1, 0]})
+    dataset = DICOMSet(df, label_col="label")
+    batch = dataset.__getitems__([3, 1])
+    assert [cat for _, cat in batch] == [0, 1]
+    img, cat = dataset[3]
+    assert np.array_equal(batch[0][0], img)
+    loader = data.DataLoader(dataset, batch_size=2)
+    images, labels = next(iter(loader))
+    assert images.shape == (2, 128, 128, 1)
+    assert labels.tolist() == [0, 1]
+
+
+def test_mixed_dataset_batched_fetch(tmp_path):
+    """Test whether the batched fetch returns the rows of the table."""
+    path = str(tmp_path / "image.png")
+    Image.fromarray(np.zeros((8, 8), dtype=np.uint8)).save(path)
+    df = pl.DataFrame({"path": [path] * 3, "age": [40, 50, 60], "density": [1, 2, 3], "pathology": [0, 1, 0]})
+    dataset = MixedDataset(df)
+    batch = dataset.__getitems__([2, 0])
+    assert batch[0]['supplementary data'].tolist() == [60.0, 3.0]
+    assert batch[1]['labels'].tolist() == [0]
+    assert dataset[1]['supplementary data'].tolist() == [50.0, 2.0]
+
+
+def write_class_folders(root, counts:dict):
+    """Write small images into one folder per class."""
+    for name, count in counts.items():
+        (root / name).mkdir(exist_ok=True)
+        for i in range(count):
+            Image.fromarray(np.full((4, 4), i, dtype=np.uint8)).save(root / name / "{}.png".format(i))
+
+
+def test_image_set_index(tmp_path):
+    """Test whether the index is reused until a class folder changes."""
+    write_class_folders(tmp_path, {'benign': 3, 'malignant': 2})
+    dataset = ImageSet(str(tmp_path), image_loader=lambda path: path)
+    assert os.path.exists(tmp_path / INDEX_FILENAME)
+    assert dataset.classes == ['benign', 'malignant']
+    assert len(dataset) == 5
+    path, label = dataset[4]
+    assert path == str(tmp_path / "malignant" / "1.png") and label == 1
+
+    # New files change the modification time of their folder.
+    mtime = os.stat(tmp_path / "benign").st_mtime_ns
+    Image.fromarray(np.zeros((4, 4), dtype=np.uint8)).save(tmp_path / "benign" / "3.png")
+    os.utime(tmp_path / "benign", ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    assert len(ImageSet(str(tmp_path))) == 6
+    (tmp_path / "normal").mkdir()
+    assert ImageSet(str(tmp_path)).classes == ['benign', 'malignant', 'normal']
+
+
+def test_image_set_read_only_root(tmp_path, monkeypatch):
+    """Test whether the index of a read-only root is kept within the user cache."""
+    root = tmp_path / "data"
+    root.mkdir()
+    write_class_folders(root, {'benign': 2, 'malignant': 2})
+    monkeypatch.setattr(datasets, 'INDEX_CACHE_DIR', str(tmp_path / "cache"))
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    dataset = ImageSet(str(root))
+    assert not os.path.exists(root / INDEX_FILENAME)
+    assert dataset.index_file.startswith(str(tmp_path / "cache")) and os.path.exists(dataset.index_file)
+    assert len(dataset) == 4
+
+
+def test_streaming_image_set_workers(tmp_path):
+    """Test whether the workers share the files without repeats."""
+    write_class_folders(tmp_path, {'benign': 5, 'malignant': 4})
+    dataset = StreamingImageSet(str(tmp_path), image_loader=lambda path: os.path.relpath(path, tmp_path), shuffle=True)
+    dataset.set_epoch(1)
+    loader = data.DataLoader(dataset, batch_size=2, num_workers=3)
+    seen = [path for paths, _ in loader for path in paths]
+    assert sorted(seen) == sorted(str(path) for path in dataset.dataset.paths)
+
+
+def test_shardset_streams_every_sample(tmp_path):
+    """Test whether the shards are split across workers without repeats."""
+    root = tmp_path / "images"
+    root.mkdir()
+    labels = dict()
+    for i in range(10):
+        path = root / "{}.png".format(i)
+        Image.fromarray(np.full((12, 12), 25 * i, dtype=np.uint8)).save(path)
+        labels[str(path)] = i
+    write_shards(str(root), str(tmp_path / "shards"), size=8, shard_size=3, workers=1, labels=labels)
+    dataset = ShardSet(str(tmp_path / "shards"), shuffle_buffer=4)
+    loader = data.DataLoader(dataset, batch_size=2, num_workers=2)
+    seen = [label for _, batch in loader for label in batch.tolist()]
+    assert sorted(seen) == list(range(10))
+    img, _ = next(iter(dataset))
+    assert img.shape == (8, 8, 1)
+
+
+def test_write_shards_metadata(tmp_path):
+    """Test whether DICOM metadata after a run of PNGs is kept and decoding errors are reported."""
+    root = tmp_path / "images"
+    root.mkdir()
+    for i in range(3):
+        Image.fromarray(np.full((12, 12), 25 * i, dtype=np.uint8)).save(root / "{}.png".format(i))
+    (root / "3.png").write_bytes(b"not an image")
+    shutil.copy(sample, root / "4.dcm")
+    manifest = write_shards(str(root), str(tmp_path / "shards"), size=8, shard_size=2, workers=1, metadata_cols=['Modality', 'PatientSex'])
+    assert manifest['count'] == 4
+    assert manifest['skipped'] == 1
+    assert manifest['errors'][0]['path'] == str(root / "3.png")
+    sidecars = [pl.read_parquet(tmp_path / "shards" / shard['metadata']) for shard in manifest['shards']]
+    assert all(sidecar.columns == ['path', 'label', 'Modality', 'PatientSex'] for sidecar in sidecars)
+    assert sidecars[0]['Modality'].to_list() == [None, None]
+    assert sidecars[1]['Modality'].to_list() == [None, 'CT']
+
+
+def test_shardset_equal_ranks(tmp_path):
+    """Test whether ranks receive the same number of samples and batches from uneven shards."""
+    root = tmp_path / "images"
+    root.mkdir()
+    labels = dict()
+    for i in range(11):
+        path = root / "{}.png".format(i)
+        Image.fromarray(np.full((12, 12), 20 * i, dtype=np.uint8)).save(path)
+        labels[str(path)] = i
+    # Shards of 4, 4, and 3 samples.
+    write_shards(str(root), str(tmp_path / "shards"), size=8, shard_size=4, workers=1, labels=labels)
+    seen = list()
+    for rank in range(2):
+        dataset = ShardSet(str(tmp_path / "shards"), shuffle_buffer=2, rank=rank, world_size=2)
+        dataset.set_epoch(3)
+        loader = data.DataLoader(dataset, batch_size=2, num_workers=2)
+        batches = [batch.tolist() for _, batch in loader]
+        assert len(dataset) == 5
+        assert sum(len(batch) for batch in batches) == 5
+        assert len(batches) == 3
+        seen.extend(label for batch in batches for label in batch)
+    assert len(set(seen)) == 10
+
+
+def slow_decoder(path:str) -> np.ndarray:
+    """Decode the file slowly so that concurrent misses overlap."""
+    time.sleep(0.2)
+    return np.arange(16, dtype=np.float32).reshape(4, 4)
+
+def load_cached(root:str, path:str, barrier):
+    """Load the file through the cache once every process is ready."""
+    barrier.wait()
+    arr = PixelCache(root).load(path, slow_decoder)
+    os._exit(0 if np.array_equal(arr, slow_decoder(path)) else 1)
+
+
+def test_pixel_cache(tmp_path):
+    """Test whether the cache decodes once, follows the mtime, and returns writable arrays."""
+    path = tmp_path / "image.dcm"
+    path.write_bytes(b"image")
+    cache = PixelCache(str(tmp_path / "cache"))
+    calls = list()
+
+    def decoder(path):
+        calls.append(path)
+        return np.ones((4, 4), dtype=np.float32)
+
+    first = cache.load(str(path), decoder)
+    second = cache.load(str(path), decoder)
+    assert len(calls) == 1
+    assert np.array_equal(first, second)
+    # In-place transforms change private pages and never the cached file.
+    second *= 2
+    assert np.array_equal(cache.load(str(path), decoder), np.ones((4, 4)))
+
+    key = cache.key(str(path))
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert cache.key(str(path)) != key
+    cache.load(str(path), decoder)
+    assert len(calls) == 2
+
+
+def test_pixel_cache_concurrent_misses(tmp_path):
+    """Test whether workers missing the same file at once read a complete array."""
+    path = tmp_path / "image.dcm"
+    path.write_bytes(b"image")
+    root = str(tmp_path / "cache")
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(2)
+    processes = [context.Process(target=load_cached, args=(root, str(path), barrier)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+    assert [process.exitcode for process in processes] == [0, 0]
+    assert [f for f in os.listdir(root) if f.endswith('.tmp')] == []
+
+
+if __name__ == "__main__":
+    pytest.main()
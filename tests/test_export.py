@@ -0,0 +1,70 @@
+"""Module for testing the export of trained models."""
+import os
+
+import pytest
+import torch
+from torch import nn
+
+from export import export_model, load_exported, onnxruntime
+from models import AlexNet
+
+
+class TwoInputNet(nn.Module):
+    """Small model with an image and a categorical input."""
+
+    def __init__(self):
+        """Init the Class."""
+        super(TwoInputNet, self).__init__()
+        self.conv = nn.Conv2d(1, 4, kernel_size=3)
+        self.bn = nn.BatchNorm2d(4)
+        self.dropout = nn.Dropout(0.5)
+        self.flatten = nn.Flatten()
+        self.linear = nn.Linear(4 * 6 * 6 + 3, 2)
+
+    def forward(self, x1, x2):
+        """Forward pass of the model."""
+        x1 = self.flatten(self.dropout(torch.relu(self.bn(self.conv(x1)))))
+        return self.linear(torch.cat((x1, x2), dim=1))
+
+
+@pytest.mark.parametrize('fmt', ['torchscript', 'onnx'])
+def test_export_parity(tmp_path, fmt):
+    """Test whether the exported model matches the eager model."""
+    if fmt == 'onnx' and onnxruntime is None:
+        pytest.skip("onnxruntime is not installed.")
+    torch.manual_seed(0)
+    model = TwoInputNet()
+    model.bn.running_mean.uniform_(-1, 1)
+    model.bn.running_var.uniform_(0.5, 2)
+    model.eval()
+    inputs = (torch.randn(2, 1, 8, 8), torch.randn(2, 3))
+    filenames = export_model(model, str(tmp_path), formats=(fmt,), inputs=inputs, version=7)
+    assert os.path.basename(filenames[fmt]).startswith("TwoInputNet_v7")
+    assert os.path.exists(tmp_path / "TwoInputNet_v7.json")
+    exported = load_exported(filenames[fmt])
+    batch = (torch.randn(5, 1, 8, 8), torch.randn(5, 3))
+    with torch.no_grad():
+        assert torch.allclose(exported(*batch), model(*batch), atol=1e-5)
+
+
+def test_export_alexnet(tmp_path):
+    """Test whether an exported AlexNet matches the model, which keeps training."""
+    torch.manual_seed(0)
+    model = AlexNet(pool_size=2)
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 2)
+    model.train()
+    filenames = export_model(model, str(tmp_path), inputs=(torch.randn(1, 1, 128, 128),), version=1)
+    assert model.training
+    assert isinstance(model.layer1[1], nn.BatchNorm2d)
+    exported = load_exported(filenames['torchscript'])
+    batch = torch.randn(3, 1, 128, 128)
+    model.eval()
+    with torch.no_grad():
+        assert torch.allclose(exported(batch), model(batch), atol=1e-4)
+
+
+if __name__ == "__main__":
+    pytest.main()
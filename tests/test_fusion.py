@@ -0,0 +1,41 @@
+"""Module for testing the fusion of convolutions and BatchNorms."""
+import pytest
+import torch
+from torch import nn
+
+from models import InceptionStem, InceptionA, ReductionA
+from fusion import fuse_conv_bn, count_batchnorms
+
+
+def randomize_batchnorms(model:nn.Module):
+    """Give every BatchNorm statistics and affine parameters differing from the identity."""
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+
+
+@pytest.mark.parametrize('block, shape', [
+    (lambda: InceptionStem(1), (2, 1, 75, 75)),
+    (lambda: InceptionA(384), (2, 384, 9, 9)),
+    (lambda: ReductionA(384), (2, 384, 9, 9)),
+    (lambda: nn.Sequential(nn.Conv2d(3, 8, 3), nn.BatchNorm2d(8), nn.ReLU(), nn.MaxPool2d(2)), (2, 3, 16, 16)),
+])
+def test_fusion_parity(block, shape):
+    """Test whether the fused block removes every BatchNorm and matches the eager block."""
+    torch.manual_seed(0)
+    model = block()
+    randomize_batchnorms(model)
+    model.eval()
+    fused = fuse_conv_bn(model)
+    assert count_batchnorms(fused) == 0
+    assert count_batchnorms(model) > 0
+    x = torch.randn(*shape)
+    with torch.no_grad():
+        assert torch.allclose(fused(x), model(x), atol=1e-4)
+
+
+if __name__ == "__main__":
+    pytest.main()
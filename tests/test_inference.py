@@ -0,0 +1,90 @@
+"""Module for testing the inference service."""
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from inference import InferenceService, decode_dicom
+
+
+def _decode(x):
+    """Use the tensor as the input and its sum as the metadata."""
+    return x, {'total': x.sum().item()}
+
+
+def test_micro_batching():
+    """Test whether concurrent requests share forward passes."""
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(16, 2), nn.Softmax(dim=1))
+    inputs = [torch.randn(1, 4, 4) for _ in range(12)]
+    expected = model(torch.stack(inputs))
+    results = [None] * 4
+    with InferenceService(model, decoder=_decode, max_batch_size=8, max_latency=0.5) as service:
+        def request(i):
+            results[i] = service.predict(inputs[3 * i:3 * i + 3], ["{}.dcm".format(j) for j in range(3 * i, 3 * i + 3)])
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    results = [result for request in results for result in request]
+    assert service.n_files == 12
+    assert service.n_batches < 12
+    for i, result in enumerate(results):
+        assert result['filename'] == "{}.dcm".format(i)
+        assert result['scores'] == pytest.approx(expected[i].tolist(), abs=1e-6)
+        assert result['pred_class'] == ('benign', 'malignant')[expected[i].argmax().item()]
+
+
+def test_decode_error():
+    """Test whether files that cannot be decoded are reported."""
+    model = nn.Sequential(nn.Flatten(), nn.Linear(16, 2))
+    with InferenceService(model, decoder=_decode) as service:
+        results = service.predict([torch.randn(1, 4, 4), None], ["good.dcm", "bad.dcm"])
+    assert 'error' not in results[0]
+    assert results[1]['filename'] == "bad.dcm" and 'error' in results[1]
+
+
+def test_decode_multiframe_memory(tmp_path):
+    """Test whether only the first frame of a multi-frame file is held in memory."""
+    frames, size = 40, 512
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.PatientID = 'p1'
+    ds.PatientAge = '054Y'
+    ds.Rows = ds.Columns = size
+    ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+    pixels = np.arange(frames * size * size, dtype=np.uint16).reshape(frames, size, size) % 4096
+    pixels[1:] = 4095 - pixels[1:]
+    ds.PixelData = pixels.tobytes()
+    path = str(tmp_path / "multiframe.dcm")
+    ds.save_as(path, enforce_file_format=True)
+
+    with open(path, 'rb') as fp:
+        tracemalloc.start()
+        image, metadata = decode_dicom(fp, size=(size, size), defer_size='1 MB')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert peak < pixels.nbytes / 4
+    first = pixels[0].astype(np.float32)
+    expected = (first - first.min()) / (first.max() - first.min())
+    assert image.shape == (1, size, size)
+    assert np.allclose(image[0].numpy(), expected, atol=1e-5)
+    assert metadata['Subject ID'] == 'p1' and metadata['age'] == 54
+
+
+if __name__ == "__main__":
+    pytest.main()
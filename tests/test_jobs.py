@@ -0,0 +1,152 @@
+"""Module for testing the background job queue."""
+import io
+import time
+import base64
+import hashlib
+
+import pytest
+import torch
+from torch import nn
+
+from inference import InferenceService
+from jobs import JobQueue
+from cache import PredictionCache
+
+
+def _decode(content):
+    """Create the input from the bytes of the file."""
+    if content == b'':
+        raise ValueError("empty file")
+    return torch.frombuffer(bytearray(content), dtype=torch.uint8).float().reshape(1, 2, 2), {'size': len(content)}
+
+
+def test_job_progress():
+    """Test whether the results of a job are collected in the background."""
+    model = nn.Sequential(nn.Flatten(), nn.Linear(4, 2), nn.Softmax(dim=1))
+    service = InferenceService(model, max_latency=0.05)
+    jobs = JobQueue(service, decoder=_decode, decode_workers=2)
+    try:
+        job_id = jobs.submit([bytes([i] * 4) for i in range(5)] + [b''], ["{}.dcm".format(i) for i in range(6)])
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        job = jobs.status(job_id)
+    finally:
+        jobs.close()
+        service.close()
+    assert job['status'] == 'done' and job['done'] == job['total'] == 6
+    errors = [result for result in job['results'] if 'error' in result]
+    assert [result['filename'] for result in errors] == ["5.dcm"]
+    assert sorted(result['filename'] for result in job['results'] if 'error' not in result) == ["{}.dcm".format(i) for i in range(5)]
+
+
+def test_file_handles():
+    """Test whether file handles are decoded by the service and closed."""
+    model = nn.Sequential(nn.Flatten(), nn.Linear(4, 2), nn.Softmax(dim=1))
+    service = InferenceService(model, decoder=lambda fp: _decode(fp.read()), max_latency=0.01)
+    jobs = JobQueue(service, decoder=_decode, decode_workers=1)
+    files = [io.BytesIO(bytes([2] * 4)), bytes([3] * 4)]
+    try:
+        job_id = jobs.submit(files, ["large.dcm", "small.dcm"])
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        jobs.close()
+        service.close()
+    results = jobs.status(job_id)['results']
+    assert sorted(result['filename'] for result in results) == ["large.dcm", "small.dcm"]
+    assert all('error' not in result for result in results)
+    assert files[0].closed
+
+
+def test_shared_jobs(tmp_path):
+    """Test whether a job is visible to the queue of another worker sharing the diskcache."""
+    pytest.importorskip('diskcache')
+    model = nn.Sequential(nn.Flatten(), nn.Linear(4, 2), nn.Softmax(dim=1))
+    service = InferenceService(model, max_latency=0.01)
+    jobs = JobQueue(service, decoder=_decode, decode_workers=1, cache_dir=str(tmp_path / "jobs"))
+    other = JobQueue(None, decode_workers=1, cache_dir=str(tmp_path / "jobs"))
+    try:
+        job_id = jobs.submit([bytes([1] * 4)], ["1.dcm"])
+        assert other.status(job_id)['total'] == 1
+        deadline = time.monotonic() + 60
+        while other.status(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        jobs.close()
+        other.close()
+        service.close()
+    assert other.status(job_id)['results'][0]['filename'] == "1.dcm"
+    assert other.shared and other.status("unknown") is None
+
+
+def test_prediction_cache(tmp_path):
+    """Test whether the predictions of a job are cached per model version."""
+    pytest.importorskip('diskcache')
+    model = nn.Sequential(nn.Flatten(), nn.Linear(4, 2), nn.Softmax(dim=1))
+    service = InferenceService(model, max_latency=0.01)
+    predictions = PredictionCache(3, cache_dir=str(tmp_path / "predictions"))
+    jobs = JobQueue(service, decoder=_decode, decode_workers=1, cache=predictions)
+    key = predictions.key(bytes([1] * 4))
+    try:
+        job_id = jobs.submit([bytes([1] * 4)], ["1.dcm"], [key])
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        jobs.close()
+        service.close()
+    result = jobs.status(job_id)['results'][0]
+    assert predictions.get(key) == {k: v for k, v in result.items() if k != 'filename'}
+    # Content hashed in chunks, as by the upload paths, gives the same key.
+    digest = hashlib.blake2b(digest_size=20)
+    for chunk in (bytes([1] * 3), bytes([1])):
+        digest.update(chunk)
+    assert predictions.digest_key(digest.hexdigest()) == key
+    predictions.close()
+    # The predictions are kept on disk but not shared with a new model version.
+    reloaded = PredictionCache(3, cache_dir=str(tmp_path / "predictions"))
+    assert reloaded.get(key)['pred_class'] == result['pred_class']
+    assert PredictionCache(4).key(bytes([1] * 4)) != key
+    assert reloaded.hit_rate() == 1.0
+
+
+def test_encoded_uploads(tmp_path):
+    """Test whether files uploaded again are taken from the cache without being decoded."""
+    pytest.importorskip('diskcache')
+    model = nn.Sequential(nn.Flatten(), nn.Linear(4, 2), nn.Softmax(dim=1))
+    service = InferenceService(model, max_latency=0.01)
+    predictions = PredictionCache(3, cache_dir=str(tmp_path / "predictions"))
+    jobs = JobQueue(service, decoder=_decode, decode_workers=1, cache=predictions)
+    content = bytes([1, 2, 3, 4])
+    decoded = []
+
+    def decode(contents):
+        content = base64.b64decode(contents.split(',', 1)[1])
+        decoded.append(content)
+        return content, hashlib.blake2b(content, digest_size=20).hexdigest()
+
+    url = "data:application/dicom;base64," + base64.b64encode(content).decode()
+    try:
+        job_id = jobs.submit_encoded([url], ["1.dcm"], decode)
+        deadline = time.monotonic() + 60
+        while jobs.status(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        result = jobs.status(job_id)['results'][0]
+        assert decoded == [content]
+        # The prediction is shared with the upload paths keyed on the decoded content.
+        assert predictions.get(predictions.key(content))['pred_class'] == result['pred_class']
+        for other in (url, "data:application/octet-stream;base64," + url.split(',', 1)[1]):
+            job = jobs.status(jobs.submit_encoded([other], ["2.dcm"], decode))
+            assert job['status'] == 'done'
+            assert job['results'] == [{**result, 'filename': "2.dcm"}]
+        assert len(decoded) == 1
+    finally:
+        jobs.close()
+        service.close()
+        predictions.close()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,68 @@
+"""Module for testing the streaming metrics."""
+import polars as pl
+import pytest
+import torch
+
+from metrics import ConfusionMatrix, AUROC, ClassificationMetrics
+from stats import calculate_confusion_matrix
+
+
+def test_confusion_matrix():
+    """Test whether the batched counts match a loop over the samples."""
+    generator = torch.Generator().manual_seed(0)
+    preds = torch.rand(100, 3, generator=generator)
+    labels = torch.nn.functional.one_hot(torch.randint(0, 3, (100,), generator=generator), 3)
+    cm = ConfusionMatrix(3)
+    for i in range(0, 100, 32):
+        cm.update(preds[i:i + 32], labels[i:i + 32])
+    expected = torch.zeros(3, 3, dtype=torch.int64)
+    for l, p in zip(labels.argmax(1), preds.argmax(1)):
+        expected[l, p] += 1
+    assert torch.equal(cm.matrix, expected)
+    metrics = cm.compute()
+    assert metrics['Accuracy'] == pytest.approx(expected.diagonal().sum().item() / 100)
+    assert torch.allclose(metrics['Recall'], expected.diagonal() / expected.sum(1).double())
+
+
+def test_auroc():
+    """Test whether the binned area matches the exact pairwise area."""
+    generator = torch.Generator().manual_seed(0)
+    scores = torch.rand(500, generator=generator)
+    labels = (torch.rand(500, generator=generator) < scores).long()
+    auroc = AUROC(2, n_bins=10000).update(torch.stack([1 - scores, scores], dim=1), labels).compute()
+    pos, neg = scores[labels == 1], scores[labels == 0]
+    expected = (pos[:, None] > neg[None, :]).double().mean().item()
+    assert auroc[1].item() == pytest.approx(expected, abs=1e-3)
+
+
+def test_auroc_logits():
+    """Test whether logits give the area of their probabilities."""
+    generator = torch.Generator().manual_seed(0)
+    logits = 3 * torch.randn(200, 3, generator=generator)
+    labels = torch.randint(0, 3, (200,), generator=generator)
+    expected = AUROC(3).update(torch.softmax(logits, dim=1), labels).compute()
+    assert torch.allclose(AUROC(3).update(logits, labels).compute(), expected)
+    metrics = ClassificationMetrics(3, activation=lambda x: torch.softmax(x, dim=1)).update(logits, labels).compute()
+    assert torch.allclose(metrics['AUROC'], expected)
+
+
+def test_calculate_confusion_matrix():
+    """Test whether the table of predictions is counted per actual and predicted class."""
+    predictions = pl.DataFrame({
+        'classification': ['benign', 'benign', 'malignant', 'malignant', 'malignant'],
+        'predictions': ['benign', 'malignant', 'malignant', 'malignant', 'benign'],
+    })
+    ct, metrics = calculate_confusion_matrix(predictions)
+    assert ct['classification'].to_list() == ['benign', 'malignant']
+    assert ct['benign'].to_list() == [1, 1]
+    assert ct['malignant'].to_list() == [1, 2]
+    assert metrics['Accuracy'] == pytest.approx(3 / 5)
+    assert metrics['Precision'] == pytest.approx(2 / 3)
+    assert metrics['Recall'] == pytest.approx(2 / 3)
+    assert metrics['F1 Score'] == pytest.approx(2 / 3)
+    _, averaged = calculate_confusion_matrix(predictions, positive='benign')
+    assert averaged['Precision'] == pytest.approx(1 / 2)
+
+
+if __name__ == "__main__":
+    pytest.main()
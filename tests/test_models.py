@@ -3,5 +3,20 @@ from src.models import *
 from numpy import ndarray
 import pytest
 
+
+@pytest.mark.parametrize('build, channels, n_inputs', [
+    (lambda: AlexNet(1, 2, pool_size=6), 1, 1),
+    (lambda: TumorClassifier(8, pool_size=4), 1, 2),
+    (lambda: TutorialNet(3, 2, pool_size=5), 3, 1),
+])
+def test_pooling_head(build, channels, n_inputs):
+    """Test whether the models with a pooling head accept several image resolutions."""
+    model = build().eval()
+    for size in (256, 320):
+        inputs = (torch.rand(2, channels, size, size), torch.rand(2, 8))[:n_inputs]
+        with torch.no_grad():
+            assert model(*inputs).shape == (2, 2)
+
+
 if __name__ == "__main__":
     pytest.main()
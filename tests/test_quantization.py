@@ -0,0 +1,98 @@
+"""Module for testing the post-training quantization of the models."""
+import pytest
+import torch
+from torch import nn
+from torch.utils import data
+
+from export import load_exported
+from quantization import quantize_model, save_quantized, evaluate_quantization, model_size
+
+
+class SmallNet(nn.Module):
+    """Small classifier whose first linear layer holds most of its parameters."""
+
+    def __init__(self):
+        """Init the Class."""
+        super(SmallNet, self).__init__()
+        self.conv = nn.Conv2d(1, 8, kernel_size=3)
+        self.bn = nn.BatchNorm2d(8)
+        self.relu = nn.ReLU()
+        self.flatten = nn.Flatten()
+        self.linear1 = nn.Linear(8 * 14 * 14, 64)
+        self.linear2 = nn.Linear(64, 2)
+        self.softmax = nn.Softmax(dim=1)
+
+    def forward(self, x):
+        """Forward pass of the model."""
+        x = self.flatten(self.relu(self.bn(self.conv(x))))
+        return self.softmax(self.linear2(self.relu(self.linear1(x))))
+
+
+class TwoInputNet(nn.Module):
+    """Small classifier of images and categorical data, like the TumorClassifier."""
+
+    def __init__(self):
+        """Init the Class."""
+        super(TwoInputNet, self).__init__()
+        self.conv = nn.Conv2d(1, 8, kernel_size=3)
+        self.relu = nn.ReLU()
+        self.flatten = nn.Flatten()
+        self.linear1 = nn.Linear(8 * 14 * 14, 32)
+        self.categorical = nn.Linear(3, 8)
+        self.linear2 = nn.Linear(40, 2)
+        self.softmax = nn.Softmax(dim=1)
+
+    def forward(self, x1, x2):
+        """Forward pass of the model."""
+        x1 = self.relu(self.linear1(self.flatten(self.relu(self.conv(x1)))))
+        x2 = self.relu(self.categorical(x2))
+        return self.softmax(self.linear2(torch.cat((x1, x2), dim=1)))
+
+
+def test_quantization(tmp_path, monkeypatch):
+    """Test whether the quantized model is smaller and predicts like the original model."""
+    torch.manual_seed(0)
+    model = SmallNet().eval()
+    dataset = data.TensorDataset(torch.rand(32, 1, 16, 16), torch.randint(0, 2, (32,)))
+    loader = data.DataLoader(dataset, batch_size=8)
+    quantized = quantize_model(model, loader, n_batches=4)
+    images = dataset.tensors[0]
+    with torch.no_grad():
+        expected = model(images)
+        assert torch.allclose(quantized(images), expected, atol=0.05)
+    assert model_size(quantized) < model_size(model) / 2
+
+    filename = save_quantized(quantized, "SmallNet", (images[:2],), str(tmp_path), version=1)
+    assert filename.endswith("SmallNet_int8_v1.pt")
+    with torch.no_grad():
+        assert torch.allclose(load_exported(filename)(images), expected, atol=0.05)
+
+    # ClassTrainer.test writes its results within the data folder.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    results = evaluate_quantization(model, quantized, loader, ('a', 'b'), n_batches=1)
+    assert results['Accuracy Delta'] == pytest.approx(results['int8']['Accuracy'] - results['fp32']['Accuracy'])
+    assert results['int8']['Size'] < results['fp32']['Size']
+
+
+def test_quantization_two_inputs(tmp_path, monkeypatch):
+    """Test whether a model with categorical inputs is quantized and evaluated."""
+    torch.manual_seed(0)
+    model = TwoInputNet().eval()
+    dataset = data.TensorDataset(torch.rand(32, 1, 16, 16), torch.rand(32, 3), torch.randint(0, 2, (32,)))
+    loader = data.DataLoader(dataset, batch_size=8)
+    to_inputs = lambda batch: (batch[0], batch[1])
+    quantized = quantize_model(model, loader, n_batches=4, to_inputs=to_inputs)
+    images, categorical = dataset.tensors[0], dataset.tensors[1]
+    with torch.no_grad():
+        assert torch.allclose(quantized(images, categorical), model(images, categorical), atol=0.05)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    results = evaluate_quantization(model, quantized, loader, ('a', 'b'), n_batches=1, to_inputs=to_inputs)
+    assert results['int8']['Accuracy'] == pytest.approx(results['fp32']['Accuracy'], abs=0.1)
+    assert results['int8']['Latency'] > 0
+    assert results['int8']['Size'] < results['fp32']['Size']
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,78 @@
+"""Module for testing the planning of the cpu resources."""
+import os
+
+import pytest
+import torch
+
+import resources
+from resources import ResourcePlan, parse_cpu_list
+
+
+def test_parse_cpu_list():
+    """Test whether ranges and single cpus are expanded into their ids."""
+    assert parse_cpu_list("0-3,8-11\n") == [0, 1, 2, 3, 8, 9, 10, 11]
+    assert parse_cpu_list("0,2,5-6") == [0, 2, 5, 6]
+    assert parse_cpu_list("7") == [7]
+    assert parse_cpu_list("") == []
+
+
+def test_resource_plan_split(monkeypatch):
+    """Test whether the workers take the last cores of each node in turn."""
+    monkeypatch.setattr(resources, "numa_nodes", lambda: [[0, 1, 2, 3], [4, 5, 6, 7]])
+    plan = ResourcePlan(num_workers=3)
+    assert plan.worker_cores == [3, 7, 2]
+    assert plan.compute_cores == [0, 1, 4, 5, 6]
+    assert plan.compute_threads == 5
+    # A single core is left to the compute threads.
+    monkeypatch.setattr(resources, "numa_nodes", lambda: [[0, 1]])
+    plan = ResourcePlan()
+    assert plan.num_workers == 1
+    assert plan.worker_cores == [1]
+    assert plan.compute_cores == [0]
+    plan = ResourcePlan(num_workers=4)
+    assert plan.worker_cores == [1]
+    assert plan.compute_cores == [0]
+    monkeypatch.setattr(resources, "numa_nodes", lambda: [[0]])
+    plan = ResourcePlan()
+    assert plan.num_workers == 0
+    assert plan.loader_kwargs() == {'num_workers': 0}
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="Pinning requires sched_setaffinity.")
+def test_resource_plan_apply(monkeypatch):
+    """Test whether applying the plan pins the process to the compute cores."""
+    monkeypatch.setattr(resources, "numa_nodes", lambda: [[0, 1, 2, 3]])
+    calls = []
+    monkeypatch.setattr(os, "sched_setaffinity", lambda pid, cpus: calls.append((pid, set(cpus))))
+    monkeypatch.setattr(torch, "set_num_threads", lambda n: calls.append(("threads", n)))
+    monkeypatch.setattr(torch, "set_num_interop_threads", lambda n: None)
+    ResourcePlan(num_workers=1).apply()
+    assert calls == [(0, {0, 1, 2}), ("threads", 3)]
+    calls.clear()
+    ResourcePlan(num_workers=1, pin_workers=False).apply()
+    assert calls == [("threads", 3)]
+    calls.clear()
+    plan = ResourcePlan(num_workers=2)
+    plan.worker_init_fn(1)
+    assert calls == [("threads", 1), (0, {2})]
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="Pinning requires sched_setaffinity.")
+def test_resource_plan_restore(monkeypatch):
+    """Test whether leaving the plan restores the affinity and threads of the process."""
+    monkeypatch.setattr(resources, "numa_nodes", lambda: [[0, 1, 2, 3], [4, 5, 6, 7]])
+    affinity = {0: set(range(8))}
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(affinity[pid]))
+    monkeypatch.setattr(os, "sched_setaffinity", lambda pid, cpus: affinity.update({pid: set(cpus)}))
+    monkeypatch.setattr(torch, "set_num_interop_threads", lambda n: None)
+    threads = torch.get_num_threads()
+    for plan in (ResourcePlan(num_workers=2), ResourcePlan(num_workers=4)):
+        with plan:
+            assert affinity[0] == set(plan.compute_cores)
+            assert torch.get_num_threads() == len(plan.compute_cores)
+        assert affinity[0] == set(range(8))
+        assert torch.get_num_threads() == threads
+
+
+if __name__ == "__main__":
+    pytest.main()
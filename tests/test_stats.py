@@ -0,0 +1,96 @@
+"""Module for testing the statistical functions."""
+import json
+
+import pytest
+import scipy
+import torch
+from torch import nn
+from torch.utils import data
+
+from stats import calculate_image_t_test, compute_normalization_stats
+from utils import create_normalize_transform
+
+
+def test_image_t_test():
+    """Test whether the streaming t-test matches the one from scipy."""
+    generator = torch.Generator().manual_seed(0)
+    images = torch.rand(50, 1, 4, 4, generator=generator)
+    images[:20] += 0.1
+    labels = nn.functional.one_hot(torch.cat([torch.zeros(20), torch.ones(30)]).long(), 2).float()
+    results = calculate_image_t_test(data.TensorDataset(images, labels), {'benign': 0, 'malignant': 1}, 0.99, batch_size=7)
+    means = images.flatten(start_dim=1).mean(dim=1).double().numpy()
+    expected = scipy.stats.ttest_ind(means[:20], means[20:], equal_var=False)
+    assert results['counts'] == {'benign': 20, 'malignant': 30}
+    assert results['t value'] == pytest.approx(expected.statistic)
+    assert results['degrees of freedom'] == pytest.approx(expected.df)
+    assert results['p value'] == pytest.approx(expected.pvalue)
+
+
+def test_image_t_test_ignores_other_classes():
+    """Test whether classes outside of the comparison are skipped."""
+    generator = torch.Generator().manual_seed(0)
+    images = torch.rand(60, 1, 4, 4, generator=generator)
+    indices = torch.cat([torch.full((20,), 2), torch.zeros(15), torch.ones(25)]).long()
+    labels = nn.functional.one_hot(indices, 3).float()
+    results = calculate_image_t_test(data.TensorDataset(images, labels), {'malignant': 2, 'benign': 0}, batch_size=8)
+    means = images.flatten(start_dim=1).mean(dim=1).double().numpy()
+    expected = scipy.stats.ttest_ind(means[:20], means[20:35], equal_var=False)
+    assert results['counts'] == {'malignant': 20, 'benign': 15}
+    assert results['t value'] == pytest.approx(expected.statistic)
+    assert results['p value'] == pytest.approx(expected.pvalue)
+
+
+def test_normalization_stats(tmp_path):
+    """Test whether the batched statistics match those of the whole tensor."""
+    images = torch.rand(30, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+    filename = str(tmp_path / ".normalization.json")
+    stats = compute_normalization_stats(data.TensorDataset(images, torch.zeros(30)), filename, batch_size=7)
+    pixels = images.transpose(0, 1).flatten(start_dim=1).double()
+    assert stats['mean'] == pytest.approx(pixels.mean(dim=1).tolist())
+    assert stats['std'] == pytest.approx(pixels.std(dim=1).tolist())
+    assert sum(stats['histogram'][0]) == 30 * 8 * 8
+    normalize = create_normalize_transform(str(tmp_path))
+    assert normalize.mean == stats['mean']
+
+
+class PathSet(data.Dataset):
+    """Dataset of random images listed by path, such as an ImageSet."""
+
+    def __init__(self, paths:list[str], size:int=8, transform=None):
+        """Init the Class."""
+        self.paths = paths
+        self.size = size
+        self.transform = transform
+
+    def __len__(self):
+        """Get the number of images."""
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        """Get the image of the path and its label."""
+        generator = torch.Generator().manual_seed(int(self.paths[index].split('.')[0]))
+        image = torch.rand(1, self.size, self.size, generator=generator)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, 0
+
+
+def test_normalization_stats_signature(tmp_path):
+    """Test whether the saved statistics are only reused for the same samples, transform, and shape."""
+    filename = str(tmp_path / ".normalization.json")
+    paths = ["{}.png".format(i) for i in range(10)]
+    compute_normalization_stats(PathSet(paths), filename)
+    with open(filename, 'r') as fp:
+        saved = json.load(fp)
+    saved['mean'] = [-1.0]
+    with open(filename, 'w') as fp:
+        json.dump(saved, fp)
+    assert compute_normalization_stats(PathSet(paths), filename)['mean'] == [-1.0]
+    for dataset in (PathSet(["{}.png".format(i) for i in range(10, 20)]), PathSet(paths, size=4), PathSet(paths, transform=lambda x: 2 * x)):
+        with open(filename, 'w') as fp:
+            json.dump(saved, fp)
+        assert compute_normalization_stats(dataset, filename)['mean'] != [-1.0]
+
+
+if __name__ == "__main__":
+    pytest.main()
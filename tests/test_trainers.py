@@ -0,0 +1,218 @@
+"""Module for testing the trainers."""
+import os
+import threading
+import time
+
+import pytest
+import torch
+from torch import nn, optim
+from torch.utils import data
+
+from PIL import Image
+import numpy as np
+
+from trainers import ClassTrainer, PrefetchLoader, launch, distributed_loader
+from checkpoints import Checkpointer
+from datasets import ShardSet
+from ingest import write_shards
+
+
+def _train_tiny(rank, world_size, output):
+    """Train a small classifier on random data within each process."""
+    torch.manual_seed(0)
+    inputs = torch.randn(32, 1, 8, 8)
+    labels = nn.functional.one_hot(torch.randint(0, 2, (32,)), 2).float()
+    model = nn.Sequential(nn.Conv2d(1, 4, 3), nn.ReLU(), nn.Flatten(), nn.Linear(144, 2), nn.Softmax(dim=1))
+    trainer = ClassTrainer(model, optim.SGD(model.parameters(), lr=0.1), nn.BCELoss())
+    trainer.train(distributed_loader(data.TensorDataset(inputs, labels), batch_size=4), 2)
+    weights = torch.cat([p.detach().flatten() for p in trainer.get_model().parameters()])
+    torch.save(weights, os.path.join(output, "weights_{}.pt".format(rank)))
+    trainer.save_model(os.path.join(output, "model.pt"))
+
+
+def test_distributed_training(tmp_path):
+    """Test whether the processes end with identical weights."""
+    launch(_train_tiny, 2, str(tmp_path), master_port=29531)
+    weights0 = torch.load(tmp_path / "weights_0.pt")
+    weights1 = torch.load(tmp_path / "weights_1.pt")
+    assert torch.equal(weights0, weights1)
+    assert os.path.exists(tmp_path / "model.pt")
+
+
+def _to_image(img):
+    """Convert an image of the shards into a tensor of shape (1, height, width)."""
+    return torch.from_numpy(img).permute(2, 0, 1)
+
+def _to_one_hot(cat):
+    """Convert a label of the shards into a one-hot encoded tensor."""
+    return nn.functional.one_hot(torch.tensor(cat % 2), 2).float()
+
+def _train_shards(rank, world_size, root, output):
+    """Train a small classifier on the shards within each process."""
+    torch.manual_seed(0)
+    dataset = ShardSet(root, shuffle_buffer=4, image_transforms=_to_image, categorical_transforms=_to_one_hot)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(64, 2), nn.Softmax(dim=1))
+    trainer = ClassTrainer(model, optim.SGD(model.parameters(), lr=0.1), nn.BCELoss())
+    trainer.train(distributed_loader(dataset, batch_size=2), 2)
+    weights = torch.cat([p.detach().flatten() for p in trainer.get_model().parameters()])
+    torch.save(weights, os.path.join(output, "weights_{}.pt".format(rank)))
+
+
+def test_distributed_uneven_shards(tmp_path):
+    """Test whether ranks given uneven shards finish the epochs together."""
+    images = tmp_path / "images"
+    images.mkdir()
+    labels = dict()
+    for i in range(11):
+        path = images / "{}.png".format(i)
+        Image.fromarray(np.full((12, 12), 20 * i, dtype=np.uint8)).save(path)
+        labels[str(path)] = i
+    # Shards of 4, 4, and 3 samples, which were assigned whole as 8 and 3.
+    write_shards(str(images), str(tmp_path / "shards"), size=8, shard_size=4, workers=1, labels=labels)
+    launch(_train_shards, 2, str(tmp_path / "shards"), str(tmp_path), master_port=29533)
+    assert torch.equal(torch.load(tmp_path / "weights_0.pt"), torch.load(tmp_path / "weights_1.pt"))
+
+
+def _resumable_trainer(checkpointer):
+    """Create a trainer of a small classifier with dropout and momentum."""
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(64, 16), nn.Dropout(0.5), nn.Linear(16, 2), nn.Softmax(dim=1))
+    opt = optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    return ClassTrainer(model, opt, nn.BCELoss(), checkpointer=checkpointer)
+
+
+def test_resume_training(tmp_path):
+    """Test whether resuming from a checkpoint matches an uninterrupted run."""
+    generator = torch.Generator().manual_seed(1)
+    inputs = torch.randn(32, 1, 8, 8, generator=generator)
+    labels = nn.functional.one_hot(torch.randint(0, 2, (32,), generator=generator), 2).float()
+    dataset = data.TensorDataset(inputs, labels)
+    trainer = _resumable_trainer(Checkpointer(str(tmp_path), every_steps=3, keep_last=10))
+    trainer.train(data.DataLoader(dataset, batch_size=4, shuffle=True), 2)
+    checkpoints = trainer.checkpointer.checkpoints()
+    assert [os.path.basename(c) for c in checkpoints] == ["checkpoint-{:08d}.pt".format(s) for s in (3, 6, 9, 12, 15, 16)]
+
+    # Resume within the second epoch, as if the run crashed after step 11.
+    resumed = _resumable_trainer(Checkpointer(str(tmp_path), every_steps=3, keep_last=2))
+    assert resumed.resume(checkpoints[2])
+    resumed.train(data.DataLoader(dataset, batch_size=4, shuffle=True), 2)
+    for expected, actual in zip(trainer.get_model().parameters(), resumed.get_model().parameters()):
+        assert torch.equal(expected, actual)
+    assert len(resumed.checkpointer.checkpoints()) == 2
+
+
+def _linear_trainer(**kwargs):
+    """Create a trainer of a small linear classifier with plain SGD."""
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(64, 2), nn.Softmax(dim=1))
+    return ClassTrainer(model, optim.SGD(model.parameters(), lr=0.1), nn.BCELoss(), **kwargs)
+
+
+def test_accumulation_steps():
+    """Test whether accumulating two batches of 4 matches one batch of 8."""
+    generator = torch.Generator().manual_seed(2)
+    inputs = torch.randn(32, 1, 8, 8, generator=generator)
+    labels = nn.functional.one_hot(torch.randint(0, 2, (32,), generator=generator), 2).float()
+    dataset = data.TensorDataset(inputs, labels)
+    accumulated = _linear_trainer(accumulation_steps=2)
+    accumulated.train(data.DataLoader(dataset, batch_size=4), 1)
+    single = _linear_trainer()
+    single.train(data.DataLoader(dataset, batch_size=8), 1)
+    assert accumulated.step == single.step == 4
+    for expected, actual in zip(single.get_model().parameters(), accumulated.get_model().parameters()):
+        assert torch.allclose(expected, actual, atol=1e-6)
+    # The leftover batch of 5 batches is a whole step of its own.
+    dataset = data.TensorDataset(inputs[:20], labels[:20])
+    accumulated = _linear_trainer(accumulation_steps=2)
+    accumulated.train(data.DataLoader(dataset, batch_size=4), 1)
+    single = _linear_trainer()
+    single.train(data.DataLoader(dataset, batch_size=8), 1)
+    assert accumulated.step == single.step == 3
+    for expected, actual in zip(single.get_model().parameters(), accumulated.get_model().parameters()):
+        assert torch.allclose(expected, actual, atol=1e-6)
+
+
+def test_mixed_precision_channels_last():
+    """Test whether training under bf16 autocast in channels last format updates the model."""
+    generator = torch.Generator().manual_seed(3)
+    inputs = torch.randn(16, 3, 8, 8, generator=generator)
+    labels = nn.functional.one_hot(torch.randint(0, 2, (16,), generator=generator), 2).float()
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.ReLU(), nn.Flatten(), nn.Linear(144, 2), nn.Softmax(dim=1))
+    initial = [p.detach().clone() for p in model.parameters()]
+    trainer = ClassTrainer(model, optim.SGD(model.parameters(), lr=0.1), nn.BCELoss(), mixed_precision=True, channels_last=True)
+    trainer.train(data.DataLoader(data.TensorDataset(inputs, labels), batch_size=4), 1)
+    assert model[0].weight.is_contiguous(memory_format=torch.channels_last)
+    for before, after in zip(initial, model.parameters()):
+        assert after.dtype == torch.float32
+        assert torch.isfinite(after).all()
+        assert not torch.equal(before, after)
+
+
+class SlowSet(data.Dataset):
+    """Dataset that sleeps before returning each sample and can fail at an index."""
+
+    def __init__(self, length:int, delay:float=0.0, fail_at:int=None):
+        """Init the Class."""
+        self.length = length
+        self.delay = delay
+        self.fail_at = fail_at
+        self.loaded = 0
+
+    def __len__(self):
+        """Get the number of samples."""
+        return self.length
+
+    def __getitem__(self, idx):
+        """Get the sample filled with its index."""
+        if idx == self.fail_at:
+            raise ValueError("Corrupt sample {}".format(idx))
+        time.sleep(self.delay)
+        self.loaded += 1
+        return torch.full((2,), float(idx))
+
+
+def test_prefetch_loader():
+    """Test whether the prefetched batches match the wrapped loader."""
+    loader = data.DataLoader(SlowSet(10), batch_size=3)
+    prefetched = PrefetchLoader(loader, n_batches=2)
+    assert len(prefetched) == 4
+    assert prefetched.dataset is loader.dataset
+    for expected, actual in zip(loader, prefetched):
+        assert torch.equal(expected, actual)
+
+
+def test_prefetch_loader_exception():
+    """Test whether an error of the loader reaches the caller."""
+    prefetched = PrefetchLoader(data.DataLoader(SlowSet(10, fail_at=5), batch_size=2))
+    batches = []
+    with pytest.raises(ValueError, match="Corrupt sample 5"):
+        for batch in prefetched:
+            batches.append(batch)
+    assert len(batches) == 2
+
+
+def test_prefetch_loader_early_exit():
+    """Test whether leaving the loop early stops the background thread."""
+    threads = set(threading.enumerate())
+    dataset = SlowSet(100, delay=0.001)
+    for batch in PrefetchLoader(data.DataLoader(dataset, batch_size=1), n_batches=2):
+        break
+    assert set(threading.enumerate()) == threads
+    # One batch was consumed, at most the queue and the one in hand were staged.
+    assert dataset.loaded <= 4
+
+
+def test_prefetch_loader_wait_time():
+    """Test whether the time spent waiting for a slow loader is reported."""
+    prefetched = PrefetchLoader(data.DataLoader(SlowSet(5, delay=0.05), batch_size=1))
+    assert len(list(prefetched)) == 5
+    assert prefetched.wait_time >= 0.2
+    for batch in prefetched:
+        # Computing longer than loading leaves the staged batches ready.
+        time.sleep(0.1)
+    assert prefetched.wait_time < 0.2
+
+
+if __name__ == "__main__":
+    pytest.main()
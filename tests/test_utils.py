@@ -0,0 +1,86 @@
+"""Module for testing the utility functions."""
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from cache import ArrayCache
+from utils import STANDARD_IMAGE_TRANSFORMS, BatchImageTransform, BatchCollate, load_image, load_images
+
+
+def test_batch_transform_matches_standard_transforms():
+    """Test whether the batched transforms match the per-sample transforms."""
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (600, 400, 3), dtype=np.uint8)) for _ in range(2)]
+    expected = torch.stack([STANDARD_IMAGE_TRANSFORMS(img) for img in images])
+    collate = BatchCollate(BatchImageTransform())
+    batch, labels = collate([(transforms.PILToTensor()(img), i) for i, img in enumerate(images)])
+    assert batch.shape == expected.shape
+    assert torch.allclose(batch, expected, atol=1 / 255)
+    assert labels.tolist() == [0, 1]
+
+
+def test_load_image_cache(tmp_path):
+    """Test whether cached images are loaded from memory and disk."""
+    filename = str(tmp_path / "image.png")
+    Image.fromarray(np.arange(64 * 48, dtype=np.uint32).reshape(64, 48).astype(np.uint8)).save(filename)
+    cache = ArrayCache(str(tmp_path / "cache"))
+    img = load_image(filename, 32, cache=cache)
+    assert np.array_equal(load_image(filename, 32, cache=cache), img)
+    assert cache.stats == {'memory hits': 1, 'disk hits': 0, 'misses': 1}
+    reloaded = ArrayCache(str(tmp_path / "cache"))
+    assert np.array_equal(load_image(filename, 32, cache=reloaded), img)
+    assert reloaded.stats['disk hits'] == 1
+
+
+def _load_full_resolution(filename, size):
+    """Load the image by resizing the fully decoded image, as before drafting."""
+    data = np.asarray(Image.open(filename).convert('L').resize(size)).astype('float32')
+    return ((data - data.min()) / (data.max() - data.min()))[np.newaxis, ...]
+
+
+@pytest.mark.parametrize("extension", ["jpg", "png"])
+def test_load_image_matches_full_resolution(tmp_path, extension):
+    """Test whether the reduced decoding matches the full resolution resize."""
+    y, x = np.mgrid[0:480, 0:640]
+    rgb = np.stack([x / 640 * 255, y / 480 * 255, (np.sin(x / 40) * np.cos(y / 30) + 1) * 127], axis=-1).astype(np.uint8)
+    filename = str(tmp_path / "image.{}".format(extension))
+    if extension == "jpg":
+        Image.fromarray(rgb).save(filename, quality=95)
+    else:
+        Image.fromarray(rgb).save(filename)
+    img = load_image(filename, (80, 60))
+    expected = _load_full_resolution(filename, (80, 60))
+    assert img.shape == (1, 60, 80)
+    assert img.dtype == np.float32
+    assert img.min() == 0 and img.max() == 1
+    assert np.allclose(img, expected, atol=0.02)
+    assert np.abs(img - expected).mean() < 0.005
+
+
+def test_load_image_constant(tmp_path):
+    """Test whether an image of a single value loads as zeros instead of NaNs."""
+    filename = str(tmp_path / "constant.jpg")
+    Image.fromarray(np.full((200, 300), 128, dtype=np.uint8)).save(filename)
+    img = load_image(filename, 32)
+    assert img.shape == (1, 32, 32)
+    assert np.array_equal(img, np.zeros((1, 32, 32), dtype=np.float32))
+
+
+def test_load_images_order(tmp_path):
+    """Test whether the threaded loading keeps the order of the filenames."""
+    rng = np.random.default_rng(0)
+    filenames = []
+    for i in range(12):
+        filename = str(tmp_path / "{}.png".format(i))
+        Image.fromarray(rng.integers(0, 256, (40 + i, 50), dtype=np.uint8)).save(filename)
+        filenames.append(filename)
+    images = load_images(filenames, 16, max_workers=4)
+    assert len(images) == len(filenames)
+    for filename, img in zip(filenames, images):
+        assert np.array_equal(img, load_image(filename, 16))
+
+
+if __name__ == "__main__":
+    pytest.main()